@@ -0,0 +1,348 @@
+"""Versioned JSON API over the database.py read functions.
+
+    GET /api/v1/<resource>                  a page; same filters, sort, order,
+                                            after and limit as the HTML lists
+    GET /api/v1/<resource>?ids=1,2,3        batch get by primary key
+    GET /api/v1/<resource>/<id>             one row (projects: /<employee_id>/<team_id>)
+    GET /api/v1/org                         headcount and salary by department and position
+    GET /api/v1/org/teams                   the same per team, with project staffing
+    GET /api/v1/leaves/out?date_from=&date_to=   approved leave covering those dates
+    GET /api/v1/leaves/balances?year=       leave balances for the year
+    GET /api/v1/attendance/rates?by=        attendance rate per employee, department,
+                                            month or overall (see attendance_store.py)
+    GET /api/v1/changes?since=<seq>         the change feed (see changes.py)
+    GET /api/v1/jobs?status=                background jobs, newest first (see jobs.py)
+    GET /api/v1/jobs/<id>                   one job, with its progress and result
+    GET /api/v1/tenants                     summary row counts of every tenant shard
+    GET /api/v1/tenants/<resource>          a page across every tenant (see shards.py)
+    GET /api/v1/tenants/reports?month=      department report rows of every tenant
+
+Any request may name a tenant in the X-Tenant header or ``tenant=``.
+
+Every request accepts ``fields=Name,Other`` to return only those columns.
+Responses carry a weak ETag derived from the change counters of the
+tables they read (migration 12), so a client revalidating with
+If-None-Match gets a 304 before any query for the data runs. Last-Modified
+is informational only: it has whole seconds, and If-Modified-Since is not
+honoured. Bodies over MIN_COMPRESS_SIZE bytes are brotli (when the
+brotli package is installed) or gzip encoded if the client accepts it.
+"""
+import gzip
+import hashlib
+from datetime import datetime, timezone
+
+from flask import Blueprint, abort, current_app, jsonify, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import is_resource_modified, quote_etag
+
+import attendance_store
+import changes
+import database
+import jobs
+import leave_index
+import org_chart
+import reports
+import shards
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+VERSION = "v1"
+MIN_COMPRESS_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+ID_SEPARATOR = ":"
+
+api = Blueprint("api", __name__, url_prefix=f"/api/{VERSION}")
+
+# resource -> (table, tables the response reads, page function, page filters, get function)
+RESOURCES = {
+    "employees": (
+        "Employee_details", ("Employee_details", "Department", "Position"),
+        database.get_employee_page, ("department_id", "position", "position_id", "status", "team_id"), database.get_employee,
+    ),
+    "departments": (
+        "Department", ("Department",),
+        database.get_department_page, ("location",), database.get_department,
+    ),
+    "positions": (
+        "Position", ("Position",),
+        database.get_position_page, ("department_id",), database.get_position,
+    ),
+    "attendance": (
+        "Attendance", ("Attendance", "Employee_details"),
+        database.get_attendance_page, ("employee_id", "date_from", "date_to", "status"), database.get_attendance,
+    ),
+    "leaves": (
+        "Leave", ("Leave", "Employee_details"),
+        database.get_leave_page, ("employee_id", "date_from", "date_to", "status"), database.get_leave,
+    ),
+    "projects": (
+        "Project", ("Project", "Employee_details"),
+        database.get_project_page, ("employee_id", "team_id", "status"), database.get_project,
+    ),
+    "payrolls": (
+        "Payroll", ("Payroll", "Employee_details"),
+        database.get_payroll_page, ("employee_id", "month", "month_from", "month_to"), database.get_payroll,
+    ),
+}
+
+def _resource(name):
+    if name not in RESOURCES:
+        abort(404, f"unknown resource {name!r}")
+    return RESOURCES[name]
+
+def _fields():
+    fields = request.args.get("fields")
+    return [field.strip() for field in fields.split(",") if field.strip()] if fields else None
+
+def _select(row, fields):
+    if fields is None:
+        return row
+    unknown = [field for field in fields if field not in row]
+    if unknown:
+        abort(400, f"unknown fields: {', '.join(unknown)}")
+    return {field: row[field] for field in fields}
+
+def int_arg(name, default=None):
+    """The integer query argument ``name``, ``default`` if absent; 400 if it is not an integer."""
+    value = request.args.get(name, "")
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        abort(400, f"{name} must be an integer, got {value!r}")
+
+def limit_arg(default, maximum=database.MAX_PAGE_SIZE):
+    """The ``limit`` query argument, at most ``maximum``; 400 if it is not a positive integer."""
+    limit = int_arg("limit", default)
+    if limit < 1:
+        abort(400, f"limit must be at least 1, got {limit}")
+    return min(limit, maximum)
+
+def _parse_ids(table, raw):
+    width = len(database.KEYS[table])
+    ids = []
+    for part in raw.split(","):
+        if not part.strip():
+            continue
+        try:
+            key = tuple(int(value) for value in part.split(ID_SEPARATOR))
+        except ValueError:
+            abort(400, f"invalid id {part!r}")
+        if len(key) != width:
+            abort(400, f"{table} ids have {width} part(s), got {part!r}")
+        ids.append(key if width > 1 else key[0])
+    if len(ids) > database.MAX_PAGE_SIZE:
+        abort(400, f"at most {database.MAX_PAGE_SIZE} ids per request")
+    return ids
+
+def _validators(tables):
+    """Return (etag, last modified) for a response reading ``tables``."""
+    versions = database.get_table_versions(tables)
+    # Shards count their versions independently, so two tenants can share counters
+    tag = repr((VERSION, database.current_shard(), request.full_path, sorted(versions.items()))).encode()
+    modified = datetime.fromtimestamp(max(at for _, at in versions.values()), timezone.utc)
+    return hashlib.sha1(tag).hexdigest(), modified
+
+def _respond(tables, load):
+    """Answer 304 if the client's copy is current, else jsonify ``load()``."""
+    etag, modified = _validators(tables)
+    # Only the ETag validates: the counters move within a second, which
+    # Last-Modified cannot show, so If-Modified-Since alone never earns a 304
+    if is_resource_modified(request.environ, etag=quote_etag(etag, weak=True)):
+        response = jsonify(load())
+    else:
+        response = current_app.response_class(status=304)
+    response.set_etag(etag, weak=True)
+    response.last_modified = modified
+    response.vary.add(shards.TENANT_HEADER)
+    response.cache_control.no_cache = True
+    return response
+
+@api.route("", methods=["GET"])
+def get_index():
+    return jsonify({name: f"{request.base_url}/{name}" for name in RESOURCES})
+
+@api.route("/<resource>", methods=["GET"])
+def get_list(resource):
+    table, tables, fetch, filters, _ = _resource(resource)
+    fields = _fields()
+    if "ids" in request.args:
+        ids = _parse_ids(table, request.args["ids"])
+
+        def load():
+            rows = database.get_by_ids(table, ids)
+            found = {tuple(row[key] for key in database.KEYS[table]) for row in rows}
+            missing = [key for key in ids if (key if isinstance(key, tuple) else (key,)) not in found]
+            return {"data": [_select(row, fields) for row in rows], "missing": missing}
+        return _respond(tables, load)
+
+    args = {name: request.args.get(name) or None for name in filters}
+    page = dict(
+        sort=request.args.get("sort"),
+        order=request.args.get("order", "asc"),
+        after=request.args.get("after"),
+        limit=limit_arg(database.PAGE_SIZE),
+    )
+
+    def load():
+        try:
+            result = fetch(**page, **args)
+        except ValueError as error:
+            abort(400, str(error))
+        result["data"] = [_select(row, fields) for row in result.pop("rows")]
+        return result
+    return _respond(tables, load)
+
+@api.route("/org", methods=["GET"])
+def get_org():
+    return _respond(org_chart.TABLES, org_chart.get_chart().summary)
+
+@api.route("/org/teams", methods=["GET"])
+def get_org_teams():
+    after = int_arg("after")
+    limit = limit_arg(org_chart.TEAM_PAGE_SIZE)
+    return _respond(org_chart.TABLES, lambda: org_chart.get_chart().teams(after=after, limit=limit))
+
+@api.route("/leaves/out", methods=["GET"])
+def get_leave_out():
+    date_from = request.args.get("date_from") or datetime.now().date().isoformat()
+    date_to = request.args.get("date_to") or date_from
+    statuses = tuple(request.args.get("status", ",".join(leave_index.OUT_STATUSES)).split(","))
+
+    def load():
+        try:
+            return {"data": leave_index.get_index().who_is_out(date_from, date_to, statuses)}
+        except ValueError as error:
+            abort(400, str(error))
+    return _respond(("Leave",), load)
+
+@api.route("/leaves/balances", methods=["GET"])
+def get_leave_balances():
+    year = int_arg("year", datetime.now().year)
+    after = int_arg("after")
+    limit = limit_arg(leave_index.BALANCE_PAGE_SIZE)
+    if "employee_id" in request.args:
+        employee_id = int_arg("employee_id")
+        return _respond(("Leave",), lambda: {"data": leave_index.get_index().balance(employee_id, year)})
+    return _respond(("Leave",), lambda: leave_index.get_index().balances(year, after, limit))
+
+@api.route("/attendance/rates", methods=["GET"])
+def get_attendance_rates():
+    by = request.args.get("by", "employee")
+    status = request.args.get("status")
+    args = {
+        "date_from": request.args.get("date_from") or None, "date_to": request.args.get("date_to") or None,
+        "employee_id": int_arg("employee_id"), "department_id": int_arg("department_id"),
+        "statuses": tuple(status.split(",")) if status else None,
+    }
+
+    def load():
+        try:
+            return {"by": by, "data": attendance_store.get_store().summary(by, **args)}
+        except ValueError as error:
+            abort(400, str(error))
+        except RuntimeError as error:
+            abort(501, str(error))
+    return _respond(("Attendance", "Employee_details"), load)
+
+@api.route("/changes", methods=["GET"])
+def get_changes():
+    since = int_arg("since", 0)
+    limit = limit_arg(changes.PAGE_SIZE)
+    wait = min(max(request.args.get("wait", 0, type=float), 0), changes.MAX_WAIT)
+    tables = [name for name in request.args.get("tables", "").split(",") if name]
+    unknown = set(tables) - set(database.TABLES)
+    if unknown:
+        abort(400, f"unknown tables: {', '.join(sorted(unknown))}")
+    try:
+        result = changes.wait_for_changes(since, limit, tables, wait)
+    except changes.Behind as error:
+        return jsonify({"error": str(error), "status": 410, "floor": error.floor}), 410
+    response = jsonify(result)
+    response.cache_control.no_store = True
+    return response
+
+@api.route("/jobs", methods=["GET"])
+def get_jobs():
+    limit = limit_arg(jobs.PAGE_SIZE)
+    try:
+        page = jobs.list_jobs(request.args.get("status") or None, database.current_shard(), int_arg("after"), limit)
+    except ValueError as error:
+        abort(400, str(error))
+    response = jsonify({"data": page["jobs"], "next_after": page["next_after"]})
+    response.cache_control.no_store = True
+    return response
+
+@api.route("/jobs/<int:id>", methods=["GET"])
+def get_job(id):
+    job = jobs.get_job(id)
+    if job is None or job["Tenant"] != database.current_shard():
+        abort(404, f"job {id} not found")
+    response = jsonify({"data": job})
+    response.cache_control.no_store = True
+    return response
+
+@api.route("/tenants", methods=["GET"])
+def get_tenants():
+    return jsonify(shards.summary_counts())
+
+@api.route("/tenants/reports", methods=["GET"])
+def get_tenant_reports():
+    month = request.args.get("month") or reports.current_month()
+    return jsonify({"month": month, "data": shards.get_department_month(month)})
+
+@api.route("/tenants/<resource>", methods=["GET"])
+def get_tenant_list(resource):
+    _, _, fetch, filters, _ = _resource(resource)
+    fields = _fields()
+    args = {name: request.args.get(name) or None for name in filters}
+    try:
+        result = shards.fetch_pages(
+            fetch, sort=request.args.get("sort"), order=request.args.get("order", "asc"),
+            after=request.args.get("after"), limit=limit_arg(database.PAGE_SIZE), **args,
+        )
+    except ValueError as error:
+        abort(400, str(error))
+    result["data"] = [dict(_select(row, fields), Tenant=row["Tenant"]) for row in result.pop("rows")]
+    return jsonify(result)
+
+@api.route("/<resource>/<int:id>", methods=["GET"])
+@api.route("/<resource>/<int:id>/<int:team_id>", methods=["GET"])
+def get_item(resource, id, team_id=None):
+    table, tables, _, _, get = _resource(resource)
+    key = (id,) if team_id is None else (id, team_id)
+    if len(key) != len(database.KEYS[table]):
+        abort(404, f"{resource} are addressed by /{'/'.join(database.KEYS[table])}")
+
+    def load():
+        row = get(*key)
+        if row is None:
+            abort(404, f"{resource} {ID_SEPARATOR.join(map(str, key))} not found")
+        return {"data": _select(row, _fields())}
+    return _respond(tables, load)
+
+@api.errorhandler(HTTPException)
+def handle_error(error):
+    return jsonify({"error": error.description, "status": error.code}), error.code
+
+@api.after_request
+def compress(response):
+    response.vary.add("Accept-Encoding")
+    if response.status_code != 200 or response.direct_passthrough or "Content-Encoding" in response.headers:
+        return response
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS_SIZE:
+        return response
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+        response.headers["Content-Encoding"] = "br"
+    elif accepted["gzip"]:
+        response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
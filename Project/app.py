@@ -1,24 +1,41 @@
-import sqlite3
-import pandas as pd
-import os
+import sys
 
-# Create output folder
-output_folder = 'output_csv'
-os.makedirs(output_folder, exist_ok=True)
+import database
+import export
+import jobs
 
-# Connect to the database
-conn = sqlite3.connect('employee_management.db')
+# Export every table in the EMS database to CSV in the 'output_csv' folder.
+# The export runs as a background job (see jobs.py), so it is recorded in
+# the job table, shows on the app's /jobs page and can be cancelled there
+# or with Ctrl-C; the app can also run it on a schedule. Rows are streamed
+# in chunks and tables exported in parallel; pass --incremental to write
+# only rows changed since the last run, or --format parquet for columnar
+# files. See export.py for all options.
+# For a consistent, restorable copy of the whole database use backup.py.
+def main(argv=None):
+    args = export.parse_args(argv)
+    database.initialize(args.database, pool_size=max(args.workers, 1) + 1)
+    job_id = jobs.submit("export", {
+        "output": args.output, "tables": args.tables or None, "format": args.format,
+        "incremental": args.incremental, "workers": args.workers, "chunk_size": args.chunk_size,
+    })
+    # Run it here unless a running app claims it first
+    runner = jobs.JobRunner(workers=1, kinds=("export",), schedules=False).start()
+    progress = lambda job: print(f"job {job_id}: {job['Progress'] * 100:.0f}% {job['Message'] or ''}", flush=True)
+    try:
+        try:
+            job = jobs.wait(job_id, on_progress=progress)
+        except KeyboardInterrupt:
+            jobs.cancel(job_id)
+            job = jobs.wait(job_id)
+    finally:
+        runner.stop()
+        database.close()
+    if job["Status"] != "succeeded":
+        print(f"❌ job {job_id} {job['Status']}{': ' + job['Error'] if job['Error'] else ''}")
+        return 1
+    export.print_results(job["Result"], args)
+    return 0
 
-# List of tables
-tables = ['Department', 'Position', 'Employee', 'Attendance', 'LeaveRequest', 'Payroll']
-
-# Export each table to CSV
-for table in tables:
-    df = pd.read_sql_query(f"SELECT * FROM {table};", conn)
-    file_path = os.path.join(output_folder, f"{table}.csv")
-    df.to_csv(file_path, index=False)
-    print(f"✅ {table}.csv created successfully at {file_path}")
-
-conn.close()
-
-print("\nAll tables exported to CSV in 'output_csv' folder.")
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,17 @@
+"""ASGI entry point serving the main.py app.
+
+    uvicorn asgi:application --port 8000 --workers 4
+    hypercorn asgi:application --workers 4
+
+The views and database.py are synchronous, so the app is wrapped with
+asgiref's WsgiToAsgi: each request runs on asgiref's executor thread and
+never blocks the event loop, and requests in parallel come from the
+server's worker processes. No view awaits I/O of its own; one that does
+should be written as an async view rather than added here.
+"""
+from asgiref.wsgi import WsgiToAsgi
+
+import main
+
+app = main.init()
+application = WsgiToAsgi(app)
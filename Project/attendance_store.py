@@ -0,0 +1,354 @@
+"""Columnar in-memory copy of Attendance for analytics.
+
+database.get_attendances() returns one dict per row, a few hundred bytes
+each; years of history for thousands of employees do not fit in memory
+that way. AttendanceStore keeps the table as numpy columns instead:
+
+    ids        int64   AttendanceID, ascending
+    employees  int32   EmployeeID (-1: none)
+    days       int32   days since 1970-01-01 (NO_DAY: no or bad date)
+    codes      uint8   Status, dictionary-encoded in ``statuses``
+
+about 17 bytes a row. Queries are vectorized scans: a boolean mask for the
+filters, then one bincount over (group, status code) for the counts of
+every group at once. Departments are looked up per query from a small
+EmployeeID -> DepartmentID array, so a transfer regroups all of an
+employee's history without touching the columns.
+
+The store is loaded on its first query and kept current like leave_index:
+create/update/delete_attendance report the AttendanceIDs they wrote
+(database.on_change) and the store re-reads those rows; other writes move
+the Attendance change counter and the next query catches up on rows with
+a newer RowVersion. Inserts append to columns with spare capacity, and a
+deleted row keeps its place with status code 0 until compaction.
+
+Requires numpy.
+"""
+import threading
+from datetime import date
+
+import conversions
+import database
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Status code 0 marks a deleted row
+DELETED = "\0deleted"
+NO_DAY = -(2 ** 31)
+EPOCH = date(1970, 1, 1).toordinal()
+GROUPS = ("employee", "department", "month", "all")
+# Compact once this share of the rows are deleted
+COMPACT_RATIO = 0.25
+INITIAL_CAPACITY = 1024
+LOAD_CHUNK_SIZE = 50000
+
+def _day(value):
+    try:
+        return date.fromisoformat(conversions.iso_date(value)).toordinal() - EPOCH
+    except (TypeError, ValueError):
+        return NO_DAY
+
+def _days(values):
+    """int32 day numbers of ``values``; numpy parses a batch of plain ISO dates in one go."""
+    if all(type(value) is str and len(value) == 10 for value in values):
+        try:
+            return numpy.array(values, "datetime64[D]").astype(numpy.int32)
+        except ValueError:
+            pass
+    return numpy.fromiter((_day(value) for value in values), numpy.int32, len(values))
+
+class AttendanceStore:
+    def __init__(self):
+        if numpy is None:
+            raise RuntimeError("the attendance store requires the numpy package")
+        self._lock = threading.RLock()
+        self.loaded = False
+
+    def _reset(self, capacity=INITIAL_CAPACITY):
+        self.size = 0
+        self.ids = numpy.empty(capacity, numpy.int64)
+        self.employees = numpy.empty(capacity, numpy.int32)
+        self.days = numpy.empty(capacity, numpy.int32)
+        self.codes = numpy.empty(capacity, numpy.uint8)
+        self.statuses = [DELETED]
+        self.status_codes = {DELETED: 0}
+        self.deleted = 0
+        self.watermark = 0
+        self.version = 0
+        self._departments = None
+        self._departments_version = None
+
+    def _code(self, status):
+        status = status or ""
+        code = self.status_codes.get(status)
+        if code is None:
+            code = self.status_codes[status] = len(self.statuses)
+            self.statuses.append(status)
+        return code
+
+    def _columns(self, rows):
+        """(ids, employees, days, codes) arrays for rows of (id, employee, date, status, version)."""
+        count = len(rows)
+        ids = numpy.fromiter((row[0] for row in rows), numpy.int64, count)
+        employees = numpy.fromiter((-1 if row[1] is None else row[1] for row in rows), numpy.int32, count)
+        days = _days([row[2] for row in rows])
+        codes = [self._code(row[3]) for row in rows]
+        if len(self.statuses) > numpy.iinfo(self.codes.dtype).max + 1:
+            self.codes = self.codes.astype(numpy.uint16)
+        codes = numpy.array(codes, self.codes.dtype)
+        if count:
+            self.watermark = max(self.watermark, max(row[4] or 0 for row in rows))
+        return ids, employees, days, codes
+
+    def load(self, chunk_size=LOAD_CHUNK_SIZE):
+        """Read the whole Attendance table; returns the number of rows loaded."""
+        with self._lock, database.route("reader"), database.get_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("BEGIN")
+            try:
+                cursor.execute("SELECT COUNT(*) FROM Attendance")
+                self._reset(max(cursor.fetchone()[0], INITIAL_CAPACITY))
+                self.version = self._read_version(cursor)
+                cursor.execute(
+                    "SELECT AttendanceID, EmployeeID, Date, Status, RowVersion FROM Attendance ORDER BY AttendanceID"
+                )
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    self._append(*self._columns(rows))
+            finally:
+                connection.rollback()
+            self.loaded = True
+            return self.size
+
+    def _read_version(self, cursor):
+        cursor.execute("SELECT Version FROM table_version WHERE TableName = 'Attendance'")
+        return cursor.fetchone()[0]
+
+    def _append(self, ids, employees, days, codes):
+        end = self.size + len(ids)
+        if end > len(self.ids):
+            capacity = max(end, len(self.ids) * 2)
+            for name in ("ids", "employees", "days", "codes"):
+                column = getattr(self, name)
+                grown = numpy.empty(capacity, column.dtype)
+                grown[:self.size] = column[:self.size]
+                setattr(self, name, grown)
+        self.ids[self.size:end] = ids
+        self.employees[self.size:end] = employees
+        self.days[self.size:end] = days
+        self.codes[self.size:end] = codes
+        self.size = end
+
+    def _positions(self, ids):
+        """Positions of ``ids`` in the columns, -1 for those not held."""
+        held = self.ids[:self.size]
+        positions = numpy.searchsorted(held, ids)
+        found = positions < self.size
+        found[found] = held[positions[found]] == ids[found]
+        return numpy.where(found, positions, -1)
+
+    def _apply_rows(self, rows):
+        ids, employees, days, codes = self._columns(rows)
+        positions = self._positions(ids)
+        held = positions >= 0
+        if held.any():
+            at = positions[held]
+            self.deleted -= int(numpy.count_nonzero(self.codes[at] == 0))
+            self.employees[at] = employees[held]
+            self.days[at] = days[held]
+            self.codes[at] = codes[held]
+        new = ~held
+        if new.any():
+            order = numpy.argsort(ids[new], kind="stable")
+            ids, employees, days, codes = (column[new][order] for column in (ids, employees, days, codes))
+            in_order = self.size == 0 or ids[0] > self.ids[self.size - 1]
+            self._append(ids, employees, days, codes)
+            if not in_order:
+                # An id below the newest one (rare: ids are handed out ascending)
+                order = numpy.argsort(self.ids[:self.size], kind="stable")
+                for name in ("ids", "employees", "days", "codes"):
+                    column = getattr(self, name)
+                    column[:self.size] = column[:self.size][order]
+
+    def _delete(self, ids):
+        positions = self._positions(numpy.asarray(ids, numpy.int64))
+        positions = positions[positions >= 0]
+        positions = positions[self.codes[positions] != 0]
+        self.codes[positions] = 0
+        self.deleted += len(positions)
+        if self.deleted > self.size * COMPACT_RATIO:
+            self._compact()
+
+    def _compact(self):
+        live = self.codes[:self.size] != 0
+        count = int(numpy.count_nonzero(live))
+        for name in ("ids", "employees", "days", "codes"):
+            column = getattr(self, name)
+            column[:count] = column[:self.size][live]
+        self.size, self.deleted = count, 0
+
+    def apply(self, table, keys):
+        """database.on_change listener: bring the store up to date after a write."""
+        if table != "Attendance" or not self.loaded:
+            return
+        try:
+            self.sync(keys)
+        except Exception:
+            # Never fail a write that has already committed; reload on next query
+            self.loaded = False
+
+    def sync(self, keys=None):
+        with self._lock, database.get_connection() as connection:
+            cursor = connection.cursor()
+            began = not connection.in_transaction
+            if began:
+                cursor.execute("BEGIN")
+            try:
+                version = self._read_version(cursor)
+                # Only the reported rows changed: re-read just those
+                if keys is not None and version - self.version <= len(keys):
+                    keys = [int(key) for key in keys]
+                    rows = []
+                    for start in range(0, len(keys), database.MAX_PAGE_SIZE):
+                        chunk = keys[start:start + database.MAX_PAGE_SIZE]
+                        cursor.execute(f"""
+                            SELECT AttendanceID, EmployeeID, Date, Status, RowVersion FROM Attendance
+                            WHERE AttendanceID IN ({', '.join('?' * len(chunk))})
+                        """, chunk)
+                        rows += cursor.fetchall()
+                    self._apply_rows(rows)
+                    self._delete(sorted(set(keys) - {row[0] for row in rows}))
+                elif version != self.version:
+                    cursor.execute(
+                        "SELECT AttendanceID, EmployeeID, Date, Status, RowVersion FROM Attendance WHERE RowVersion > ?",
+                        (self.watermark,),
+                    )
+                    rows = cursor.fetchall()
+                    self._apply_rows(rows)
+                    # The counter moves once per row written: if it moved
+                    # further than the rows re-read, some were deleted and
+                    # RowVersion cannot show which
+                    if version - self.version != len(rows):
+                        cursor.execute("SELECT AttendanceID FROM Attendance ORDER BY AttendanceID")
+                        present = numpy.fromiter((row[0] for row in cursor), numpy.int64)
+                        held = self.ids[:self.size][self.codes[:self.size] != 0]
+                        self._delete(held[~numpy.isin(held, present, assume_unique=True)])
+                self.version = version
+            finally:
+                if began:
+                    connection.rollback()
+
+    def current(self):
+        """Load or catch up when Attendance has moved past what the store holds."""
+        if not self.loaded:
+            self.load()
+        elif database.data_versions(("Attendance",))[0] > self.version:
+            self.sync()
+
+    def _department_lookup(self):
+        # EmployeeID -> DepartmentID (0: none), rebuilt when Employee_details moves
+        version = database.data_versions(("Employee_details",))[0]
+        if self._departments is None or self._departments_version != version:
+            with database.get_connection() as connection:
+                rows = connection.execute("SELECT EmployeeID, IFNULL(DepartmentID, 0) FROM Employee_details").fetchall()
+            lookup = numpy.zeros(max((row[0] for row in rows), default=0) + 1, numpy.int32)
+            for employee, department in rows:
+                lookup[employee] = department
+            self._departments, self._departments_version = lookup, version
+        return self._departments
+
+    def nbytes(self):
+        """Bytes held by the columns, allocated and in use."""
+        columns = (self.ids, self.employees, self.days, self.codes)
+        return {
+            "allocated": sum(column.nbytes for column in columns),
+            "used": sum(column.itemsize for column in columns) * self.size,
+            "rows": self.size - self.deleted,
+        }
+
+    def summary(self, by="employee", date_from=None, date_to=None, employee_id=None, department_id=None,
+                statuses=None, worked=database.WORKED_STATUSES):
+        """Days per status and the attendance rate of each group.
+
+        ``by`` is one of GROUPS. Rows without a date are left out; the rate
+        is the share of recorded days whose status is in ``worked``.
+        """
+        if by not in GROUPS:
+            raise ValueError(f"cannot group by {by!r}")
+        low = _day(date_from) if date_from else NO_DAY + 1
+        high = _day(date_to) if date_to else -NO_DAY - 1
+        if date_from and low == NO_DAY or date_to and high == NO_DAY:
+            raise ValueError("invalid date")
+        self.current()
+        with self._lock:
+            size = self.size
+            employees, days, codes = self.employees[:size], self.days[:size], self.codes[:size]
+            mask = (codes != 0) & (days >= low) & (days <= high)
+            if employee_id is not None:
+                mask &= employees == int(employee_id)
+            if statuses is not None:
+                wanted = [self.status_codes[status] for status in statuses if status in self.status_codes]
+                mask &= numpy.isin(codes, wanted)
+            if by == "department" or department_id is not None:
+                lookup = self._department_lookup()
+                known = (employees >= 0) & (employees < len(lookup))
+                departments = numpy.zeros(size, numpy.int32)
+                departments[known] = lookup[employees[known]]
+                if department_id is not None:
+                    mask &= departments == int(department_id)
+            if by == "employee":
+                keys = employees[mask].astype(numpy.int64)
+            elif by == "department":
+                keys = departments[mask].astype(numpy.int64)
+            elif by == "month":
+                # Months since 1970-01
+                keys = days[mask].astype("datetime64[D]").astype("datetime64[M]").astype(numpy.int64)
+            else:
+                keys = numpy.zeros(int(numpy.count_nonzero(mask)), numpy.int64)
+            selected = codes[mask].astype(numpy.int64)
+            statuses_held = list(self.statuses)
+        if not len(keys):
+            return []
+        offset = int(keys.min())
+        width = len(statuses_held)
+        counts = numpy.bincount((keys - offset) * width + selected, minlength=(int(keys.max()) - offset + 1) * width)
+        counts = counts.reshape(-1, width)
+        worked_codes = [code for code, status in enumerate(statuses_held) if status in worked]
+        totals = counts.sum(axis=1)
+        worked_totals = counts[:, worked_codes].sum(axis=1)
+        result = []
+        for group in numpy.flatnonzero(totals):
+            key = int(group) + offset
+            if by == "month":
+                key = f"{1970 + key // 12:04d}-{key % 12 + 1:02d}"
+            elif by == "all":
+                key = None
+            row = counts[group]
+            result.append({
+                "key": key, "days": int(totals[group]), "worked": int(worked_totals[group]),
+                "rate": round(float(worked_totals[group]) / float(totals[group]), 4),
+                "statuses": {statuses_held[code]: int(row[code]) for code in numpy.flatnonzero(row)},
+            })
+        return result
+
+# One store per tenant shard (None: the default database)
+_stores = {}
+
+def get_store():
+    """The store of this thread's shard, loaded on its first query."""
+    shard = database.current_shard()
+    store = _stores.get(shard)
+    if store is None:
+        store = _stores.setdefault(shard, AttendanceStore())
+    return store
+
+@database.on_change
+def _apply(table, keys):
+    store = _stores.get(database.current_shard())
+    if store is not None:
+        store.apply(table, keys)
@@ -0,0 +1,348 @@
+"""Online snapshots of the EMS database, and restoring them.
+
+A snapshot is taken with SQLite's online backup API, PAGES_PER_STEP pages
+at a time. The copy reads from one read transaction, so it is consistent
+across every table, and in WAL mode readers never block writers, so the
+app keeps serving (and writing) while it runs; ``pause`` seconds between
+steps leave the disk to the app on a busy server. The copy is gzipped to
+``<name>-<UTC time>.db.gz`` with a ``.json`` manifest next to it holding
+the row count and checksum of every table in database.TABLES.
+
+    python backup.py create --database ems.db --output backups
+    python backup.py verify backups/ems-20250301T020000Z.db.gz
+    python backup.py restore backups/ems-20250301T020000Z.db.gz --database ems.db
+    python backup.py schedule --every 3600 --keep 48
+
+``verify`` checks the file hash, PRAGMA integrity_check and every table's
+count and checksum against the manifest. ``restore`` verifies first and
+then copies the snapshot into the database with the backup API, so it is
+safe while other connections are open, but running app processes keep
+their in-process caches: restart them afterwards.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import signal
+import sqlite3
+import sys
+import tempfile
+import time
+
+import cache
+import database
+
+PAGES_PER_STEP = 1024
+CHUNK_SIZE = 5000
+COPY_BUFFER = 1024 * 1024
+SUFFIX = ".db.gz"
+
+def table_checksums(connection):
+    """Return {table: {"rows": count, "checksum": sha256}} for database.TABLES.
+
+    Rows are hashed in primary key order, so two databases holding the same
+    rows give the same checksum whatever their page layout.
+    """
+    cursor = connection.cursor()
+    tables = {}
+    for table in database.TABLES:
+        digest = hashlib.sha256()
+        rows = 0
+        cursor.execute(f"SELECT * FROM {table} ORDER BY {', '.join(database.KEYS[table])}")
+        while True:
+            chunk = cursor.fetchmany(CHUNK_SIZE)
+            if not chunk:
+                break
+            for row in chunk:
+                digest.update(repr(tuple(row)).encode())
+                digest.update(b"\n")
+            rows += len(chunk)
+        tables[table] = {"rows": rows, "checksum": digest.hexdigest()}
+    return tables
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(COPY_BUFFER), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _copy(source, target, pages, pause, progress):
+    def step(status, remaining, total):
+        if progress is not None:
+            progress(total - remaining, total)
+        if pause and remaining:
+            time.sleep(pause)
+
+    source.backup(target, pages=pages, progress=step)
+
+def manifest_path(snapshot):
+    return snapshot[:-len(SUFFIX)] + ".json" if snapshot.endswith(SUFFIX) else snapshot + ".json"
+
+def read_manifest(snapshot):
+    with open(manifest_path(snapshot), encoding="utf-8") as file:
+        return json.load(file)
+
+def create_snapshot(database_file, directory, pages=PAGES_PER_STEP, pause=0.0, level=6, progress=None):
+    """Copy ``database_file`` into a compressed snapshot and return its manifest."""
+    os.makedirs(directory, exist_ok=True)
+    started = time.perf_counter()
+    taken = time.gmtime()
+    stem = os.path.splitext(os.path.basename(database_file))[0]
+    path = os.path.join(directory, f"{stem}-{time.strftime('%Y%m%dT%H%M%SZ', taken)}{SUFFIX}")
+    handle, copy = tempfile.mkstemp(suffix=".db", dir=directory)
+    os.close(handle)
+    try:
+        source = sqlite3.connect(database_file, timeout=30)
+        target = sqlite3.connect(copy)
+        try:
+            # Every step reads from this one snapshot, so writes by other
+            # connections neither restart the copy nor leak into it
+            source.execute("BEGIN")
+            source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            _copy(source, target, pages, pause, progress)
+            source.rollback()
+            integrity = target.execute("PRAGMA integrity_check").fetchone()[0]
+            if integrity != "ok":
+                raise sqlite3.DatabaseError(f"snapshot failed integrity_check: {integrity}")
+            version = target.execute("SELECT MAX(Version) FROM schema_version").fetchone()[0]
+            tables = table_checksums(target)
+        finally:
+            source.close()
+            target.close()
+
+        with open(copy, "rb") as raw, gzip.open(path + ".tmp", "wb", compresslevel=level) as packed:
+            shutil.copyfileobj(raw, packed, COPY_BUFFER)
+        os.replace(path + ".tmp", path)
+        manifest = {
+            "database": os.path.abspath(database_file),
+            "taken_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", taken),
+            "schema_version": version,
+            "bytes": os.path.getsize(copy),
+            "compressed_bytes": os.path.getsize(path),
+            "sha256": _file_sha256(path),
+            "seconds": round(time.perf_counter() - started, 3),
+            "tables": tables,
+        }
+        # The manifest is written last; a snapshot without one is incomplete
+        with open(manifest_path(path), "w", encoding="utf-8") as file:
+            json.dump(manifest, file, indent=2)
+    finally:
+        for leftover in (copy, path + ".tmp"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    manifest["path"] = path
+    return manifest
+
+def _compare(expected, actual):
+    problems = []
+    for table in database.TABLES:
+        want, got = expected.get(table), actual.get(table)
+        if want is None:
+            problems.append(f"{table}: missing from the manifest")
+        elif got["rows"] != want["rows"]:
+            problems.append(f"{table}: {got['rows']} rows, manifest has {want['rows']}")
+        elif got["checksum"] != want["checksum"]:
+            problems.append(f"{table}: checksum does not match the manifest")
+    return problems
+
+def _unpack(snapshot, directory):
+    handle, copy = tempfile.mkstemp(suffix=".db", dir=directory)
+    with os.fdopen(handle, "wb") as raw, gzip.open(snapshot, "rb") as packed:
+        shutil.copyfileobj(packed, raw, COPY_BUFFER)
+    return copy
+
+def _check(copy, manifest):
+    problems = []
+    connection = sqlite3.connect(copy)
+    try:
+        integrity = connection.execute("PRAGMA integrity_check").fetchone()[0]
+        if integrity != "ok":
+            problems.append(f"integrity_check: {integrity}")
+        else:
+            problems += _compare(manifest["tables"], table_checksums(connection))
+    finally:
+        connection.close()
+    return problems
+
+def verify_snapshot(snapshot):
+    """Return a list of problems with ``snapshot``; empty when it is sound."""
+    manifest = read_manifest(snapshot)
+    if _file_sha256(snapshot) != manifest["sha256"]:
+        return ["file hash does not match the manifest"]
+    copy = _unpack(snapshot, os.path.dirname(os.path.abspath(snapshot)))
+    try:
+        return _check(copy, manifest)
+    finally:
+        os.remove(copy)
+
+def restore_snapshot(database_file, snapshot, pages=PAGES_PER_STEP, pause=0.0, progress=None):
+    """Verify ``snapshot`` and copy it over ``database_file``; return the manifest.
+
+    Raises ValueError, leaving the database untouched, if verification fails.
+    """
+    manifest = read_manifest(snapshot)
+    if _file_sha256(snapshot) != manifest["sha256"]:
+        raise ValueError(f"{snapshot} failed verification: file hash does not match the manifest")
+    copy = _unpack(snapshot, os.path.dirname(os.path.abspath(database_file)))
+    try:
+        problems = _check(copy, manifest)
+        if problems:
+            raise ValueError(f"{snapshot} failed verification: " + "; ".join(problems))
+        source = sqlite3.connect(copy)
+        target = sqlite3.connect(database_file, timeout=30)
+        try:
+            versions = _table_versions(target)
+            row_version = _row_version(target)
+            sequence = _change_sequence(target)
+            _copy(source, target, pages, pause, progress)
+            # Change counters go forward past both the live and the restored
+            # values, so no ETag handed out before the restore is reused
+            target.executemany(
+                "UPDATE table_version SET Version = MAX(Version, ?) + 1, ModifiedAt = CAST(strftime('%s', 'now') AS INTEGER) WHERE TableName = ?",
+                [(version, table) for table, version in versions.items()],
+            )
+            _advance_row_version(target, row_version)
+            _reset_change_feed(target, sequence)
+            target.commit()
+            problems = _compare(manifest["tables"], table_checksums(target))
+        finally:
+            source.close()
+            target.close()
+        if problems:
+            raise ValueError(f"restored database does not match {snapshot}: " + "; ".join(problems))
+    finally:
+        os.remove(copy)
+    cache.clear()
+    return manifest
+
+def _table_versions(connection):
+    try:
+        return dict(connection.execute("SELECT TableName, Version FROM table_version").fetchall())
+    except sqlite3.OperationalError:
+        return {}
+
+def _row_version(connection):
+    try:
+        row = connection.execute("SELECT Value FROM row_version").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return row[0] if row else 0
+
+def _advance_row_version(connection, value):
+    # Row versions are export watermarks (export.py, the in-memory indexes);
+    # a rewound counter would hand out values they have already passed
+    try:
+        connection.execute("UPDATE row_version SET Value = MAX(Value, ?) + 1", (value,))
+    except sqlite3.OperationalError:
+        pass
+
+def _change_sequence(connection):
+    try:
+        row = connection.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return row[0] if row else 0
+
+def _reset_change_feed(connection, sequence):
+    # The change log went back in time with the data: move its sequence past
+    # every Seq handed out and raise the floor to it, so consumers of the
+    # feed (changes.py) are told to start again from a full export
+    try:
+        sequence = max(sequence, _change_sequence(connection)) + 1
+        connection.execute("DELETE FROM sqlite_sequence WHERE name = 'change_log'")
+        connection.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('change_log', ?)", (sequence,))
+        connection.execute("DELETE FROM change_log")
+        connection.execute("UPDATE change_log_state SET FloorSeq = ?, CompactedSeq = ?", (sequence, sequence))
+    except sqlite3.OperationalError:
+        pass
+
+def list_snapshots(directory):
+    """Return complete snapshots in ``directory``, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.endswith(SUFFIX) and os.path.exists(manifest_path(os.path.join(directory, name)))
+    )
+
+def prune(directory, keep):
+    """Delete all but the newest ``keep`` snapshots; return the deleted paths."""
+    snapshots = list_snapshots(directory)
+    removed = snapshots[:-keep] if keep > 0 else []
+    for path in removed:
+        os.remove(manifest_path(path))
+        os.remove(path)
+    return removed
+
+def run_schedule(database_file, directory, every, keep, pages=PAGES_PER_STEP, pause=0.0, runs=None):
+    """Take a snapshot every ``every`` seconds, keeping the newest ``keep``."""
+    taken = 0
+    while runs is None or taken < runs:
+        started = time.monotonic()
+        try:
+            manifest = create_snapshot(database_file, directory, pages, pause)
+            print(f"{manifest['path']}: {manifest['compressed_bytes']} bytes in {manifest['seconds']:.2f}s", flush=True)
+            for path in prune(directory, keep):
+                print(f"removed {path}", flush=True)
+        except (OSError, sqlite3.Error) as error:
+            print(f"❌ snapshot failed: {error}", file=sys.stderr, flush=True)
+        taken += 1
+        if runs is None or taken < runs:
+            time.sleep(max(every - (time.monotonic() - started), 0))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Take, verify and restore snapshots of the EMS database.")
+    parser.add_argument("command", choices=["create", "verify", "restore", "list", "schedule"])
+    parser.add_argument("snapshot", nargs="?", help="snapshot file, for verify and restore")
+    parser.add_argument("--database", default="ems.db")
+    parser.add_argument("--output", default="backups", help="snapshot directory")
+    parser.add_argument("--pages", type=int, default=PAGES_PER_STEP, help="pages copied per step")
+    parser.add_argument("--pause-ms", type=float, default=0, help="sleep between steps")
+    parser.add_argument("--level", type=int, default=6, help="gzip level")
+    parser.add_argument("--every", type=float, default=3600, help="seconds between scheduled snapshots")
+    parser.add_argument("--keep", type=int, default=24, help="snapshots kept by schedule")
+    args = parser.parse_args(argv)
+    pause = args.pause_ms / 1000
+
+    if args.command in ("verify", "restore") and not args.snapshot:
+        parser.error(f"{args.command} needs a snapshot file")
+    if args.command in ("create", "schedule"):
+        # Bring the schema up to date first so the manifest covers every table
+        database.initialize(args.database, pool_size=1, backfill=False)
+        database.close()
+
+    if args.command == "create":
+        manifest = create_snapshot(args.database, args.output, args.pages, pause, args.level)
+        print(f"✅ {manifest['path']}: {manifest['bytes']} -> {manifest['compressed_bytes']} bytes in {manifest['seconds']:.2f}s")
+        for table, state in manifest["tables"].items():
+            print(f"  {table:<18}{state['rows']:>10} rows  {state['checksum'][:16]}")
+    elif args.command == "verify":
+        problems = verify_snapshot(args.snapshot)
+        for problem in problems:
+            print(f"❌ {problem}")
+        if problems:
+            return 1
+        print(f"✅ {args.snapshot} verified")
+    elif args.command == "restore":
+        try:
+            manifest = restore_snapshot(args.database, args.snapshot, args.pages, pause)
+        except ValueError as error:
+            print(f"❌ {error}")
+            return 1
+        print(f"✅ {args.database} restored to {manifest['taken_at']}; restart the app to drop its caches")
+    elif args.command == "list":
+        for path in list_snapshots(args.output):
+            manifest = read_manifest(path)
+            rows = sum(state["rows"] for state in manifest["tables"].values())
+            print(f"{path}  {manifest['taken_at']}  {manifest['compressed_bytes']:>12} bytes  {rows} rows")
+    else:
+        # Let a stop signal unwind through the cleanup of a snapshot in progress
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        run_schedule(args.database, args.output, args.every, args.keep, args.pages, pause)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,878 @@
+"""Synthetic data generator and benchmark suite.
+
+``seed`` fills a database with a deterministic synthetic organisation:
+departments, positions, employees, and for every workday and month in the
+last ``--years`` years their attendance, leave, projects and payroll.
+
+``run`` times every public database.py function (the ``db`` suite) and
+every main.py route through the Flask test client (the ``http`` suite).
+It prints throughput and latency percentiles for each benchmark. Write
+benchmarks create their own rows and delete them again, so the seeded
+data is left as it was. With ``--baseline`` a benchmark whose p50 or p95
+is more than ``--tolerance`` slower than the stored baseline is reported
+as a regression and the exit status is 1.
+
+    python benchmark.py seed --database ems.db --scale 10k --years 2 --reset
+    python benchmark.py run --database ems.db --save-baseline benchmark_baseline.json
+    python benchmark.py run --database ems.db --baseline benchmark_baseline.json
+
+``asgi`` times a few GET routes three ways: one request at a time through
+the WSGI app, ``--concurrency`` threads through the WSGI app, and
+``--concurrency`` requests in flight through asgi.application.
+
+    python benchmark.py asgi --database ems.db --concurrency 16
+
+``columnar`` compares attendance rates computed in Python over the row
+dicts of database.get_attendances() with attendance_store summaries: the
+memory each holds, the time to load it, and the time per group-by.
+
+    python benchmark.py columnar --database ems.db
+"""
+import argparse
+import asyncio
+import calendar
+import csv
+import io
+import itertools
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from urllib.parse import parse_qs, urlsplit
+
+import attendance_store
+import check_query_plans
+import conversions
+import database
+import jobs
+import metrics
+import reports
+
+SCALES = {"1k": 1000, "10k": 10000, "100k": 100000}
+END_DATE = date(2025, 6, 30)
+SEED_CHUNK_SIZE = 10000
+ITERATIONS = 200
+TOLERANCE = 0.25
+# Differences below this are timer noise, not regressions
+NOISE_FLOOR_MS = 0.2
+# Rows per create_attendances call, and concurrent clients in the check-in burst
+CHECK_IN_BATCH = 50
+CHECK_IN_CLIENTS = 32
+
+FIRST_NAMES = (
+    "Aarav", "Aisha", "Ben", "Chen", "Diego", "Elena", "Fatima", "George", "Hana", "Ivan",
+    "Jia", "Kofi", "Lena", "Mateo", "Nia", "Omar", "Priya", "Quinn", "Rosa", "Sven",
+)
+LAST_NAMES = (
+    "Anand", "Brown", "Costa", "Dubois", "Evans", "Fischer", "Garcia", "Haddad", "Ito", "Jones",
+    "Kumar", "Larsen", "Mensah", "Novak", "Okafor", "Patel", "Rossi", "Smith", "Tanaka", "Walker",
+)
+DEPARTMENTS = ("Engineering", "Sales", "Finance", "HR", "Operations", "Marketing", "Support", "Legal")
+POSITIONS = ("Developer", "Analyst", "Manager", "Associate", "Lead")
+ATTENDANCE_STATUSES = (("Present", 90), ("Absent", 4), ("Half Day", 3), ("Late", 3))
+LEAVE_STATUSES = (("Approved", 70), ("Pending", 20), ("Rejected", 10))
+PROJECT_STATUSES = ("Open", "In Progress", "Done")
+
+def _weighted(rng, choices):
+    values, weights = zip(*choices)
+    cumulative = list(itertools.accumulate(weights))
+    return lambda: rng.choices(values, cum_weights=cumulative)[0]
+
+def _months(start, end):
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        yield year, month
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+def _insert(sql, rows, chunk_size=SEED_CHUNK_SIZE):
+    rows = iter(rows)
+    count = 0
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return count
+        with database.transaction() as connection:
+            connection.cursor().executemany(sql, chunk)
+        count += len(chunk)
+
+def seed(employees, years=1, end=END_DATE, random_seed=0):
+    """Populate the (empty) current database and return row counts per table."""
+    rng = random.Random(random_seed)
+    start = end - timedelta(days=round(365.25 * years) - 1)
+    department_count = max(len(DEPARTMENTS), employees // 250)
+    team_count = max(10, employees // 20)
+    counts = {}
+    department_name = lambda i: f"{DEPARTMENTS[(i - 1) % len(DEPARTMENTS)]} {(i - 1) // len(DEPARTMENTS) + 1}"
+
+    counts["Department"] = _insert(
+        "INSERT INTO Department (DepartmentID, DeptName, Location) VALUES (?, ?, ?)",
+        ((i, department_name(i), f"Floor {i % 10 + 1}") for i in range(1, department_count + 1)),
+    )
+    # Position names stay unique so the legacy name column is unambiguous
+    position_name = lambda department, name: f"{name}, {department_name(department)}"
+    position_id = lambda department, index: (department - 1) * len(POSITIONS) + index + 1
+    counts["Position"] = _insert(
+        "INSERT INTO Position (PositionID, PositionName, DepartmentID) VALUES (?, ?, ?)",
+        ((position_id(department, index), position_name(department, name), department)
+         for department in range(1, department_count + 1) for index, name in enumerate(POSITIONS)),
+    )
+
+    salaries = {}
+    def employee_rows():
+        for i in range(1, employees + 1):
+            first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            hired = start - timedelta(days=rng.randrange(0, 3650))
+            born = hired - timedelta(days=rng.randrange(21 * 365, 45 * 365))
+            salary = rng.randrange(2000, 12000, 50)
+            salaries[i] = salary * 100
+            department = rng.randrange(1, department_count + 1)
+            position = rng.randrange(len(POSITIONS))
+            years = (end - hired).days // 365
+            yield (
+                i, f"{first} {last}", hired.isoformat(), f"{years} years",
+                position_name(department, POSITIONS[position]), rng.choice(("Female", "Male")), department,
+                f"{first.lower()}.{last.lower()}{i}@example.com", f"555{i:07d}",
+                "Active" if rng.random() < 0.95 else "Inactive", born.isoformat(), str(salary),
+                rng.randrange(1, team_count + 1), position_id(department, position), salary * 100, years * 12,
+            )
+    counts["Employee_details"] = _insert("""
+        INSERT INTO Employee_details (
+            EmployeeID, EmployeeName, HireDate, Experience, Position, Gender, DepartmentID,
+            Email, Phone, Status, DOB, Salary, TeamID, PositionID, SalaryCents, ExperienceMonths
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, employee_rows())
+
+    attendance_status = _weighted(rng, ATTENDANCE_STATUSES)
+    def attendance_rows():
+        day = start
+        while day <= end:
+            if day.weekday() < 5:
+                iso = day.isoformat()
+                for employee in range(1, employees + 1):
+                    yield employee, iso, attendance_status()
+            day += timedelta(days=1)
+    counts["Attendance"] = _insert(
+        "INSERT INTO Attendance (EmployeeID, Date, Status) VALUES (?, ?, ?)", attendance_rows()
+    )
+
+    leave_status = _weighted(rng, LEAVE_STATUSES)
+    span = (end - start).days
+    def leave_rows():
+        for employee in range(1, employees + 1):
+            for _ in range(round(4 * years)):
+                first = start + timedelta(days=rng.randrange(span))
+                last = min(first + timedelta(days=rng.randrange(5)), end)
+                yield employee, first.isoformat(), last.isoformat(), "Synthetic leave", leave_status()
+    counts["Leave"] = _insert(
+        "INSERT INTO Leave (EmployeeID, StartDate, EndDate, Reason, Status) VALUES (?, ?, ?, ?, ?)",
+        leave_rows(),
+    )
+
+    counts["Project"] = _insert(
+        "INSERT INTO Project (EmployeeID, TeamID, ProjectID, Task, Status, Sprint) VALUES (?, ?, ?, ?, ?, ?)",
+        ((i, rng.randrange(1, team_count + 1), f"P-{i}", f"Task {i}", rng.choice(PROJECT_STATUSES), rng.randrange(1, 27))
+         for i in range(1, employees + 1)),
+    )
+
+    def payroll_rows():
+        for year, month in _months(start, end):
+            label = date(year, month, 1).strftime("%B-%Y")
+            for employee in range(1, employees + 1):
+                basic = salaries[employee]
+                deductions = round(basic / calendar.monthrange(year, month)[1] * rng.choice((0, 0, 0, 0.5, 1)))
+                yield (
+                    employee, label, basic / 100, deductions / 100, (basic - deductions) / 100,
+                    year * 100 + month, basic, deductions, basic - deductions,
+                )
+    counts["Payroll"] = _insert("""
+        INSERT INTO Payroll (
+            EmployeeID, Month, BasicPay, Deductions, Netpay, MonthKey, BasicPayCents, DeductionsCents, NetpayCents
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, payroll_rows())
+
+    with database.get_connection("primary") as connection:
+        connection.execute("ANALYZE")
+    return counts
+
+def table_counts():
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        counts = {}
+        for table in database.TABLES:
+            cursor.execute(f"SELECT COUNT(*) FROM {table}")
+            counts[table] = cursor.fetchone()[0]
+        return counts
+
+# Measurement
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))]
+
+def measure(call, iterations, workers=1):
+    """Call ``call()`` ``iterations`` times across ``workers`` threads and summarise latencies."""
+    errors = []
+
+    def work(count):
+        latencies = []
+        for _ in range(count):
+            started = time.perf_counter()
+            try:
+                call()
+            except Exception as error:
+                errors.append(repr(error))
+            latencies.append(time.perf_counter() - started)
+        return latencies
+
+    started = time.perf_counter()
+    if workers <= 1:
+        latencies = work(iterations)
+    else:
+        shares = [iterations // workers + (1 if i < iterations % workers else 0) for i in range(workers)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            latencies = [value for part in executor.map(work, shares) for value in part]
+    return summarise(latencies, errors, time.perf_counter() - started)
+
+def summarise(latencies, errors, wall):
+    iterations = len(latencies)
+    latencies.sort()
+    return {
+        "iterations": iterations,
+        "ops_per_sec": round(iterations / wall, 1) if wall else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+    }
+
+# Fixtures drawn from the seeded data
+def load_sample(rng, size=200):
+    queries = {
+        "employees": "SELECT EmployeeID FROM Employee_details",
+        "departments": "SELECT DepartmentID FROM Department",
+        "positions": "SELECT PositionID FROM Position",
+        "attendance": "SELECT AttendanceID FROM Attendance",
+        "leave": "SELECT LeaveID FROM Leave",
+        "payroll": "SELECT PayrollID FROM Payroll",
+        "projects": "SELECT EmployeeID, TeamID FROM Project",
+    }
+    sample = {}
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        for name, sql in queries.items():
+            cursor.execute(f"SELECT * FROM ({sql}) ORDER BY random() LIMIT ?", (size,))
+            sample[name] = [tuple(row) if len(row) > 1 else row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT MIN(Date), MAX(Date) FROM Attendance")
+        first, last = cursor.fetchone()
+        cursor.execute("SELECT Month FROM Payroll ORDER BY PayrollID DESC LIMIT 1")
+        row = cursor.fetchone()
+        cursor.execute("SELECT FloorSeq FROM change_log_state")
+        change_floor = cursor.fetchone()[0]
+    missing = [name for name, ids in sample.items() if not ids]
+    if missing or first is None or row is None:
+        raise SystemExit(f"database has no rows to benchmark ({', '.join(missing) or 'Attendance/Payroll'}); run seed first")
+    last = date.fromisoformat(last)
+    sample["month"] = row[0]
+    sample["change_floor"] = change_floor
+    sample["date_from"] = (last - timedelta(days=30)).isoformat()
+    sample["date_to"] = last.isoformat()
+    sample["summary_month"] = last.strftime("%Y-%m")
+    following = (last.replace(day=28) + timedelta(days=4)).replace(day=1)
+    sample["run_month"] = following.strftime("%B-%Y")
+    return sample
+
+_sequence = itertools.count(1)
+
+def _new_rows(rng, sample):
+    """Row factories for each entity's create/update benchmarks."""
+    employee = lambda: rng.choice(sample["employees"])
+    n = lambda: next(_sequence)
+
+    def leave():
+        # A day of its own after the seeded data, so no two benchmark leaves overlap
+        day = (date.fromisoformat(sample["date_to"]) + timedelta(days=n())).isoformat()
+        return {"EmployeeID": employee(), "StartDate": day, "EndDate": day, "Reason": "Benchmark", "Status": "Pending"}
+
+    return {
+        "department": lambda: {"DeptName": f"Bench {n()}", "Location": "Floor 0"},
+        "position": lambda: {"PositionName": f"Bench {n()}", "DepartmentID": rng.choice(sample["departments"])},
+        "employee": lambda: {
+            "EmployeeName": f"Bench Employee {n()}", "HireDate": "2024-01-01", "Experience": "1 years",
+            "PositionID": rng.choice(sample["positions"]), "Gender": "Female", "DepartmentID": rng.choice(sample["departments"]),
+            "Email": "bench@example.com", "Phone": "0", "Status": "Inactive", "DOB": "1990-01-01",
+            "Salary": "3000", "TeamID": 1,
+        },
+        "attendance": lambda: {"EmployeeID": employee(), "Date": sample["date_to"], "Status": "Present"},
+        "leave": leave,
+        "project": lambda: {
+            "EmployeeID": employee(), "TeamID": 1000000 + n(), "ProjectID": f"BENCH-{n()}",
+            "Task": "Benchmark", "Status": "Open", "Sprint": 1,
+        },
+        "payroll": lambda: {
+            "EmployeeID": employee(), "Month": sample["month"], "BasicPay": 3000, "Deductions": 0, "Netpay": 3000,
+        },
+    }
+
+# entity -> (table, primary key column)
+WRITE_ENTITIES = {
+    "department": ("Department", "DepartmentID"),
+    "position": ("Position", "PositionID"),
+    "employee": ("Employee_details", "EmployeeID"),
+    "attendance": ("Attendance", "AttendanceID"),
+    "leave": ("Leave", "LeaveID"),
+    "project": ("Project", "ProjectID"),
+    "payroll": ("Payroll", "PayrollID"),
+}
+
+def _max_rowid(table):
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(f"SELECT MAX(rowid) FROM {table}")
+        return cursor.fetchone()[0] or 0
+
+def _created_keys(entity, since):
+    table, key = WRITE_ENTITIES[entity]
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        if entity == "project":
+            cursor.execute("SELECT EmployeeID, TeamID FROM Project WHERE rowid > ? AND ProjectID LIKE 'BENCH-%'", (since,))
+            return [tuple(row) for row in cursor.fetchall()]
+        cursor.execute(f"SELECT {key} FROM {table} WHERE rowid > ?", (since,))
+        return [row[0] for row in cursor.fetchall()]
+
+def _run_write_cycle(results, entity, create, update, delete, iterations, workers, make_row):
+    """Benchmark create, then update and delete of the rows just created."""
+    table, _ = WRITE_ENTITIES[entity]
+    since = _max_rowid(table)
+    results[create[0]] = measure(lambda: create[1](make_row()), iterations, workers)
+    keys = _created_keys(entity, since)
+    lock = threading.Lock()
+
+    def take():
+        with lock:
+            return next(pending)
+
+    pending = iter(keys)
+    results[update[0]] = measure(lambda: update[1](take(), make_row()), len(keys), workers)
+    pending = iter(keys)
+    results[delete[0]] = measure(lambda: delete[1](take()), len(keys), workers)
+
+# db suite
+def db_benchmarks(sample, rng):
+    pick = lambda name: rng.choice(sample[name])
+    return [
+        ("get_employees", lambda: database.get_employees()),
+        ("get_employee", lambda: database.get_employee(pick("employees"))),
+        ("get_employee_page", lambda: database.get_employee_page()),
+        ("get_employee_page?department_id", lambda: database.get_employee_page(department_id=pick("departments"))),
+        ("get_employee_page?sort=name", lambda: database.get_employee_page(sort="name")),
+        ("search_employees", lambda: database.search_employees(rng.choice(FIRST_NAMES)[:3])),
+        ("search_employees?fuzzy", lambda: database.search_employees(rng.choice(LAST_NAMES)[::-1][:4])),
+        ("get_departments", lambda: database.get_departments()),
+        ("get_department", lambda: database.get_department(pick("departments"))),
+        ("get_department_page", lambda: database.get_department_page()),
+        ("get_positions", lambda: database.get_positions()),
+        ("get_position", lambda: database.get_position(pick("positions"))),
+        ("get_position_page", lambda: database.get_position_page(department_id=pick("departments"))),
+        ("get_attendance", lambda: database.get_attendance(pick("attendance"))),
+        ("get_attendance_page", lambda: database.get_attendance_page()),
+        ("get_attendance_page?employee_id", lambda: database.get_attendance_page(
+            employee_id=pick("employees"), date_from=sample["date_from"], date_to=sample["date_to"])),
+        ("get_leave", lambda: database.get_leave(pick("leave"))),
+        ("get_leave_page", lambda: database.get_leave_page()),
+        ("get_leave_page?employee_id", lambda: database.get_leave_page(employee_id=pick("employees"))),
+        ("get_project", lambda: database.get_project(*pick("projects"))),
+        ("get_project_page", lambda: database.get_project_page()),
+        ("get_project_page?employee_id", lambda: database.get_project_page(employee_id=pick("employees"))),
+        ("get_payroll", lambda: database.get_payroll(pick("payroll"))),
+        ("get_payroll_page", lambda: database.get_payroll_page()),
+        ("get_payroll_page?month", lambda: database.get_payroll_page(month=sample["month"], sort="netpay")),
+        ("get_payroll_page?month_from", lambda: database.get_payroll_page(month_from=sample["month"], sort="month")),
+        ("get_by_ids", lambda: database.get_by_ids("Employee_details", rng.sample(sample["employees"], 20))),
+        ("get_by_ids?Project", lambda: database.get_by_ids("Project", rng.sample(sample["projects"], 20))),
+        ("get_table_versions", lambda: database.get_table_versions(("Attendance", "Employee_details"))),
+        ("reports.get_department_month", lambda: reports.get_department_month(sample["summary_month"])),
+        ("reports.get_daily_totals", lambda: reports.get_daily_totals(sample["summary_month"])),
+    ]
+
+# Whole-table reads: timed with few iterations since they grow with the data
+DB_FULL_READS = ("get_attendances", "get_leaves", "get_projects", "get_payrolls")
+
+def run_db_suite(sample, rng, iterations, workers, only=None):
+    results = {}
+    for name, call in db_benchmarks(sample, rng):
+        if not only or only in name:
+            results[name] = measure(call, iterations, workers)
+    for name in DB_FULL_READS:
+        if not only or only in name:
+            results[name] = measure(getattr(database, name), max(1, iterations // 50), 1)
+
+    rows = _new_rows(rng, sample)
+    for entity in WRITE_ENTITIES:
+        if only and only not in entity:
+            continue
+        keyed = entity == "project"
+        update = getattr(database, f"update_{entity}")
+        delete = getattr(database, f"delete_{entity}")
+        _run_write_cycle(
+            results, entity,
+            (f"create_{entity}", getattr(database, f"create_{entity}")),
+            (f"update_{entity}", (lambda key, row: update(*key, row)) if keyed else update),
+            (f"delete_{entity}", (lambda key: delete(*key)) if keyed else delete),
+            iterations, workers, rows[entity],
+        )
+
+    # One group commit's worth of check-ins per call; the rows are removed again
+    if not only or only in "create_attendances":
+        since = _max_rowid("Attendance")
+        batch = lambda: [rows["attendance"]() for _ in range(CHECK_IN_BATCH)]
+        results["create_attendances"] = measure(lambda: database.create_attendances(batch()), max(1, iterations // 10), workers)
+        with database.transaction() as connection:
+            connection.execute("DELETE FROM Attendance WHERE rowid > ?", (since,))
+    return results
+
+def db_coverage(results):
+    covered = {name.split("?")[0] for name in results}
+    return sorted(check_query_plans.public_functions() - covered)
+
+# http suite
+_clients = threading.local()
+
+def _client(app):
+    client = getattr(_clients, "client", None)
+    if client is None or client.application is not app:
+        client = _clients.client = app.test_client()
+    return client
+
+def _csv(rows):
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=list(rows[0]))
+    writer.writeheader()
+    writer.writerows(rows)
+    return output.getvalue().encode()
+
+def _rows(table, key, ids):
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        marks = ",".join("?" * len(ids))
+        cursor.execute(f"SELECT * FROM {table} WHERE {key} IN ({marks})", list(ids))
+        return [{name: value for name, value in dict(row).items() if name != "RowVersion"} for row in cursor.fetchall()]
+
+def http_benchmarks(sample, rng):
+    """(name, endpoint, method, path factory, form factory) for every read-only or idempotent request."""
+    pick = lambda name: rng.choice(sample[name])
+    month = sample["summary_month"]
+    imports = {
+        "employee": _csv(_rows("Employee_details", "EmployeeID", sample["employees"][:20])),
+        "attendance": _csv(_rows("Attendance", "AttendanceID", sample["attendance"][:50])),
+        "payroll": _csv(_rows("Payroll", "PayrollID", sample["payroll"][:50])),
+    }
+    upload = lambda entity: lambda: {"file": (io.BytesIO(imports[entity]), f"{entity}.csv")}
+    return [
+        ("GET /", "get_employee_list", "GET", lambda: "/", None),
+        ("GET /employees?department_id", "get_employee_list", "GET", lambda: f"/employees?department_id={pick('departments')}", None),
+        ("GET /employees/search", "get_employee_search", "GET", lambda: f"/employees/search?q={rng.choice(FIRST_NAMES)[:3]}", None),
+        ("GET /employee/create", "get_employee_create", "GET", lambda: "/employee/create", None),
+        ("GET /employee/update", "get_employee_update", "GET", lambda: f"/employee/update/{pick('employees')}", None),
+        ("GET /departments", "get_department_list", "GET", lambda: "/departments", None),
+        ("GET /department/create", "get_department_create", "GET", lambda: "/department/create", None),
+        ("GET /department/update", "get_department_update", "GET", lambda: f"/department/update/{pick('departments')}", None),
+        ("GET /positions", "get_position_list", "GET", lambda: "/positions", None),
+        ("GET /position/create", "get_position_create", "GET", lambda: "/position/create", None),
+        ("GET /position/update", "get_position_update", "GET", lambda: f"/position/update/{pick('positions')}", None),
+        ("GET /attendances", "get_attendance_list", "GET", lambda: "/attendances", None),
+        ("GET /attendances?employee_id", "get_attendance_list", "GET", lambda: f"/attendances?employee_id={pick('employees')}", None),
+        ("GET /attendances?employee_id&all", "get_attendance_list", "GET", lambda: f"/attendances?employee_id={pick('employees')}&all=1", None),
+        ("GET /attendance/create", "get_attendance_create", "GET", lambda: "/attendance/create", None),
+        ("GET /attendance/update", "get_attendance_update", "GET", lambda: f"/attendance/update/{pick('attendance')}", None),
+        ("GET /leaves", "get_leave_list", "GET", lambda: "/leaves", None),
+        ("GET /leaves/out", "get_leave_out", "GET", lambda: f"/leaves/out?date_from={sample['date_from']}&date_to={sample['date_to']}", None),
+        ("GET /leaves/balances", "get_leave_balances", "GET", lambda: f"/leaves/balances?year={sample['date_to'][:4]}", None),
+        ("GET /leave/create", "get_leave_create", "GET", lambda: "/leave/create", None),
+        ("GET /leave/update", "get_leave_update", "GET", lambda: f"/leave/update/{pick('leave')}", None),
+        ("GET /projects", "get_project_list", "GET", lambda: "/projects", None),
+        ("GET /project/create", "get_project_create", "GET", lambda: "/project/create", None),
+        ("GET /project/update", "get_project_update", "GET", lambda: "/project/update/{}/{}".format(*pick("projects")), None),
+        ("GET /payrolls", "get_payroll_list", "GET", lambda: "/payrolls", None),
+        ("GET /payrolls?month", "get_payroll_list", "GET", lambda: f"/payrolls?month={sample['month']}", None),
+        ("GET /payroll/create", "get_payroll_create", "GET", lambda: "/payroll/create", None),
+        ("GET /payroll/update", "get_payroll_update", "GET", lambda: f"/payroll/update/{pick('payroll')}", None),
+        ("GET /reports", "get_reports", "GET", lambda: f"/reports?month={month}", None),
+        ("GET /org", "get_org", "GET", lambda: "/org", None),
+        ("GET /cache/stats", "get_cache_stats", "GET", lambda: "/cache/stats", None),
+        ("GET /metrics", "get_metrics", "GET", lambda: "/metrics", None),
+        ("GET /metrics/slow-queries", "get_slow_queries", "GET", lambda: "/metrics/slow-queries", None),
+        ("GET /api/v1", "api.get_index", "GET", lambda: "/api/v1", None),
+        ("GET /api/v1/employees", "api.get_list", "GET", lambda: "/api/v1/employees", None),
+        ("GET /api/v1/attendance?employee_id&fields", "api.get_list", "GET",
+         lambda: f"/api/v1/attendance?employee_id={pick('employees')}&fields=Date,Status", None),
+        ("GET /api/v1/employees?ids", "api.get_list", "GET",
+         lambda: "/api/v1/employees?ids=" + ",".join(map(str, rng.sample(sample["employees"], 50))), None),
+        ("GET /api/v1/payrolls/<id>", "api.get_item", "GET", lambda: f"/api/v1/payrolls/{pick('payroll')}", None),
+        ("GET /api/v1/org", "api.get_org", "GET", lambda: "/api/v1/org", None),
+        ("GET /api/v1/org/teams", "api.get_org_teams", "GET", lambda: "/api/v1/org/teams?limit=50", None),
+        ("GET /api/v1/leaves/out", "api.get_leave_out", "GET", lambda: f"/api/v1/leaves/out?date_from={sample['date_to']}", None),
+        ("GET /api/v1/leaves/balances", "api.get_leave_balances", "GET",
+         lambda: f"/api/v1/leaves/balances?year={sample['date_to'][:4]}&employee_id={pick('employees')}", None),
+        ("GET /api/v1/attendance/rates", "api.get_attendance_rates", "GET",
+         lambda: f"/api/v1/attendance/rates?by=department&date_from={sample['date_from']}", None),
+        ("GET /api/v1/changes", "api.get_changes", "GET", lambda: f"/api/v1/changes?since={sample['change_floor']}&limit=100", None),
+        ("GET /jobs", "get_jobs", "GET", lambda: "/jobs", None),
+        ("GET /api/v1/jobs", "api.get_jobs", "GET", lambda: "/api/v1/jobs?limit=50", None),
+        ("GET /api/v1/tenants", "api.get_tenants", "GET", lambda: "/api/v1/tenants", None),
+        ("GET /api/v1/tenants/employees", "api.get_tenant_list", "GET", lambda: "/api/v1/tenants/employees?limit=50", None),
+        ("GET /api/v1/tenants/reports", "api.get_tenant_reports", "GET", lambda: f"/api/v1/tenants/reports?month={month}", None),
+        ("POST /employee/import", "post_employee_import", "POST", lambda: "/employee/import", upload("employee")),
+        ("POST /attendance/import", "post_attendance_import", "POST", lambda: "/attendance/import", upload("attendance")),
+        ("POST /payroll/import", "post_payroll_import", "POST", lambda: "/payroll/import", upload("payroll")),
+    ]
+
+def _request(app, method, path, form=None):
+    if form is not None and method == "POST" and "file" not in form:
+        form = {name: str(value) for name, value in form.items()}
+    response = _client(app).open(path, method=method, data=form)
+    if response.status_code >= 400:
+        raise RuntimeError(f"{method} {path} returned {response.status_code}")
+    return response
+
+def run_http_suite(app, sample, rng, iterations, workers, only=None):
+    results = {}
+    endpoints = set()
+    for name, endpoint, method, path, form in http_benchmarks(sample, rng):
+        endpoints.add(endpoint)
+        if only and only not in name:
+            continue
+        results[name] = measure(
+            lambda: _request(app, method, path(), form() if form else None), iterations, workers
+        )
+
+    rows = _new_rows(rng, sample)
+    for entity in WRITE_ENTITIES:
+        endpoints.update({f"post_{entity}_create", f"post_{entity}_update", f"get_{entity}_delete"})
+        if only and only not in entity:
+            continue
+        keyed = entity == "project"
+        path = lambda key: "/".join(str(part) for part in key) if keyed else str(key)
+        _run_write_cycle(
+            results, entity,
+            (f"POST /{entity}/create", lambda row: _request(app, "POST", f"/{entity}/create", row)),
+            (f"POST /{entity}/update", lambda key, row: _request(app, "POST", f"/{entity}/update/{path(key)}", row)),
+            (f"GET /{entity}/delete", lambda key: _request(app, "GET", f"/{entity}/delete/{path(key)}")),
+            iterations, workers, rows[entity],
+        )
+
+    # Shift start: many clients checking in at once, coalesced by group commit
+    if not only or only in "POST /attendance/create burst":
+        since = _max_rowid("Attendance")
+        results[f"POST /attendance/create burst x{CHECK_IN_CLIENTS}"] = measure(
+            lambda: _request(app, "POST", "/attendance/create", rows["attendance"]()), iterations, CHECK_IN_CLIENTS
+        )
+        with database.transaction() as connection:
+            connection.execute("DELETE FROM Attendance WHERE rowid > ?", (since,))
+
+    # A payroll run rewrites a whole month; run it a few times for a month after the seeded data
+    endpoints.add("post_payroll_run")
+    if not only or only in "POST /payroll/run":
+        results["POST /payroll/run"] = measure(
+            lambda: _await_job(_request(app, "POST", "/payroll/run", {"month": sample["run_month"]})), 3, 1
+        )
+        with database.transaction() as connection:
+            connection.execute("DELETE FROM Payroll WHERE MonthKey = ?", (conversions.month_key(sample["run_month"]),))
+            connection.execute("DELETE FROM payroll_run WHERE Month = ?", (sample["run_month"],))
+
+    # Jobs: queue a small export and wait for it, then read and cancel jobs
+    endpoints.update({"post_job_submit", "api.get_job", "post_job_cancel"})
+    if not only or only in "POST /jobs/export":
+        output = tempfile.mkdtemp()
+        finished = []
+        try:
+            results["POST /jobs/export Department"] = measure(
+                lambda: finished.append(_await_job(
+                    _request(app, "POST", "/jobs/export", {"tables": "Department", "output": output})
+                )), iterations, 1
+            )
+        finally:
+            shutil.rmtree(output)
+        results["GET /api/v1/jobs/<id>"] = measure(
+            lambda: _request(app, "GET", f"/api/v1/jobs/{rng.choice(finished)}"), iterations, workers
+        )
+        # Jobs queued to run in an hour, so the cancel always finds them queued
+        results["POST /jobs/<id>/cancel"] = measure(
+            lambda: _request(app, "POST", f"/jobs/{jobs.submit('rebuild_reports', run_after=time.time() + 3600)}/cancel"),
+            iterations, 1
+        )
+    missing = sorted(set(app.view_functions) - endpoints - {"static"})
+    return results, missing
+
+def _await_job(response):
+    """Wait for the job a POST redirected to; returns its JobID."""
+    job_id = int(parse_qs(urlsplit(response.location).query)["job"][0])
+    job = jobs.wait(job_id, interval=0.01)
+    if job["Status"] != "succeeded":
+        raise RuntimeError(f"job {job_id} {job['Status']}: {job['Error']}")
+    return job_id
+
+# asgi suite: the same GET requests through the WSGI app and asgi.application
+ASGI_BENCHMARKS = ("GET /employee/update", "GET /position/update", "GET /employees?department_id", "GET /api/v1/employees?ids")
+
+async def _asgi_get(application, path):
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "",
+        "query_string": query.encode(), "headers": [(b"host", b"localhost")],
+        "client": ("127.0.0.1", 0), "server": ("localhost", 80),
+    }
+    messages = [{"type": "http.request", "body": b"", "more_body": False}]
+    status = []
+
+    async def receive():
+        return messages.pop() if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    await application(scope, receive, send)
+    if status[0] >= 400:
+        raise RuntimeError(f"GET {path} returned {status[0]}")
+
+async def _asgi_measure(application, path, iterations, concurrency):
+    latencies, errors = [], []
+    remaining = iter(range(iterations))
+
+    async def client():
+        for _ in remaining:
+            started = time.perf_counter()
+            try:
+                await _asgi_get(application, path())
+            except Exception as error:
+                errors.append(repr(error))
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+    return summarise(latencies, errors, wall)
+
+def run_asgi_suite(app, application, sample, rng, iterations, concurrency):
+    """Compare one request at a time over WSGI with ``concurrency`` threads over WSGI and ``concurrency`` in flight over ASGI."""
+    results = {}
+    benchmarks = {name: path for name, _, _, path, _ in http_benchmarks(sample, rng)}
+    for name in ASGI_BENCHMARKS:
+        path = benchmarks[name]
+        results[f"{name} wsgi"] = measure(lambda: _request(app, "GET", path()), iterations)
+        results[f"{name} wsgi x{concurrency} threads"] = measure(lambda: _request(app, "GET", path()), iterations, concurrency)
+        results[f"{name} asgi x{concurrency}"] = asyncio.run(_asgi_measure(application, path, iterations, concurrency))
+    return results
+
+# columnar suite: attendance rates over row dicts and over attendance_store
+COLUMNAR_ITERATIONS = 20
+
+def _row_rates(rows, by, departments):
+    # The Python equivalent of AttendanceStore.summary(by): {key: rate}
+    counts = {}
+    for row in rows:
+        if not row["Date"]:
+            continue
+        if by == "employee":
+            key = row["EmployeeID"]
+        elif by == "department":
+            key = departments.get(row["EmployeeID"]) or 0
+        else:
+            key = conversions.iso_date(row["Date"])[:7]
+        days = counts.setdefault(key, [0, 0])
+        days[0] += 1
+        days[1] += row["Status"] in database.WORKED_STATUSES
+    return {key: round(worked / total, 4) for key, (total, worked) in counts.items()}
+
+def _traced(load):
+    """Call ``load()``; returns its result and the bytes it still holds."""
+    tracemalloc.start()
+    try:
+        result = load()
+        held = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return result, held
+
+def run_columnar_suite(iterations):
+    """Return (results, footprints, mismatches) comparing the two paths."""
+    rows, row_bytes = _traced(database.get_attendances)
+    store = attendance_store.AttendanceStore()
+    _, store_bytes = _traced(store.load)
+    footprints = {
+        "row dicts": {"rows": len(rows), "bytes": row_bytes},
+        "columnar": {"rows": store.nbytes()["rows"], "bytes": store_bytes},
+    }
+    departments = {employee["EmployeeID"]: employee["DepartmentID"] for employee in database.get_employees()}
+
+    results = {
+        "rows load": measure(database.get_attendances, max(1, iterations // 4)),
+        "columnar load": measure(attendance_store.AttendanceStore().load, max(1, iterations // 4)),
+    }
+    mismatches = []
+    for by in ("employee", "department", "month"):
+        results[f"rows rate by {by}"] = measure(lambda: _row_rates(rows, by, departments), iterations)
+        results[f"columnar rate by {by}"] = measure(lambda: store.summary(by), iterations)
+        expected = _row_rates(rows, by, departments)
+        if {row["key"]: row["rate"] for row in store.summary(by)} != expected:
+            mismatches.append(f"rate by {by}: columnar summary differs from the row dicts")
+    return results, footprints, mismatches
+
+# Baselines
+def compare(results, baseline, tolerance=TOLERANCE):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get("results", {}).get(name)
+        if base is None:
+            continue
+        for metric in ("p50_ms", "p95_ms"):
+            limit = base[metric] * (1 + tolerance)
+            if result[metric] > limit and result[metric] - base[metric] > NOISE_FLOOR_MS:
+                regressions.append(f"{name}: {metric} {result[metric]:.3f} ms vs baseline {base[metric]:.3f} ms")
+    return regressions
+
+def print_results(results, baseline=None):
+    base = (baseline or {}).get("results", {})
+    print(f"{'benchmark':<44}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}  vs baseline p95")
+    for name, result in results.items():
+        delta = ""
+        if name in base and base[name]["p95_ms"]:
+            delta = f"{(result['p95_ms'] / base[name]['p95_ms'] - 1) * 100:+.0f}%"
+        print(
+            f"{name:<44}{result['ops_per_sec']:>10.1f}{result['p50_ms']:>10.3f}{result['p95_ms']:>10.3f}"
+            f"{result['p99_ms']:>10.3f}{result['max_ms']:>10.3f}  {delta}"
+        )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Seed synthetic data and benchmark the EMS.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = commands.add_parser("seed", help="populate a database with synthetic data")
+    seed_parser.add_argument("--database", default="ems.db")
+    seed_parser.add_argument("--scale", default="1k", help="1k, 10k, 100k or a number of employees")
+    seed_parser.add_argument("--years", type=float, default=1)
+    seed_parser.add_argument("--seed", type=int, default=0)
+    seed_parser.add_argument("--reset", action="store_true", help="delete the database file first")
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--database", default="ems.db")
+    run_parser.add_argument("--suite", choices=("db", "http", "all"), default="all")
+    run_parser.add_argument("--iterations", type=int, default=ITERATIONS)
+    run_parser.add_argument("--concurrency", type=int, default=1)
+    run_parser.add_argument("--only", help="run benchmarks whose name contains this text")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--baseline", help="fail on regressions against this baseline file")
+    run_parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    run_parser.add_argument("--save-baseline", help="write the results to this baseline file")
+    asgi_parser = commands.add_parser("asgi", help="compare request throughput over WSGI and ASGI")
+    asgi_parser.add_argument("--database", default="ems.db")
+    asgi_parser.add_argument("--iterations", type=int, default=ITERATIONS)
+    asgi_parser.add_argument("--concurrency", type=int, default=8)
+    asgi_parser.add_argument("--seed", type=int, default=0)
+    columnar_parser = commands.add_parser("columnar", help="compare attendance rates over row dicts and the columnar store")
+    columnar_parser.add_argument("--database", default="ems.db")
+    columnar_parser.add_argument("--iterations", type=int, default=COLUMNAR_ITERATIONS)
+    args = parser.parse_args(argv)
+
+    if args.command == "seed":
+        employees = SCALES.get(args.scale) or int(args.scale)
+        if args.reset:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(args.database + suffix):
+                    os.remove(args.database + suffix)
+        # Bulk inserts would flood the slow-query log
+        metrics.enabled = False
+        database.initialize(args.database)
+        if table_counts()["Employee_details"]:
+            print(f"{args.database} already has employees; use --reset to replace it", file=sys.stderr)
+            return 1
+        started = time.perf_counter()
+        counts = seed(employees, args.years, random_seed=args.seed)
+        for table, count in counts.items():
+            print(f"{table:<18}{count:>12}")
+        print(f"Seeded {args.database} in {time.perf_counter() - started:.1f}s")
+        return 0
+
+    if args.command == "asgi":
+        # asgi.py opens main.DATABASE_FILE on import
+        os.environ["EMS_DATABASE"] = args.database
+        import asgi
+        rng = random.Random(args.seed)
+        results = run_asgi_suite(asgi.app, asgi.application, load_sample(rng), rng, args.iterations, args.concurrency)
+        print_results(results)
+        errors = [f"{name}: {result['errors']} errors, first: {result['first_error']}"
+                  for name, result in results.items() if result["errors"]]
+        for error in errors:
+            print(error, file=sys.stderr)
+        return 1 if errors else 0
+
+    if args.command == "columnar":
+        if attendance_store.numpy is None:
+            print("the columnar store requires numpy", file=sys.stderr)
+            return 1
+        database.initialize(args.database)
+        results, footprints, mismatches = run_columnar_suite(args.iterations)
+        for name, footprint in footprints.items():
+            print(f"{name:<12}{footprint['rows']:>10} rows{footprint['bytes'] / 2 ** 20:>10.1f} MiB"
+                  f"{footprint['bytes'] / max(footprint['rows'], 1):>8.1f} bytes/row")
+        print_results(results)
+        for mismatch in mismatches:
+            print(mismatch, file=sys.stderr)
+        return 1 if mismatches else 0
+
+    app = None
+    if args.suite in ("http", "all"):
+        import main as web
+        app = web.init(args.database)
+    else:
+        database.initialize(args.database)
+    rng = random.Random(args.seed)
+    sample = load_sample(rng)
+    counts = table_counts()
+    print(", ".join(f"{table} {count}" for table, count in counts.items()))
+
+    results = {}
+    problems = []
+    if args.suite in ("db", "all"):
+        results.update(run_db_suite(sample, rng, args.iterations, args.concurrency, args.only))
+        if not args.only:
+            problems += [f"{name}: no benchmark covers this function" for name in db_coverage(results)]
+    if app is not None:
+        http_results, missing = run_http_suite(app, sample, rng, args.iterations, args.concurrency, args.only)
+        results.update(http_results)
+        problems += [f"{endpoint}: no benchmark covers this route" for endpoint in missing]
+    problems += [f"{name}: {result['errors']} errors, first: {result['first_error']}"
+                 for name, result in results.items() if result["errors"]]
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("counts") != counts:
+            print("warning: row counts differ from the baseline's dataset", file=sys.stderr)
+        if baseline.get("concurrency") != args.concurrency:
+            print(f"warning: the baseline was taken with --concurrency {baseline.get('concurrency')}", file=sys.stderr)
+    print_results(results, baseline)
+    if baseline is not None:
+        problems += compare(results, baseline, args.tolerance)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump({"counts": counts, "concurrency": args.concurrency, "results": results}, baseline_file, indent=2)
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
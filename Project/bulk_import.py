@@ -0,0 +1,301 @@
+"""Bulk loading of attendance, payroll and employee rows.
+
+Input is streamed from CSV, JSON Lines or a JSON array and written with
+``executemany`` in one transaction per chunk. A row that fails validation
+or a constraint is reported with its line number and skipped; the rest of
+the chunk is still written. The CSV layout written by app.py into
+output_csv/ is accepted as-is (``NetPay``, ``FirstName``/``LastName`` and
+``PositionID`` are mapped onto the Employee_details/Payroll columns).
+Rows that carry their primary key replace the existing row with that key.
+
+    python bulk_import.py attendance output_csv/Attendance.csv
+"""
+import argparse
+import csv
+import io
+import json
+import sqlite3
+import sys
+from datetime import date
+
+import conversions
+import database
+
+CHUNK_SIZE = 1000
+MAX_ERRORS = 1000
+
+def _text(row, name, required=True):
+    value = row.get(name)
+    if value is None or str(value).strip() == "":
+        if required:
+            raise ValueError(f"{name} is required")
+        return None
+    return str(value).strip()
+
+def _int(row, name, required=True):
+    value = _text(row, name, required)
+    if value is None:
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        number = None
+    if number is None or not number.is_integer():
+        raise ValueError(f"{name} must be an integer, got {value!r}")
+    return int(number)
+
+def _number(row, name, required=True):
+    value = _text(row, name, required)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a number, got {value!r}")
+
+def _date(row, name, required=True):
+    value = _text(row, name, required)
+    if value is None:
+        return None
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise ValueError(f"{name} must be a YYYY-MM-DD date, got {value!r}")
+
+def _attendance(row, lookups):
+    return {
+        "AttendanceID": _int(row, "AttendanceID", required=False),
+        "EmployeeID": _int(row, "EmployeeID"),
+        "Date": _date(row, "Date"),
+        "Status": _text(row, "Status"),
+    }
+
+def _cents(row, name, required=True):
+    value = _text(row, name, required)
+    try:
+        return conversions.cents(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a number, got {value!r}")
+
+def _payroll(row, lookups):
+    basic = _cents(row, "BasicPay")
+    deductions = _cents(row, "Deductions", required=False) or 0
+    netpay = _cents(row, "Netpay", required=False)
+    if netpay is None:
+        netpay = _cents(row, "NetPay", required=False)
+    if netpay is None:
+        netpay = basic - deductions
+    month = conversions.month_key(_text(row, "Month"))
+    return {
+        "PayrollID": _int(row, "PayrollID", required=False),
+        "EmployeeID": _int(row, "EmployeeID"),
+        "Month": conversions.month_label(month),
+        "BasicPay": conversions.amount(basic),
+        "Deductions": conversions.amount(deductions),
+        "Netpay": conversions.amount(netpay),
+        "MonthKey": month,
+        "BasicPayCents": basic,
+        "DeductionsCents": deductions,
+        "NetpayCents": netpay,
+    }
+
+def _employee(row, lookups):
+    name = _text(row, "EmployeeName", required=False)
+    if name is None:
+        parts = [_text(row, "FirstName", required=False), _text(row, "LastName", required=False)]
+        name = " ".join(part for part in parts if part)
+    if not name:
+        raise ValueError("EmployeeName (or FirstName/LastName) is required")
+    department_id = _int(row, "DepartmentID", required=False)
+    position = _text(row, "Position", required=False)
+    position_id = _int(row, "PositionID", required=False)
+    if position_id is not None:
+        if position_id not in lookups["positions"]:
+            raise ValueError(f"unknown PositionID {position_id}")
+        position = lookups["positions"][position_id]
+    elif position is not None:
+        position_id = lookups["position_ids"].get((position, department_id), lookups["position_ids"].get((position, None)))
+        if position_id is None:
+            raise ValueError(f"unknown Position {position!r}")
+    salary = _text(row, "Salary", required=False)
+    experience = _text(row, "Experience", required=False)
+    return {
+        "EmployeeID": _int(row, "EmployeeID", required=False),
+        "EmployeeName": name,
+        "HireDate": _date(row, "HireDate", required=False),
+        "Experience": experience,
+        "Position": position,
+        "Gender": _text(row, "Gender", required=False),
+        "DepartmentID": department_id,
+        "Email": _text(row, "Email", required=False),
+        "Phone": _text(row, "Phone", required=False),
+        "Status": _text(row, "Status", required=False) or "Active",
+        "DOB": _date(row, "DOB", required=False),
+        "Salary": salary,
+        "TeamID": _int(row, "TeamID", required=False),
+        "PositionID": position_id,
+        "SalaryCents": conversions.cents(salary),
+        "ExperienceMonths": conversions.experience_months(experience),
+    }
+
+def _position_lookup():
+    positions = sorted(database.get_positions(), key=lambda pos: pos["PositionID"])
+    # Names are unique within a department; a name alone maps to its lowest id
+    position_ids = {}
+    for pos in positions:
+        position_ids.setdefault((pos["PositionName"], pos["DepartmentID"]), pos["PositionID"])
+        position_ids.setdefault((pos["PositionName"], None), pos["PositionID"])
+    return {
+        "positions": {pos["PositionID"]: pos["PositionName"] for pos in positions},
+        "position_ids": position_ids,
+    }
+
+# entity -> (table, primary key, row normalizer, lookup loader)
+ENTITIES = {
+    "attendance": ("Attendance", "AttendanceID", _attendance, None),
+    "payroll": ("Payroll", "PayrollID", _payroll, None),
+    "employee": ("Employee_details", "EmployeeID", _employee, _position_lookup),
+}
+
+def read_rows(stream, fmt):
+    """Yield ``(line_number, row)`` from a text stream.
+
+    JSON Lines rows are yielded unparsed so a malformed line is reported as
+    a row error by import_rows() instead of ending the import.
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt == "jsonl":
+        for number, line in enumerate(stream, start=1):
+            if line.strip():
+                yield number, line
+    elif fmt == "json":
+        for number, row in enumerate(json.load(stream), start=1):
+            yield number, row
+    else:
+        raise ValueError(f"unsupported format {fmt!r}")
+
+def detect_format(filename):
+    name = (filename or "").lower()
+    if name.endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    if name.endswith(".json"):
+        return "json"
+    return "csv"
+
+def _insert_sql(table, key, columns):
+    placeholders = ", ".join("?" * len(columns))
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"
+    if key not in columns:
+        return sql
+    # An upsert rather than INSERT OR REPLACE: REPLACE deletes the old row
+    # without firing DELETE triggers, leaving summaries and search stale
+    updates = ", ".join(f"{column} = excluded.{column}" for column in columns if column != key)
+    return f"{sql} ON CONFLICT ({key}) DO UPDATE SET {updates}"
+
+def _write_chunk(table, key, chunk, result):
+    # Rows with and without an explicit key need different column lists
+    groups = {}
+    for line, record in chunk:
+        columns = tuple(c for c in record if c != key or record[key] is not None)
+        groups.setdefault(columns, []).append((line, record))
+
+    with database.transaction() as connection:
+        cursor = connection.cursor()
+        # Savepoints below must nest inside the chunk's transaction
+        if not connection.in_transaction:
+            cursor.execute("BEGIN")
+        for columns, rows in groups.items():
+            sql = _insert_sql(table, key, columns)
+            values = [tuple(record[c] for c in columns) for _, record in rows]
+            cursor.execute("SAVEPOINT bulk_chunk")
+            try:
+                cursor.executemany(sql, values)
+                cursor.execute("RELEASE bulk_chunk")
+                result["inserted"] += len(rows)
+                continue
+            except sqlite3.DatabaseError:
+                cursor.execute("ROLLBACK TO bulk_chunk")
+                cursor.execute("RELEASE bulk_chunk")
+
+            # Retry row by row so one bad row does not discard the chunk
+            for (line, _), row_values in zip(rows, values):
+                cursor.execute("SAVEPOINT bulk_row")
+                try:
+                    cursor.execute(sql, row_values)
+                    cursor.execute("RELEASE bulk_row")
+                    result["inserted"] += 1
+                except sqlite3.DatabaseError as error:
+                    cursor.execute("ROLLBACK TO bulk_row")
+                    cursor.execute("RELEASE bulk_row")
+                    _error(result, line, str(error))
+
+def _error(result, line, message):
+    result["failed"] += 1
+    if len(result["errors"]) < MAX_ERRORS:
+        result["errors"].append({"line": line, "error": message})
+
+def import_rows(entity, rows, chunk_size=CHUNK_SIZE):
+    """Validate and insert ``(line_number, row_dict)`` pairs for ``entity``.
+
+    Returns a summary with the number of rows read, inserted and failed and
+    up to MAX_ERRORS per-row error messages.
+    """
+    if entity not in ENTITIES:
+        raise ValueError(f"unknown entity {entity!r}")
+    table, key, normalize, load_lookups = ENTITIES[entity]
+    lookups = load_lookups() if load_lookups else {}
+    result = {"entity": entity, "read": 0, "inserted": 0, "failed": 0, "errors": []}
+
+    chunk = []
+    for line, row in rows:
+        result["read"] += 1
+        try:
+            if isinstance(row, str):
+                row = json.loads(row)
+            if not isinstance(row, dict):
+                raise ValueError("row must be an object")
+            chunk.append((line, normalize(row, lookups)))
+        except ValueError as error:
+            _error(result, line, str(error))
+        if len(chunk) >= chunk_size:
+            _write_chunk(table, key, chunk, result)
+            chunk = []
+    if chunk:
+        _write_chunk(table, key, chunk, result)
+    if result["inserted"]:
+        database.tables_changed(table)
+    if entity == "employee" and result["inserted"]:
+        database.invalidate_cache("employees")
+    return result
+
+def import_file(entity, path, fmt=None, chunk_size=CHUNK_SIZE):
+    fmt = fmt or detect_format(path)
+    with open(path, newline="", encoding="utf-8-sig") as stream:
+        return import_rows(entity, read_rows(stream, fmt), chunk_size)
+
+def import_upload(entity, upload, chunk_size=CHUNK_SIZE):
+    fmt = detect_format(upload.filename)
+    stream = io.TextIOWrapper(upload.stream, encoding="utf-8-sig", newline="")
+    return import_rows(entity, read_rows(stream, fmt), chunk_size)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import rows into the EMS database.")
+    parser.add_argument("entity", choices=sorted(ENTITIES))
+    parser.add_argument("path")
+    parser.add_argument("--database", default="ems.db")
+    parser.add_argument("--format", choices=["csv", "json", "jsonl"])
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    database.initialize(args.database)
+    result = import_file(args.entity, args.path, args.format, args.chunk_size)
+    for error in result["errors"]:
+        print(f"line {error['line']}: {error['error']}", file=sys.stderr)
+    print(f"{result['inserted']} of {result['read']} {args.entity} rows imported, {result['failed']} failed.")
+    return 1 if result["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,214 @@
+"""Read-through cache for reference data (departments, positions, employees).
+
+database.py wraps its list functions with ``cached(key)`` and calls
+``invalidate(*keys)`` once a write touching that data has committed. The
+default backend is an in-process LRU with a TTL; ``SharedBackend`` keeps
+entries in an external store (anything with redis-style ``get``/``set``/
+``delete``) so several app processes see the same entries and the same
+invalidations. ``InMemoryClient`` is a stand-in for that store.
+"""
+import functools
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_SIZE = 128
+
+class LocalBackend:
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, ttl):
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def size(self):
+        return len(self._entries)
+
+class InMemoryClient:
+    """Minimal redis-style client used in place of a real shared store."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ex if ex else None)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+class SharedBackend:
+    def __init__(self, client, prefix="ems:cache:"):
+        self.client = client
+        self.prefix = prefix
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            return False, None
+        return True, pickle.loads(raw)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl or None)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in list(_keys):
+            self.delete(key)
+
+    def size(self):
+        return None
+
+def backend_from_url(url):
+    if not url or url == "local://":
+        return LocalBackend()
+    if url == "memory://":
+        return SharedBackend(InMemoryClient())
+    if url.startswith(("redis://", "rediss://")):
+        import redis
+        return SharedBackend(redis.Redis.from_url(url))
+    raise ValueError(f"unsupported cache backend {url!r}")
+
+backend = backend_from_url(os.environ.get("EMS_CACHE_URL"))
+ttl = DEFAULT_TTL
+enabled = True
+# Returns the namespace of the caller's keys (database.py: its tenant shard), None for none
+scope = None
+_keys = set()
+_generations = {}
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+def configure(new_backend=None, new_ttl=None, enable=None, new_scope=None):
+    global backend, ttl, enabled, scope
+    if new_backend is not None:
+        backend = new_backend
+    if new_scope is not None:
+        scope = new_scope
+    if new_ttl is not None:
+        ttl = new_ttl
+    if enable is not None:
+        enabled = enable
+    clear()
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+def _scoped(key):
+    name = scope() if scope is not None else None
+    return key if name is None else f"{name}/{key}"
+
+def get_or_load(key, load, timeout=None):
+    # ``timeout`` overrides the module TTL for this entry
+    if not enabled:
+        return load()
+    key = _scoped(key)
+    found, value = backend.get(key)
+    if found:
+        _count("hits")
+        return value
+    _count("misses")
+    # An invalidation that lands while we load means the value may be stale
+    with _lock:
+        generation = _generations.get(key, 0)
+        _keys.add(key)
+    value = load()
+    with _lock:
+        if _generations.get(key, 0) == generation:
+            backend.set(key, value, ttl if timeout is None else timeout)
+    return value
+
+def cached(key, bypass=None):
+    """Decorate a zero-argument loader so its result is cached under ``key``.
+
+    When ``bypass()`` is true the loader is called directly, e.g. inside a
+    transaction whose uncommitted writes must not be cached. The cached
+    value is shared between callers and must not be mutated.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper():
+            if bypass is not None and bypass():
+                return function()
+            return get_or_load(key, function)
+        wrapper.uncached = function
+        return wrapper
+    return decorator
+
+def invalidate(*keys):
+    keys = [_scoped(key) for key in keys]
+    with _lock:
+        for key in keys:
+            _generations[key] = _generations.get(key, 0) + 1
+            backend.delete(key)
+        _stats["invalidations"] += len(keys)
+
+def clear():
+    with _lock:
+        for key in _keys:
+            _generations[key] = _generations.get(key, 0) + 1
+        backend.clear()
+
+def stats():
+    with _lock:
+        result = dict(_stats)
+    lookups = result["hits"] + result["misses"]
+    result["hit_ratio"] = result["hits"] / lookups if lookups else 0.0
+    result["evictions"] = backend.evictions
+    result["expirations"] = backend.expirations
+    result["size"] = backend.size()
+    result["backend"] = type(backend).__name__
+    return result
@@ -0,0 +1,239 @@
+"""Change feed over the change_log table (migration 14).
+
+Triggers append a record to change_log for every insert, update and delete
+of a data table, in the writing transaction, so the log holds exactly the
+committed changes in commit order. A consumer keeps the last Seq it has
+applied and asks for what follows:
+
+    GET /api/v1/changes?since=<seq>&wait=<seconds>&tables=Employee_details,Payroll
+
+The reply lists the changes (table, key, operation and, for updates, the
+changed columns) and ``next``, the Seq to ask from next time; rows are read
+with /api/v1/<resource>?ids=. With ``wait`` the request is held until a
+change arrives or the wait runs out (long polling).
+
+compact() keeps the log bounded. Records older than COMPACT_AFTER seconds
+are merged to one per row, the latest, so a consumer at any position still
+learns about every row that changed after it. Records older than RETAIN
+seconds are dropped and FloorSeq moves past them; a consumer asking from
+below the floor gets ``Behind`` and must start again from a full export.
+
+    python changes.py tail --since 0
+    python changes.py compact
+    python changes.py schedule --every 3600
+"""
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+import database
+
+PAGE_SIZE = 500
+MAX_WAIT = 30
+# Other processes' writes do not wake a waiting request; it re-reads this often
+POLL_INTERVAL = 1.0
+COMPACT_AFTER = int(os.environ.get("EMS_CHANGE_LOG_COMPACT_AFTER", 24 * 3600))
+RETAIN = int(os.environ.get("EMS_CHANGE_LOG_RETAIN", 30 * 24 * 3600))
+COMPACT_CHUNK_SIZE = 5000
+
+class Behind(Exception):
+    """The records after the requested Seq have been dropped by retention."""
+
+    def __init__(self, since, floor):
+        super().__init__(f"changes up to {floor} are no longer kept; asked from {since}")
+        self.floor = floor
+
+_arrived = threading.Condition()
+# Bumped on every local commit, so a waiter can tell one came in while it read
+_commits = 0
+
+@database.on_change
+def _wake(table, keys):
+    global _commits
+    with _arrived:
+        _commits += 1
+        _arrived.notify_all()
+
+def _record(row):
+    return {
+        "seq": row["Seq"], "table": row["TableName"], "key": json.loads(row["RowKey"]),
+        "op": row["Operation"], "columns": json.loads(row["Columns"]) if row["Columns"] else None,
+        "at": row["ChangedAt"],
+    }
+
+def read_changes(since=0, limit=PAGE_SIZE, tables=None):
+    """Return changes after ``since`` as {"changes", "next", "floor"}."""
+    # Never the replica: a consumer must not be handed a stale position
+    with database.route("reader"), database.get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("BEGIN")
+        try:
+            cursor.execute("SELECT FloorSeq FROM change_log_state")
+            floor = cursor.fetchone()[0]
+            if since < floor:
+                raise Behind(since, floor)
+            sql = "SELECT Seq, TableName, RowKey, Operation, Columns, ChangedAt FROM change_log WHERE Seq > ?"
+            params = [since]
+            if tables:
+                sql += f" AND TableName IN ({', '.join('?' * len(tables))})"
+                params += list(tables)
+            cursor.execute(sql + " ORDER BY Seq LIMIT ?", params + [limit])
+            changes = [_record(row) for row in cursor.fetchall()]
+            if len(changes) == limit:
+                next_seq = changes[-1]["seq"]
+            else:
+                # Nothing more matched: later calls can skip what was scanned
+                cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'")
+                row = cursor.fetchone()
+                next_seq = max(since, row[0] if row else 0)
+        finally:
+            connection.rollback()
+    return {"changes": changes, "next": next_seq, "floor": floor}
+
+def wait_for_changes(since=0, limit=PAGE_SIZE, tables=None, timeout=0):
+    """Like read_changes, but wait up to ``timeout`` seconds for a change."""
+    deadline = time.monotonic() + min(timeout, MAX_WAIT)
+    while True:
+        seen = _commits
+        result = read_changes(since, limit, tables)
+        remaining = deadline - time.monotonic()
+        if result["changes"] or remaining <= 0:
+            return result
+        since = result["next"]
+        with _arrived:
+            if _commits == seen:
+                _arrived.wait(min(remaining, POLL_INTERVAL))
+
+def _merge(records):
+    """One record standing for ``records`` (oldest first) of one row."""
+    last = dict(records[-1])
+    if last["Operation"] == "delete":
+        return last
+    if any(record["Operation"] == "insert" or record["Columns"] is None for record in records):
+        last["Operation"], last["Columns"] = "insert", None
+        return last
+    columns = []
+    for record in records:
+        columns += [name for name in json.loads(record["Columns"]) if name not in columns]
+    last["Operation"], last["Columns"] = "update", json.dumps(columns)
+    return last
+
+def _compact_chunk(cursor, start, end):
+    # Only rows with more than one record so far have anything to merge
+    cursor.execute("""
+        SELECT DISTINCT c.TableName, c.RowKey FROM change_log c
+        WHERE c.Seq > ? AND c.Seq <= ? AND EXISTS (
+            SELECT 1 FROM change_log o
+            WHERE o.TableName = c.TableName AND o.RowKey = c.RowKey AND o.Seq <= ? AND o.Seq != c.Seq
+        )
+    """, (start, end, end))
+    merged = 0
+    for table, key in cursor.fetchall():
+        cursor.execute(
+            "SELECT * FROM change_log WHERE TableName = ? AND RowKey = ? AND Seq <= ? ORDER BY Seq",
+            (table, key, end),
+        )
+        records = cursor.fetchall()
+        if len(records) < 2:
+            continue
+        last = _merge(records)
+        cursor.execute(
+            "DELETE FROM change_log WHERE TableName = ? AND RowKey = ? AND Seq < ?", (table, key, last["Seq"])
+        )
+        cursor.execute(
+            "UPDATE change_log SET Operation = ?, Columns = ? WHERE Seq = ?",
+            (last["Operation"], last["Columns"], last["Seq"]),
+        )
+        merged += len(records) - 1
+    cursor.execute("UPDATE change_log_state SET CompactedSeq = ?", (end,))
+    return merged
+
+def _horizon(after, before):
+    """The last Seq past ``after`` changed before the unix time ``before``."""
+    horizon = after
+    with database.route("reader"), database.get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT Seq, ChangedAt FROM change_log WHERE Seq > ? ORDER BY Seq", (after,))
+        for seq, changed_at in cursor:
+            if changed_at >= before:
+                break
+            horizon = seq
+        cursor.close()
+    return horizon
+
+def compact(now=None, compact_after=COMPACT_AFTER, retain=RETAIN, chunk_size=COMPACT_CHUNK_SIZE):
+    """Merge old records to one per row and drop expired ones.
+
+    Each chunk of ``chunk_size`` sequence numbers is its own transaction, so
+    writers wait for one chunk at most; returns (records merged away,
+    records dropped).
+    """
+    now = time.time() if now is None else now
+    merged = dropped = 0
+    with database.get_connection("primary") as connection:
+        floor, compacted = connection.execute("SELECT FloorSeq, CompactedSeq FROM change_log_state").fetchone()
+    horizon = _horizon(compacted, now - compact_after)
+    while compacted < horizon:
+        end = min(compacted + chunk_size, horizon)
+        with database.transaction() as connection:
+            merged += _compact_chunk(connection.cursor(), compacted, end)
+        compacted = end
+    expired = _horizon(floor, now - retain)
+    while floor < expired:
+        end = min(floor + chunk_size, expired)
+        with database.transaction() as connection:
+            cursor = connection.cursor()
+            cursor.execute("DELETE FROM change_log WHERE Seq <= ?", (end,))
+            dropped += cursor.rowcount
+            cursor.execute(
+                "UPDATE change_log_state SET FloorSeq = ?, CompactedSeq = MAX(CompactedSeq, ?)", (end, end)
+            )
+        floor = end
+    return merged, dropped
+
+def tail(since=0, tables=None, wait=MAX_WAIT):
+    """Print changes as they arrive, forever."""
+    while True:
+        result = wait_for_changes(since, PAGE_SIZE, tables, wait)
+        for change in result["changes"]:
+            print(json.dumps(change), flush=True)
+        since = result["next"]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Follow and compact the EMS change log.")
+    parser.add_argument("command", choices=["tail", "compact", "schedule"])
+    parser.add_argument("--database", default="ems.db")
+    parser.add_argument("--since", type=int, default=0, help="Seq to follow from")
+    parser.add_argument("--tables", help="comma-separated tables to follow")
+    parser.add_argument("--every", type=float, default=3600, help="seconds between scheduled compactions")
+    args = parser.parse_args(argv)
+    database.initialize(args.database, pool_size=1, backfill=False)
+    try:
+        if args.command == "tail":
+            try:
+                tail(args.since, args.tables.split(",") if args.tables else None)
+            except Behind as error:
+                print(f"❌ {error}")
+                return 1
+        elif args.command == "compact":
+            merged, dropped = compact()
+            print(f"✅ merged {merged} and dropped {dropped} change records")
+        else:
+            signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+            while True:
+                started = time.monotonic()
+                merged, dropped = compact()
+                print(f"merged {merged} and dropped {dropped} change records", flush=True)
+                time.sleep(max(args.every - (time.monotonic() - started), 0))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        database.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,176 @@
+"""Fail if any query issued by database.py does a full table scan.
+
+Every public get_/create_/update_/delete_ function is called at least once
+against a scratch database while the SQL it sends is traced, and each
+statement is run through EXPLAIN QUERY PLAN. A ``SCAN`` of a table, or an
+automatic index built at query time, is a failure unless the probe lists
+that table alias as expected to be read in full (the unfiltered listings).
+
+    python check_query_plans.py
+"""
+import inspect
+import os
+import re
+import sys
+import tempfile
+
+import cache
+import database
+
+EMPLOYEE = {
+    "EmployeeName": "Probe", "HireDate": "2020-01-01", "Experience": "1 year",
+    "Position": "Developer", "Gender": "Female", "DepartmentID": 1,
+    "Email": "probe@example.com", "Phone": "0", "Status": "Active",
+    "DOB": "1990-01-01", "Salary": "1000", "TeamID": 1,
+}
+DEPARTMENT = {"DeptName": "IT", "Location": "Floor 1"}
+POSITION = {"PositionName": "Developer", "DepartmentID": 1}
+ATTENDANCE = {"EmployeeID": 1, "Date": "2025-03-01", "Status": "Present"}
+LEAVE = {
+    "EmployeeID": 1, "StartDate": "2025-03-03", "EndDate": "2025-03-04",
+    "Reason": "Probe", "Status": "Pending",
+}
+PROJECT = {"EmployeeID": 1, "TeamID": 1, "ProjectID": "P-1", "Task": "Probe", "Status": "Open", "Sprint": 1}
+PAYROLL = {"EmployeeID": 1, "Month": "March-2025", "BasicPay": 1000, "Deductions": 0, "Netpay": 1000}
+
+# (function name, arguments, aliases allowed to be read in full)
+PROBES = [
+    ("create_department", (DEPARTMENT,), ()),
+    ("create_position", (POSITION,), ()),
+    ("create_employee", (EMPLOYEE,), ()),
+    ("create_attendance", (ATTENDANCE,), ()),
+    ("create_attendances", ([ATTENDANCE, ATTENDANCE],), ()),
+    ("create_leave", (LEAVE,), ()),
+    ("create_project", (PROJECT,), ()),
+    ("create_payroll", (PAYROLL,), ()),
+
+    ("get_employees", (), ("e",)),
+    ("get_employee", (1,), ()),
+    ("get_employee_page", (), ("e",)),
+    ("get_employee_page", {"department_id": 1}, ()),
+    ("get_employee_page", {"position": "Developer", "sort": "name"}, ()),
+    ("get_employee_page", {"team_id": 1}, ()),
+    ("get_employee_page", {"position_id": 1, "sort": "name"}, ()),
+    ("search_employees", ("pro",), ()),
+    ("search_employees", ("porbe",), ()),
+    ("get_departments", (), ("Department",)),
+    ("get_department", (1,), ()),
+    ("get_department_page", (), ("Department",)),
+    ("get_positions", (), ("Position",)),
+    ("get_position", (1,), ()),
+    ("get_position_page", (), ("Position",)),
+    ("get_position_page", {"department_id": 1}, ()),
+    ("get_attendances", (), ("a",)),
+    ("get_attendance", (1,), ()),
+    ("get_attendance_page", (), ("a",)),
+    ("get_attendance_page", {"employee_id": 1, "date_from": "2025-03-01", "date_to": "2025-03-31"}, ()),
+    ("get_attendance_page", {"date_from": "2025-03-01", "sort": "date"}, ()),
+    ("get_leaves", (), ("l",)),
+    ("get_leave", (1,), ()),
+    ("get_leave_page", (), ("l",)),
+    ("get_leave_page", {"employee_id": 1}, ()),
+    ("get_leave_page", {"date_to": "2025-03-31", "sort": "start_date"}, ()),
+    ("get_leave_page", {"date_from": "2025-03-01", "sort": "start_date"}, ()),
+    ("get_projects", (), ("p",)),
+    ("get_project", (1, 1), ()),
+    ("get_project_page", (), ("p",)),
+    ("get_project_page", {"employee_id": 1}, ()),
+    ("get_project_page", {"team_id": 1}, ()),
+    ("get_payrolls", (), ("p",)),
+    ("get_payroll", (1,), ()),
+    ("get_payroll_page", (), ("p",)),
+    ("get_payroll_page", {"employee_id": 1}, ()),
+    ("get_payroll_page", {"month": "March-2025", "sort": "netpay"}, ()),
+    ("get_payroll_page", {"month_from": "2025-01", "month_to": "2025-03", "sort": "month"}, ()),
+    ("get_by_ids", ("Employee_details", [1, 2]), ()),
+    ("get_by_ids", ("Project", [(1, 1), (2, 1)]), ()),
+    ("get_table_versions", (["Employee_details", "Department"],), ()),
+
+    ("update_employee", (1, EMPLOYEE), ()),
+    ("update_department", (1, DEPARTMENT), ()),
+    ("update_position", (1, POSITION), ()),
+    ("update_attendance", (1, ATTENDANCE), ()),
+    ("update_leave", (1, LEAVE), ()),
+    ("update_project", (1, 1, PROJECT), ()),
+    ("update_payroll", (1, PAYROLL), ()),
+    ("delete_payroll", (1,), ()),
+    ("delete_project", (1, 1), ()),
+    ("delete_leave", (1,), ()),
+    ("delete_attendance", (1,), ()),
+    ("delete_employee", (1,), ()),
+    ("delete_position", (1,), ()),
+    ("delete_department", (1,), ()),
+]
+
+SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)")
+TRACED = ("SELECT", "UPDATE", "DELETE", "INSERT", "WITH")
+
+# Helpers that share a CRUD prefix but issue no queries of their own
+NOT_QUERIES = {"get_connection", "create_tables"}
+
+def public_functions():
+    return {
+        name for name, member in inspect.getmembers(database, inspect.isfunction)
+        if member.__module__ == database.__name__
+        and name.startswith(("get_", "create_", "update_", "delete_"))
+        and name not in NOT_QUERIES
+    }
+
+def explain(connection, sql):
+    cursor = connection.cursor()
+    cursor.execute("EXPLAIN QUERY PLAN " + sql)
+    return [row[3] for row in cursor.fetchall()]
+
+def check(probes=PROBES):
+    failures = []
+    missing = public_functions() - {name for name, _, _ in probes}
+    for name in sorted(missing):
+        failures.append(f"{name}: no probe covers this function")
+
+    for name, args, allowed in probes:
+        statements = []
+        # Hold the writer so reads and writes alike run on the traced connection
+        with database.get_connection("primary") as connection:
+            connection.set_trace_callback(statements.append)
+            try:
+                function = getattr(database, name)
+                if isinstance(args, dict):
+                    function(**args)
+                else:
+                    function(*args)
+            finally:
+                connection.set_trace_callback(None)
+            for sql in statements:
+                if not sql.lstrip().upper().startswith(TRACED):
+                    continue
+                # FTS5 loads its own shadow tables with statements on 'main'.'<name>'
+                if "'main'." in sql:
+                    continue
+                for detail in explain(connection, sql):
+                    match = SCAN.match(detail)
+                    # FTS5 lookups are reported as scans of the virtual table
+                    if match and "VIRTUAL TABLE" in detail:
+                        match = None
+                    if match and match.group(1) not in allowed:
+                        failures.append(f"{name}{args!r}: {detail}\n    {sql.strip()}")
+                    elif "AUTOMATIC" in detail:
+                        failures.append(f"{name}{args!r}: {detail}\n    {sql.strip()}")
+    return failures
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        database.initialize(os.path.join(directory, "plans.db"))
+        # Cached list functions must reach SQLite to be traced
+        cache.configure(enable=False)
+        failures = check()
+        database.close()
+    for failure in failures:
+        print("FAIL", failure)
+    if failures:
+        print(f"\n{len(failures)} query plan problem(s) found.")
+        return 1
+    print(f"{len(PROBES)} probes, no full table scans.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
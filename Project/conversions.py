@@ -0,0 +1,93 @@
+"""Conversions between the legacy text columns and the typed ones.
+
+Money is stored as integer cents, months as year * 100 + month (202503),
+dates as ISO YYYY-MM-DD text and experience as a whole number of months.
+Each parser returns None for a blank value and raises ValueError for
+input it cannot read.
+"""
+import re
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+MONTH_FORMAT = "%B-%Y"
+MONTH_FORMATS = (MONTH_FORMAT, "%b-%Y", "%Y-%m")
+DATE_FORMATS = ("%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y", "%Y/%m/%d")
+EXPERIENCE = re.compile(r"^(?:(\d+(?:\.\d+)?)\s*(?:y|yr|yrs|year|years)\b)?\s*(?:(\d+)\s*(?:m|mo|mos|month|months)\b)?$", re.I)
+
+def _blank(value):
+    return value is None or (isinstance(value, str) and not value.strip())
+
+def cents(value):
+    """Return ``value`` ("1,250.50", 1250.5, ...) as integer cents."""
+    if _blank(value):
+        return None
+    try:
+        amount = Decimal(str(value).replace(",", "").replace("$", "").strip())
+    except InvalidOperation:
+        raise ValueError(f"invalid amount {value!r}")
+    if not amount.is_finite():
+        raise ValueError(f"invalid amount {value!r}")
+    return int((amount * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def amount(value):
+    """Return integer cents as a float amount for the legacy columns."""
+    return None if value is None else value / 100
+
+def month_key(value):
+    """Return "March-2025", "Mar-2025", "2025-03" or 202503 as 202503."""
+    if _blank(value):
+        return None
+    if isinstance(value, int) or str(value).strip().isdigit():
+        key = int(value)
+        if 1 <= key % 100 <= 12 and key // 100 > 0:
+            return key
+        raise ValueError(f"invalid month {value!r}")
+    for fmt in MONTH_FORMATS:
+        try:
+            parsed = datetime.strptime(str(value).strip(), fmt)
+        except ValueError:
+            continue
+        return parsed.year * 100 + parsed.month
+    raise ValueError(f"invalid month {value!r}, expected e.g. March-2025 or 2025-03")
+
+def month_label(key):
+    """Return 202503 as "March-2025", the legacy Month text."""
+    return None if key is None else date(key // 100, key % 100, 1).strftime(MONTH_FORMAT)
+
+def month_bounds(key):
+    """Return the first and last ISO day of month ``key``."""
+    first = date(key // 100, key % 100, 1)
+    following = date(first.year + first.month // 12, first.month % 12 + 1, 1)
+    return first.isoformat(), date.fromordinal(following.toordinal() - 1).isoformat()
+
+def iso_date(value):
+    """Return an ISO date for ISO, day/month/year or year/month/day input."""
+    if _blank(value):
+        return None
+    text = str(value).strip()
+    try:
+        return date.fromisoformat(text[:10]).isoformat()
+    except ValueError:
+        pass
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date().isoformat()
+        except ValueError:
+            continue
+    raise ValueError(f"invalid date {value!r}, expected YYYY-MM-DD")
+
+def experience_months(value):
+    """Return "5 years", "1 year 6 months", "18 months" or "3" (years) in months."""
+    if _blank(value):
+        return None
+    text = str(value).strip()
+    try:
+        # A bare number counts years
+        return round(float(text) * 12)
+    except (ValueError, OverflowError):
+        pass
+    match = EXPERIENCE.match(text)
+    if match is None or not any(match.groups()):
+        raise ValueError(f"invalid experience {value!r}, expected e.g. 5 years or 18 months")
+    years, months = match.groups()
+    return round(float(years or 0) * 12) + int(months or 0)
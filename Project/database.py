@@ -1,467 +1,1477 @@
+import base64
+import binascii
+import difflib
+import functools
+import json
+import os
+import queue
+import re
 import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-connection = None
+import cache
+import conversions
+import metrics
+import migrations
 
-def initialize(database_file):
-    global connection
-    connection = sqlite3.connect(database_file, check_same_thread=False)
-    connection.row_factory = sqlite3.Row
+# Writes go through ``pool``, a single writer by default; reads go through
+# ``read_pool`` (read-only WAL connections) or ``replica_pool``, see ROUTES
+pool = None
+read_pool = None
+replica_pool = None
+_local = threading.local()
+
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool:
+    """Checkout/return pool of SQLite connections shared by the CRUD functions.
+
+    Connections are opened lazily up to ``size``, run in WAL mode so readers
+    do not block the writer, and wait ``busy_timeout`` ms on a locked database
+    before raising.
+    """
+
+    def __init__(self, database_file, size=5, timeout=30.0, busy_timeout=5000, read_only=False):
+        self.database_file = database_file
+        self.size = size
+        self.read_only = read_only
+        self.timeout = timeout
+        self.busy_timeout = busy_timeout
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self.checkouts = 0
+        self.in_use = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.timeouts = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.database_file,
+            timeout=self.busy_timeout / 1000,
+            check_same_thread=False,
+            factory=metrics.InstrumentedConnection,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+        conn.execute("PRAGMA journal_mode = WAL")
+        if self.read_only:
+            conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    def acquire(self):
+        # A forked worker must not reuse the parent's connections
+        if os.getpid() != self._pid:
+            with self._lock:
+                if os.getpid() != self._pid:
+                    self._reset()
+
+        start = time.perf_counter()
+        conn = None
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_open = self._opened < self.size
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+            else:
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self.timeouts += 1
+                    raise PoolTimeout(
+                        f"no connection available after {self.timeout}s "
+                        f"(pool size {self.size})"
+                    )
+
+        waited = time.perf_counter() - start
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        return conn
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self.in_use -= 1
+        self._idle.put(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "opened": self._opened,
+                "in_use": self.in_use,
+                "idle": self._idle.qsize(),
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_time_total": self.wait_time,
+                "wait_time_max": self.max_wait_time,
+                "wait_time_avg": self.wait_time / self.checkouts if self.checkouts else 0.0,
+            }
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+
+# Optional replica file for reads routed to "replica", how often it is
+# refreshed and how old it may be before those reads go to a reader instead
+REPLICA_FILE = os.environ.get("EMS_DB_REPLICA") or None
+REPLICA_INTERVAL = float(os.environ.get("EMS_DB_REPLICA_INTERVAL", "60"))
+MAX_STALENESS = float(os.environ["EMS_DB_MAX_STALENESS"]) if os.environ.get("EMS_DB_MAX_STALENESS") else None
+
+def initialize(database_file, pool_size=5, pool_timeout=30.0, busy_timeout=5000, backfill=True,
+               writers=1, replica_file=REPLICA_FILE, replica_interval=REPLICA_INTERVAL, max_staleness=MAX_STALENESS):
+    """Open the connection pools for ``database_file`` and bring its schema up to date.
+
+    ``pool_size`` read-only connections serve reads and ``writers`` (one
+    by default, so writers queue here rather than on SQLite's lock) serve
+    transactions. With ``replica_file``, reads routed to "replica" use a
+    copy of the database refreshed every ``replica_interval`` seconds, and
+    fall back to the readers while the copy is older than ``max_staleness``.
+    """
+    global pool, read_pool, replica_pool, _replica
+    close()
+    _pool_options.update(timeout=pool_timeout, busy_timeout=busy_timeout)
+    pool = ConnectionPool(database_file, size=writers, timeout=pool_timeout, busy_timeout=busy_timeout)
+    read_pool = ConnectionPool(database_file, size=pool_size, timeout=pool_timeout, busy_timeout=busy_timeout, read_only=True)
+    if replica_file:
+        replica_pool = ConnectionPool(replica_file, size=pool_size, timeout=pool_timeout, busy_timeout=busy_timeout, read_only=True)
+        _replica = {
+            "file": replica_file, "source": database_file, "busy_timeout": busy_timeout / 1000,
+            "interval": replica_interval, "max_staleness": max_staleness,
+            "pid": None, "checked": 0.0, "refreshed": None,
+        }
+    cache.clear()
     create_tables()
+    if backfill:
+        run_backfills()
+    if _replica is not None:
+        _start_replica_refresher(_replica)
 
-def create_tables():
-    cursor = connection.cursor()
-    
-    # Create Department table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Department (
-            DepartmentID INTEGER PRIMARY KEY,
-            DeptName TEXT,
-            Location TEXT
+def close():
+    global pool, read_pool, replica_pool, _replica
+    with _shard_lock:
+        shards = list(_shards.values())
+        _shards.clear()
+    for opened in (pool, read_pool, replica_pool, *(shard for pools in shards for shard in pools)):
+        if opened is not None:
+            opened.close()
+    pool = read_pool = replica_pool = _replica = None
+
+# Tenant shards: each tenant's data in its own database file, with its own
+# writer and readers, opened the first time a thread uses the tenant (see
+# shards.py). Threads outside use_shard() use the file given to initialize().
+SHARD_POOL_SIZE = int(os.environ.get("EMS_SHARD_POOL_SIZE", "2"))
+_shard_files = {}
+# name -> (writer pool, reader pool)
+_shards = {}
+_shard_lock = threading.Lock()
+_pool_options = {"timeout": 30.0, "busy_timeout": 5000}
+
+def busy_timeout():
+    """Seconds a connection waits for a locked database before giving up."""
+    return _pool_options["busy_timeout"] / 1000
+
+def configure_shards(files):
+    """Register the tenant shards, a {name: database file} mapping."""
+    _shard_files.clear()
+    _shard_files.update(files)
+
+def shard_files():
+    return dict(_shard_files)
+
+def shard_names():
+    return sorted(_shard_files)
+
+def current_shard():
+    return getattr(_local, "shard", None)
+
+@contextmanager
+def use_shard(name):
+    """Send this thread's queries inside the block to shard ``name`` (None: the default file)."""
+    if name is not None and name not in _shard_files:
+        raise LookupError(f"unknown tenant {name!r}")
+    previous = current_shard()
+    if name != previous and (getattr(_local, "connection", None) or getattr(_local, "reader", None)):
+        raise RuntimeError("cannot switch shards while holding a connection")
+    _local.shard = name
+    try:
+        if name is not None and name not in _shards:
+            _open_shard(name)
+        yield
+    finally:
+        _local.shard = previous
+
+# Cached entries are kept apart per shard
+cache.configure(new_scope=current_shard)
+
+def _open_shard(name):
+    with _shard_lock:
+        if name in _shards:
+            return
+        database_file = _shard_files[name]
+        _shards[name] = (
+            ConnectionPool(database_file, size=1, **_pool_options),
+            ConnectionPool(database_file, size=SHARD_POOL_SIZE, read_only=True, **_pool_options),
         )
-    """)
-    
-    # Create Position table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Position (
-            PositionID INTEGER PRIMARY KEY,
-            PositionName TEXT,
-            DepartmentID INTEGER,
-            FOREIGN KEY (DepartmentID) REFERENCES Department(DepartmentID)
+        try:
+            create_tables()
+            run_backfills()
+        except Exception:
+            for opened in _shards.pop(name):
+                opened.close()
+            raise
+
+def _pools():
+    """(writer, readers, replica) pools of this thread's shard."""
+    name = current_shard()
+    if name is None:
+        return pool, read_pool, replica_pool
+    writer, readers = _shards[name]
+    return writer, readers, None
+
+def run_backfills(chunk_size=migrations.BACKFILL_CHUNK_SIZE, pause=0.0, progress=None):
+    """Run the pending data backfills to completion, one transaction per chunk.
+
+    Other connections can write between chunks; ``pause`` seconds of sleep
+    after each chunk leave them more room. Returns the number of chunks.
+    """
+    chunks = 0
+    while True:
+        with transaction() as connection:
+            cursor = connection.cursor()
+            if not connection.in_transaction:
+                cursor.execute("BEGIN IMMEDIATE")
+            step = migrations.backfill_step(cursor, chunk_size)
+            if step is not None:
+                tables_changed(*(table for name, table, _, _ in migrations.BACKFILLS if name == step[0]))
+        if step is None:
+            return chunks
+        chunks += 1
+        if progress is not None:
+            progress(*step)
+        if pause:
+            time.sleep(pause)
+
+# Read routes: "primary" reads through the writer, "reader" on a read-only
+# WAL connection that sees everything committed before the read began, and
+# "replica" on the replica file while it is fresh enough, else on a reader.
+# In WAL mode neither kind of reader blocks a writer or waits for one.
+ROUTE_NAMES = ("primary", "reader", "replica")
+READ_ROUTE = os.environ.get("EMS_DB_READ_ROUTE", "reader")
+# Route of each @reads function by name; EMS_DB_ROUTES="name=route,..." adds to it
+ROUTES = {
+    "get_department_month": "replica",
+    "get_employee_month": "replica",
+    "get_daily_totals": "replica",
+    "export_table": "replica",
+}
+ROUTES.update(
+    (name.strip(), value.strip())
+    for name, _, value in (pair.partition("=") for pair in os.environ.get("EMS_DB_ROUTES", "").split(","))
+    if name.strip()
+)
+
+@contextmanager
+def route(name):
+    """Send reads on this thread inside the block to route ``name``."""
+    if name not in ROUTE_NAMES:
+        raise ValueError(f"unknown route {name!r}, expected one of {', '.join(ROUTE_NAMES)}")
+    previous = getattr(_local, "route", None)
+    _local.route = name
+    try:
+        yield
+    finally:
+        _local.route = previous
+
+def current_route():
+    return getattr(_local, "route", None) or READ_ROUTE
+
+def reads(function):
+    """Run ``function`` on the route ROUTES gives its name, READ_ROUTE if none."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with route(ROUTES.get(function.__name__, READ_ROUTE)):
+            return function(*args, **kwargs)
+    return wrapper
+
+@contextmanager
+def get_connection(route=None):
+    # Nested calls on the same thread reuse the connection already checked
+    # out; once this thread holds the writer every read uses it, so a
+    # transaction sees its own writes
+    conn = getattr(_local, "connection", None)
+    if conn is not None:
+        yield conn
+        return
+    route = route or current_route()
+    writer, readers, replica = _pools()
+    if route == "primary":
+        conn = writer.acquire()
+        _local.connection = conn
+        try:
+            yield conn
+        finally:
+            _local.connection = None
+            writer.release(conn)
+        return
+    conn = getattr(_local, "reader", None)
+    if conn is not None:
+        yield conn
+        return
+    source = replica if replica is not None and route == "replica" and replica_fresh() else readers
+    conn = source.acquire()
+    _local.reader = conn
+    try:
+        yield conn
+    finally:
+        _local.reader = None
+        source.release(conn)
+
+@contextmanager
+def transaction():
+    with get_connection("primary") as connection:
+        depth = getattr(_local, "tx_depth", 0)
+        _local.tx_depth = depth + 1
+        if depth == 0:
+            _local.after_commit = []
+        try:
+            yield connection
+            if depth == 0:
+                connection.commit()
+        except Exception:
+            if depth == 0:
+                connection.rollback()
+            raise
+        finally:
+            _local.tx_depth = depth
+        if depth == 0:
+            callbacks, _local.after_commit = _local.after_commit, []
+            for callback in callbacks:
+                callback()
+
+def in_transaction():
+    return getattr(_local, "tx_depth", 0) > 0
+
+def after_commit(callback):
+    # Run once the outermost transaction commits, or now outside of one
+    if in_transaction():
+        _local.after_commit.append(callback)
+    else:
+        callback()
+
+def invalidate_cache(*keys):
+    after_commit(lambda: cache.invalidate(*keys))
+
+# Seconds a cached change counter is trusted. Writes through this module
+# drop it as they commit; writes from other processes (with the local cache
+# backend) or from raw SQL show up once it expires
+VERSION_TTL = int(os.environ.get("EMS_VERSION_TTL", "2"))
+
+def data_versions(tables):
+    """Return the table_version counters of ``tables`` as a tuple, cached."""
+    return tuple(
+        cache.get_or_load(f"version:{table}", lambda table=table: get_table_versions((table,))[table][0], VERSION_TTL)
+        for table in tables
+    )
+
+# Called as listener(table, keys) after a write to ``table`` commits; keys
+# are the primary keys written, or None when they are not known
+_change_listeners = []
+
+def on_change(listener):
+    _change_listeners.append(listener)
+    return listener
+
+def _notify(table, keys):
+    for listener in _change_listeners:
+        listener(table, keys)
+
+def tables_changed(*tables):
+    invalidate_cache(*(f"version:{table}" for table in tables))
+    for table in tables:
+        after_commit(lambda table=table: _notify(table, None))
+
+def rows_changed(table, *keys):
+    invalidate_cache(f"version:{table}")
+    after_commit(lambda: _notify(table, keys))
+
+def pool_stats():
+    """Return the stats of each open pool by route."""
+    pools = {"primary": pool, "reader": read_pool, "replica": replica_pool}
+    for name, (writer, readers) in list(_shards.items()):
+        pools.update({f"{name}/primary": writer, f"{name}/reader": readers})
+    return {name: opened.stats() for name, opened in pools.items() if opened is not None}
+
+# Replica file
+REPLICA_PAGES_PER_STEP = 1024
+_replica = None
+_replica_lock = threading.Lock()
+
+def _read_stamp(replica):
+    try:
+        with open(replica["file"] + ".refreshed", encoding="utf-8") as stamp:
+            return float(stamp.read())
+    except (OSError, ValueError):
+        return None
+
+def replica_age():
+    """Seconds since the replica's data was read from the primary; None without one."""
+    replica = _replica
+    if replica is None:
+        return None
+    _start_replica_refresher(replica)
+    now = time.time()
+    # Re-read the stamp, which another process may have moved on, once a second
+    if now - replica["checked"] >= 1.0:
+        replica["refreshed"], replica["checked"] = _read_stamp(replica), now
+    refreshed = replica["refreshed"]
+    return None if refreshed is None else max(now - refreshed, 0.0)
+
+def replica_fresh():
+    age = replica_age()
+    if age is None:
+        return False
+    return _replica["max_staleness"] is None or age <= _replica["max_staleness"]
+
+def refresh_replica(replica=None):
+    """Copy the primary into the replica file with the backup API; return its time."""
+    replica = replica or _replica
+    source = sqlite3.connect(replica["source"], timeout=replica["busy_timeout"])
+    target = sqlite3.connect(replica["file"], timeout=replica["busy_timeout"])
+    try:
+        # One read transaction gives a consistent copy without blocking writers
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        refreshed = time.time()
+        source.backup(target, pages=REPLICA_PAGES_PER_STEP)
+        source.rollback()
+    finally:
+        source.close()
+        target.close()
+    stamp_file = replica["file"] + ".refreshed"
+    with open(stamp_file + ".tmp", "w", encoding="utf-8") as stamp:
+        stamp.write(repr(refreshed))
+    os.replace(stamp_file + ".tmp", stamp_file)
+    replica["refreshed"], replica["checked"] = refreshed, time.time()
+    return refreshed
+
+def _refresh_replica_forever(replica):
+    while _replica is replica:
+        wait = replica["interval"]
+        refreshed = _read_stamp(replica)
+        age = None if refreshed is None else time.time() - refreshed
+        if age is not None and age < wait * 0.9:
+            # Another process sharing the replica file refreshed it recently
+            wait -= age
+        else:
+            try:
+                refresh_replica(replica)
+            except (OSError, sqlite3.Error) as error:
+                print(f"replica refresh failed: {error}", file=sys.stderr)
+        time.sleep(wait)
+
+def _start_replica_refresher(replica):
+    # One refresher thread per process, restarted in a forked worker
+    if replica["pid"] != os.getpid():
+        with _replica_lock:
+            if replica["pid"] != os.getpid():
+                replica["pid"] = os.getpid()
+                threading.Thread(target=_refresh_replica_forever, args=(replica,), name="ems-replica", daemon=True).start()
+
+QUERY_WORKERS = 4
+_query_executor = None
+_query_executor_pid = None
+_query_executor_lock = threading.Lock()
+
+def gather(*calls):
+    """Run independent zero-argument reads concurrently and return their results in order.
+
+    Each call runs on its own pooled connection. Inside a transaction, or
+    when this thread already holds a connection, the calls run in turn so
+    they see the same connection.
+    """
+    global _query_executor, _query_executor_pid
+    if len(calls) < 2 or getattr(_local, "connection", None) is not None:
+        return [call() for call in calls]
+    if _query_executor_pid != os.getpid():
+        with _query_executor_lock:
+            if _query_executor_pid != os.getpid():
+                _query_executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="ems-query")
+                _query_executor_pid = os.getpid()
+    shard = current_shard()
+
+    def on_shard(call):
+        with use_shard(shard):
+            return call()
+    futures = [_query_executor.submit(on_shard, call) for call in calls[1:]]
+    first = calls[0]()
+    return [first] + [future.result() for future in futures]
+
+@reads
+def get_by_ids(table, ids):
+    """Return the rows of ``table`` whose key is in ``ids``, in that order.
+
+    Project keys are (EmployeeID, TeamID) pairs. The ids travel as a single
+    JSON parameter, so any number fits in one statement.
+    """
+    if table not in KEYS:
+        raise ValueError(f"unknown table {table!r}")
+    columns = KEYS[table]
+    ids = [tuple(key) if len(columns) > 1 else (key,) for key in ids]
+    if len(columns) > 1:
+        selector = ", ".join(f"json_extract(value, '$[{i}]')" for i in range(len(columns)))
+        match = f"({', '.join(columns)}) IN (SELECT {selector} FROM json_each(?))"
+        parameter = json.dumps([list(key) for key in ids])
+    else:
+        match = f"{columns[0]} IN (SELECT value FROM json_each(?))"
+        parameter = json.dumps([key[0] for key in ids])
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(f"SELECT * FROM {table} WHERE {match}", (parameter,))
+        rows = {tuple(row[column] for column in columns): dict(row) for row in cursor.fetchall()}
+    return [rows[key] for key in ids if key in rows]
+
+@reads
+def get_table_versions(tables):
+    """Return {table: (change counter, unix time of last change)}."""
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            f"SELECT TableName, Version, ModifiedAt FROM table_version WHERE TableName IN ({', '.join('?' * len(tables))})",
+            list(tables),
         )
-    """)
-    
-    # Create Attendance table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Attendance (
-            AttendanceID INTEGER PRIMARY KEY,
-            EmployeeID INTEGER,
-            Date DATE,
-            Status TEXT
+        return {row["TableName"]: (row["Version"], row["ModifiedAt"]) for row in cursor.fetchall()}
+
+# Keyset pagination helpers
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, binascii.Error):
+        raise ValueError("invalid cursor")
+    if not isinstance(values, list):
+        raise ValueError("invalid cursor")
+    return values
+
+def fetch_page(columns, source, keys, sorts, filters=(), sort=None, order="asc", after=None, limit=PAGE_SIZE,
+               stream=False, row_keys=False):
+    """Return one page of ``SELECT columns FROM source`` ordered by ``sort``.
+
+    ``keys`` are the primary-key expressions used as a tie-breaker, ``sorts``
+    maps the allowed sort names to SQL expressions and ``filters`` is a list
+    of ``(clause, value)`` pairs; clauses whose value is None are skipped.
+    The page is located with a row-value comparison against ``after`` so the
+    cost does not grow with the page number.
+
+    With ``stream=True`` there is no limit: ``rows`` is a generator over
+    every row after ``after``, read STREAM_CHUNK_SIZE rows at a time.
+    With ``row_keys=True`` each row keeps its ordering values under
+    ``_keys``; encode_cursor(row["_keys"]) resumes after that row.
+    """
+    sort = sort or next(iter(sorts))
+    if sort not in sorts:
+        raise ValueError(f"cannot sort by {sort!r}")
+    if order not in ("asc", "desc"):
+        raise ValueError(f"invalid sort order {order!r}")
+    limit = max(1, min(int(limit or PAGE_SIZE), MAX_PAGE_SIZE))
+
+    sort_expr = sorts[sort]
+    order_exprs = list(keys)
+    if sort_expr not in keys:
+        order_exprs.insert(0, f"IFNULL({sort_expr}, '')")
+
+    where = []
+    params = []
+    for clause, value in filters:
+        if value is None or value == "":
+            continue
+        where.append(clause)
+        params.append(value)
+    if after:
+        values = decode_cursor(after)
+        if len(values) != len(order_exprs):
+            raise ValueError("invalid cursor")
+        comparison = "<" if order == "desc" else ">"
+        where.append(
+            f"({', '.join(order_exprs)}) {comparison} ({', '.join('?' * len(values))})"
         )
-    """)
+        params.extend(values)
+
+    key_columns = ", ".join(f"{expr} AS _key{i}" for i, expr in enumerate(order_exprs))
+    direction = " DESC" if order == "desc" else ""
+    sql = f"SELECT {columns}, {key_columns} FROM {source}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY " + ", ".join(expr + direction for expr in order_exprs)
+    if stream:
+        return {"rows": _stream_rows(sql, params, len(order_exprs), current_route()), "next_cursor": None, "limit": None}
+    sql += " LIMIT ?"
+    params.append(limit + 1)
+
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        rows = [dict(row) for row in cursor.fetchall()]
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor([last[f"_key{i}"] for i in range(len(order_exprs))])
+    for row in rows:
+        values = [row.pop(f"_key{i}") for i in range(len(order_exprs))]
+        if row_keys:
+            row["_keys"] = values
+    return {"rows": rows, "next_cursor": next_cursor, "limit": limit}
+
+STREAM_CHUNK_SIZE = 500
+
+def _stream_rows(sql, params, key_count, route):
+    # The pooled connection is held until the generator is exhausted or closed
+    with get_connection(route) as connection:
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        while True:
+            chunk = cursor.fetchmany(STREAM_CHUNK_SIZE)
+            if not chunk:
+                return
+            for row in chunk:
+                row = dict(row)
+                for i in range(key_count):
+                    del row[f"_key{i}"]
+                yield row
+
+# Tables created by create_tables(), parents first
+TABLES = ("Department", "Position", "Employee_details", "Attendance", "Leave", "Project", "Payroll")
+# Primary key columns of each table in TABLES
+KEYS = {
+    "Department": ("DepartmentID",),
+    "Position": ("PositionID",),
+    "Employee_details": ("EmployeeID",),
+    "Attendance": ("AttendanceID",),
+    "Leave": ("LeaveID",),
+    "Project": ("EmployeeID", "TeamID"),
+    "Payroll": ("PayrollID",),
+}
+
+def create_tables():
+    with transaction() as connection:
+        cursor = connection.cursor()
     
-    # Create Leave table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Leave (
-            LeaveID INTEGER PRIMARY KEY,
-            EmployeeID INTEGER,
-            StartDate DATE,
-            EndDate DATE,
-            Reason TEXT,
-            Status TEXT
-        )
-    """)
+        # Create Department table
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS Department (
+                DepartmentID INTEGER PRIMARY KEY,
+                DeptName TEXT,
+                Location TEXT
+            )
+        """)
     
-    # Create Project table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Project (
-            EmployeeID INTEGER,
-            TeamID INTEGER,
-            ProjectID TEXT UNIQUE,
-            Task TEXT,
-            Status TEXT,
-            Sprint INTEGER,
-            PRIMARY KEY (EmployeeID, TeamID)
-        )
-    """)
+        # Create Position table
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS Position (
+                PositionID INTEGER PRIMARY KEY,
+                PositionName TEXT,
+                DepartmentID INTEGER,
+                FOREIGN KEY (DepartmentID) REFERENCES Department(DepartmentID)
+            )
+        """)
     
-    # Create Payroll table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Payroll (
-            PayrollID INTEGER PRIMARY KEY,
-            EmployeeID INTEGER,
-            Month TEXT,
-            BasicPay DECIMAL(10,2),
-            Deductions DECIMAL(10,2),
-            Netpay DECIMAL(10,2)
-        )
-    """)
+        # Create Attendance table
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS Attendance (
+                AttendanceID INTEGER PRIMARY KEY,
+                EmployeeID INTEGER,
+                Date DATE,
+                Status TEXT
+            )
+        """)
     
-    # Create Employee_details table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Employee_details (
-            EmployeeID INTEGER PRIMARY KEY,
-            EmployeeName TEXT,
-            HireDate DATE,
-            Experience TEXT,
-            Position TEXT,
-            Gender TEXT,
-            DepartmentID INTEGER,
-            Email TEXT,
-            Phone TEXT,
-            Status TEXT,
-            DOB TEXT,
-            Salary TEXT,
-            TeamID INTEGER,
-            FOREIGN KEY (DepartmentID) REFERENCES Department(DepartmentID),
-            FOREIGN KEY (Position) REFERENCES Position(PositionName)
-        )
-    """)
+        # Create Leave table
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS Leave (
+                LeaveID INTEGER PRIMARY KEY,
+                EmployeeID INTEGER,
+                StartDate DATE,
+                EndDate DATE,
+                Reason TEXT,
+                Status TEXT
+            )
+        """)
+    
+        # Create Project table
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS Project (
+                EmployeeID INTEGER,
+                TeamID INTEGER,
+                ProjectID TEXT UNIQUE,
+                Task TEXT,
+                Status TEXT,
+                Sprint INTEGER,
+                PRIMARY KEY (EmployeeID, TeamID)
+            )
+        """)
     
-    connection.commit()
+        # Create Payroll table
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS Payroll (
+                PayrollID INTEGER PRIMARY KEY,
+                EmployeeID INTEGER,
+                Month TEXT,
+                BasicPay DECIMAL(10,2),
+                Deductions DECIMAL(10,2),
+                Netpay DECIMAL(10,2)
+            )
+        """)
+    
+        # Create Employee_details table
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS Employee_details (
+                EmployeeID INTEGER PRIMARY KEY,
+                EmployeeName TEXT,
+                HireDate DATE,
+                Experience TEXT,
+                Position TEXT,
+                Gender TEXT,
+                DepartmentID INTEGER,
+                Email TEXT,
+                Phone TEXT,
+                Status TEXT,
+                DOB TEXT,
+                Salary TEXT,
+                TeamID INTEGER,
+                FOREIGN KEY (DepartmentID) REFERENCES Department(DepartmentID),
+                FOREIGN KEY (Position) REFERENCES Position(PositionName)
+            )
+        """)
+
+        # Indexes and later schema changes
+        migrations.migrate(connection)
 
 # Employee CRUD operations
+@cache.cached("employees", bypass=in_transaction)
+@reads
 def get_employees():
-    cursor = connection.cursor()
-    cursor.execute("""
-        SELECT e.*, d.DeptName, p.PositionName 
-        FROM Employee_details e
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT e.*, d.DeptName, p.PositionName 
+            FROM Employee_details e
+            LEFT JOIN Department d ON e.DepartmentID = d.DepartmentID
+            LEFT JOIN Position p ON e.PositionID = p.PositionID
+        """)
+        employees = cursor.fetchall()
+        return [dict(emp) for emp in employees]
+
+@reads
+def get_employee_page(department_id=None, position=None, position_id=None, status=None, team_id=None, **page):
+    return fetch_page(
+        "e.*, d.DeptName, p.PositionName",
+        """Employee_details e
         LEFT JOIN Department d ON e.DepartmentID = d.DepartmentID
-        LEFT JOIN Position p ON e.Position = p.PositionName
-    """)
-    employees = cursor.fetchall()
-    return [dict(emp) for emp in employees]
+        LEFT JOIN Position p ON e.PositionID = p.PositionID""",
+        keys=["e.EmployeeID"],
+        sorts={
+            "id": "e.EmployeeID", "name": "e.EmployeeName",
+            "hire_date": "e.HireDate", "department": "d.DeptName",
+        },
+        filters=[
+            ("e.DepartmentID = ?", department_id),
+            ("e.PositionID IN (SELECT PositionID FROM Position WHERE PositionName = ?)", position),
+            ("e.PositionID = ?", position_id),
+            ("e.Status = ?", status), ("e.TeamID = ?", team_id),
+        ],
+        **page
+    )
+
+SEARCH_LIMIT = 10
+FUZZY_CANDIDATES = 100
+
+def _search_terms(query):
+    return re.findall(r"\w+", query.lower())
+
+@reads
+def search_employees(query, limit=SEARCH_LIMIT):
+    """Return up to ``limit`` employees matching ``query`` for a typeahead.
 
+    Every word in the query must prefix-match the name, email or phone. If
+    that finds fewer than ``limit`` rows, names and emails sharing trigrams
+    with the query are ranked by similarity to catch typos. FTS5's bm25
+    ``rank`` is not used: it scores every match, which costs tens of ms for
+    a one-letter prefix at 100k employees, while LIMIT without it stops
+    after the first few postings.
+    """
+    terms = _search_terms(query)
+    if not terms:
+        return []
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT e.EmployeeID, e.EmployeeName, e.Email, e.Phone
+            FROM employee_search s
+            JOIN Employee_details e ON e.EmployeeID = s.rowid
+            WHERE employee_search MATCH ?
+            LIMIT ?
+        """, (" ".join(f'"{term}"*' for term in terms), limit))
+        matches = [dict(row) for row in cursor.fetchall()]
+        # Names starting with the query read better than email/phone hits
+        matches.sort(key=lambda m: not (m["EmployeeName"] or "").lower().startswith(terms[0]))
+
+        trigrams = {
+            word[i:i + 3] for word in terms if len(word) >= 3 for i in range(len(word) - 2)
+        }
+        if len(matches) >= limit or not trigrams:
+            return matches
+        cursor.execute("""
+            SELECT e.EmployeeID, e.EmployeeName, e.Email, e.Phone
+            FROM employee_trigram t
+            JOIN Employee_details e ON e.EmployeeID = t.rowid
+            WHERE employee_trigram MATCH ?
+            LIMIT ?
+        """, (" OR ".join(f'"{gram}"' for gram in sorted(trigrams)), FUZZY_CANDIDATES))
+        candidates = [dict(row) for row in cursor.fetchall()]
+
+    seen = {match["EmployeeID"] for match in matches}
+    needle = " ".join(terms)
+
+    def similarity(employee):
+        return max(
+            difflib.SequenceMatcher(None, needle, (value or "").lower()).ratio()
+            for value in (employee["EmployeeName"], employee["Email"])
+        )
+
+    candidates = [c for c in candidates if c["EmployeeID"] not in seen]
+    candidates.sort(key=similarity, reverse=True)
+    return matches + candidates[:limit - len(matches)]
+
+@reads
 def get_employee(id):
-    cursor = connection.cursor()
-    cursor.execute("""
-        SELECT e.*, d.DeptName, p.PositionName 
-        FROM Employee_details e
-        LEFT JOIN Department d ON e.DepartmentID = d.DepartmentID
-        LEFT JOIN Position p ON e.Position = p.PositionName
-        WHERE e.EmployeeID = ?
-    """, (id,))
-    employee = cursor.fetchone()
-    return dict(employee) if employee else None
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT e.*, d.DeptName, p.PositionName 
+            FROM Employee_details e
+            LEFT JOIN Department d ON e.DepartmentID = d.DepartmentID
+            LEFT JOIN Position p ON e.PositionID = p.PositionID
+            WHERE e.EmployeeID = ?
+        """, (id,))
+        employee = cursor.fetchone()
+        return dict(employee) if employee else None
+
+def _employee_values(cursor, data):
+    # The typed columns are parsed from the submitted text, which is kept in
+    # the text columns; the position may be given by id or by name
+    position_id, position = data.get("PositionID") or None, data.get("Position") or None
+    if position_id is not None:
+        cursor.execute("SELECT PositionID, PositionName FROM Position WHERE PositionID = ?", (position_id,))
+    elif position is not None:
+        cursor.execute("""
+            SELECT PositionID, PositionName FROM Position WHERE PositionName = ?
+            ORDER BY DepartmentID IS NOT ?, PositionID LIMIT 1
+        """, (position, data["DepartmentID"]))
+    if position_id is not None or position is not None:
+        found = cursor.fetchone()
+        if found is None:
+            raise ValueError(f"unknown position {position_id or position!r}")
+        position_id, position = found
+    return (
+        data["EmployeeName"], conversions.iso_date(data["HireDate"]), data["Experience"],
+        position, data["Gender"], data["DepartmentID"],
+        data["Email"], data["Phone"], data["Status"],
+        conversions.iso_date(data["DOB"]), data["Salary"], data["TeamID"],
+        position_id, conversions.cents(data["Salary"]), conversions.experience_months(data["Experience"]),
+    )
 
 def create_employee(data):
-    cursor = connection.cursor()
-    cursor.execute("""
-        INSERT INTO Employee_details (
-            EmployeeName, HireDate, Experience, Position, Gender, 
-            DepartmentID, Email, Phone, Status, DOB, Salary, TeamID
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        data["EmployeeName"], data["HireDate"], data["Experience"], 
-        data["Position"], data["Gender"], data["DepartmentID"], 
-        data["Email"], data["Phone"], data["Status"], 
-        data["DOB"], data["Salary"], data["TeamID"]
-    ))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO Employee_details (
+                EmployeeName, HireDate, Experience, Position, Gender, 
+                DepartmentID, Email, Phone, Status, DOB, Salary, TeamID,
+                PositionID, SalaryCents, ExperienceMonths
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, _employee_values(cursor, data))
+        invalidate_cache("employees")
+        rows_changed("Employee_details", cursor.lastrowid)
 
 def update_employee(id, data):
-    cursor = connection.cursor()
-    cursor.execute("""
-        UPDATE Employee_details SET 
-            EmployeeName = ?, HireDate = ?, Experience = ?, Position = ?, 
-            Gender = ?, DepartmentID = ?, Email = ?, Phone = ?, 
-            Status = ?, DOB = ?, Salary = ?, TeamID = ?
-        WHERE EmployeeID = ?
-    """, (
-        data["EmployeeName"], data["HireDate"], data["Experience"], 
-        data["Position"], data["Gender"], data["DepartmentID"], 
-        data["Email"], data["Phone"], data["Status"], 
-        data["DOB"], data["Salary"], data["TeamID"], id
-    ))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE Employee_details SET 
+                EmployeeName = ?, HireDate = ?, Experience = ?, Position = ?, 
+                Gender = ?, DepartmentID = ?, Email = ?, Phone = ?, 
+                Status = ?, DOB = ?, Salary = ?, TeamID = ?,
+                PositionID = ?, SalaryCents = ?, ExperienceMonths = ?
+            WHERE EmployeeID = ?
+        """, _employee_values(cursor, data) + (id,))
+        invalidate_cache("employees")
+        rows_changed("Employee_details", id)
 
 def delete_employee(id):
-    cursor = connection.cursor()
-    cursor.execute("DELETE FROM Employee_details WHERE EmployeeID = ?", (id,))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM Employee_details WHERE EmployeeID = ?", (id,))
+        invalidate_cache("employees")
+        rows_changed("Employee_details", id)
 
 # Department CRUD operations
+@cache.cached("departments", bypass=in_transaction)
+@reads
 def get_departments():
-    cursor = connection.cursor()
-    cursor.execute("SELECT * FROM Department")
-    return [dict(dept) for dept in cursor.fetchall()]
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT * FROM Department")
+        return [dict(dept) for dept in cursor.fetchall()]
+
+@reads
+def get_department_page(location=None, **page):
+    return fetch_page(
+        "*", "Department",
+        keys=["DepartmentID"],
+        sorts={"id": "DepartmentID", "name": "DeptName", "location": "Location"},
+        filters=[("Location = ?", location)],
+        **page
+    )
 
+@reads
 def get_department(id):
-    cursor = connection.cursor()
-    cursor.execute("SELECT * FROM Department WHERE DepartmentID = ?", (id,))
-    dept = cursor.fetchone()
-    return dict(dept) if dept else None
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT * FROM Department WHERE DepartmentID = ?", (id,))
+        dept = cursor.fetchone()
+        return dict(dept) if dept else None
 
 def create_department(data):
-    cursor = connection.cursor()
-    cursor.execute("""
-        INSERT INTO Department (DeptName, Location) 
-        VALUES (?, ?)
-    """, (data["DeptName"], data["Location"]))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO Department (DeptName, Location) 
+            VALUES (?, ?)
+        """, (data["DeptName"], data["Location"]))
+        invalidate_cache("departments", "employees")
+        rows_changed("Department", cursor.lastrowid)
 
 def update_department(id, data):
-    cursor = connection.cursor()
-    cursor.execute("""
-        UPDATE Department SET 
-            DeptName = ?, Location = ?
-        WHERE DepartmentID = ?
-    """, (data["DeptName"], data["Location"], id))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE Department SET 
+                DeptName = ?, Location = ?
+            WHERE DepartmentID = ?
+        """, (data["DeptName"], data["Location"], id))
+        invalidate_cache("departments", "employees")
+        rows_changed("Department", id)
 
 def delete_department(id):
-    cursor = connection.cursor()
-    cursor.execute("DELETE FROM Department WHERE DepartmentID = ?", (id,))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM Department WHERE DepartmentID = ?", (id,))
+        invalidate_cache("departments", "employees")
+        rows_changed("Department", id)
 
 # Position CRUD operations
+@cache.cached("positions", bypass=in_transaction)
+@reads
 def get_positions():
-    cursor = connection.cursor()
-    cursor.execute("SELECT * FROM Position")
-    return [dict(pos) for pos in cursor.fetchall()]
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT * FROM Position")
+        return [dict(pos) for pos in cursor.fetchall()]
 
+@reads
+def get_position_page(department_id=None, **page):
+    return fetch_page(
+        "*", "Position",
+        keys=["PositionID"],
+        sorts={"id": "PositionID", "name": "PositionName"},
+        filters=[("DepartmentID = ?", department_id)],
+        **page
+    )
+
+@reads
 def get_position(id):
-    cursor = connection.cursor()
-    cursor.execute("SELECT * FROM Position WHERE PositionID = ?", (id,))
-    pos = cursor.fetchone()
-    return dict(pos) if pos else None
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT * FROM Position WHERE PositionID = ?", (id,))
+        pos = cursor.fetchone()
+        return dict(pos) if pos else None
 
 def create_position(data):
-    cursor = connection.cursor()
-    cursor.execute("""
-        INSERT INTO Position (PositionName, DepartmentID) 
-        VALUES (?, ?)
-    """, (data["PositionName"], data["DepartmentID"]))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO Position (PositionName, DepartmentID) 
+            VALUES (?, ?)
+        """, (data["PositionName"], data["DepartmentID"]))
+        invalidate_cache("positions", "employees")
+        rows_changed("Position", cursor.lastrowid)
 
 def update_position(id, data):
-    cursor = connection.cursor()
-    cursor.execute("""
-        UPDATE Position SET 
-            PositionName = ?, DepartmentID = ?
-        WHERE PositionID = ?
-    """, (data["PositionName"], data["DepartmentID"], id))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE Position SET 
+                PositionName = ?, DepartmentID = ?
+            WHERE PositionID = ?
+        """, (data["PositionName"], data["DepartmentID"], id))
+        invalidate_cache("positions", "employees")
+        rows_changed("Position", id)
 
 def delete_position(id):
-    cursor = connection.cursor()
-    cursor.execute("DELETE FROM Position WHERE PositionID = ?", (id,))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM Position WHERE PositionID = ?", (id,))
+        invalidate_cache("positions", "employees")
+        rows_changed("Position", id)
 
 # Attendance CRUD operations
+@reads
 def get_attendances():
-    cursor = connection.cursor()
-    cursor.execute("""
-        SELECT a.*, e.EmployeeName 
-        FROM Attendance a
-        LEFT JOIN Employee_details e ON a.EmployeeID = e.EmployeeID
-    """)
-    return [dict(att) for att in cursor.fetchall()]
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT a.*, e.EmployeeName 
+            FROM Attendance a
+            LEFT JOIN Employee_details e ON a.EmployeeID = e.EmployeeID
+        """)
+        return [dict(att) for att in cursor.fetchall()]
+
+@reads
+def get_attendance_page(employee_id=None, date_from=None, date_to=None, status=None, **page):
+    return fetch_page(
+        "a.*, e.EmployeeName",
+        "Attendance a LEFT JOIN Employee_details e ON a.EmployeeID = e.EmployeeID",
+        keys=["a.AttendanceID"],
+        sorts={"id": "a.AttendanceID", "date": "a.Date", "employee": "e.EmployeeName"},
+        filters=[
+            ("a.EmployeeID = ?", employee_id), ("a.Date >= ?", date_from),
+            ("a.Date <= ?", date_to), ("a.Status = ?", status),
+        ],
+        **page
+    )
 
+@reads
 def get_attendance(id):
-    cursor = connection.cursor()
-    cursor.execute("SELECT * FROM Attendance WHERE AttendanceID = ?", (id,))
-    att = cursor.fetchone()
-    return dict(att) if att else None
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT * FROM Attendance WHERE AttendanceID = ?", (id,))
+        att = cursor.fetchone()
+        return dict(att) if att else None
 
 def create_attendance(data):
-    cursor = connection.cursor()
-    cursor.execute("""
-        INSERT INTO Attendance (EmployeeID, Date, Status) 
-        VALUES (?, ?, ?)
-    """, (data["EmployeeID"], data["Date"], data["Status"]))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO Attendance (EmployeeID, Date, Status) 
+            VALUES (?, ?, ?)
+        """, (data["EmployeeID"], data["Date"], data["Status"]))
+        rows_changed("Attendance", cursor.lastrowid)
+
+def create_attendances(rows):
+    """Insert ``rows`` in one transaction and return an AttendanceID or exception per row.
+
+    Each row runs under its own savepoint, so a row that fails is rolled
+    back alone and the rest still commit.
+    """
+    results = []
+    with transaction() as connection:
+        cursor = connection.cursor()
+        if not connection.in_transaction:
+            cursor.execute("BEGIN")
+        for data in rows:
+            cursor.execute("SAVEPOINT attendance_row")
+            try:
+                cursor.execute("""
+                    INSERT INTO Attendance (EmployeeID, Date, Status)
+                    VALUES (?, ?, ?)
+                """, (data["EmployeeID"], data["Date"], data["Status"]))
+                results.append(cursor.lastrowid)
+            except (KeyError, sqlite3.Error) as error:
+                cursor.execute("ROLLBACK TO attendance_row")
+                results.append(error)
+            cursor.execute("RELEASE attendance_row")
+        rows_changed("Attendance", *(result for result in results if not isinstance(result, Exception)))
+    return results
 
 def update_attendance(id, data):
-    cursor = connection.cursor()
-    cursor.execute("""
-        UPDATE Attendance SET 
-            EmployeeID = ?, Date = ?, Status = ?
-        WHERE AttendanceID = ?
-    """, (data["EmployeeID"], data["Date"], data["Status"], id))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE Attendance SET 
+                EmployeeID = ?, Date = ?, Status = ?
+            WHERE AttendanceID = ?
+        """, (data["EmployeeID"], data["Date"], data["Status"], id))
+        rows_changed("Attendance", id)
 
 def delete_attendance(id):
-    cursor = connection.cursor()
-    cursor.execute("DELETE FROM Attendance WHERE AttendanceID = ?", (id,))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM Attendance WHERE AttendanceID = ?", (id,))
+        rows_changed("Attendance", id)
 
 # Leave CRUD operations
+@reads
 def get_leaves():
-    cursor = connection.cursor()
-    cursor.execute("""
-        SELECT l.*, e.EmployeeName 
-        FROM Leave l
-        LEFT JOIN Employee_details e ON l.EmployeeID = e.EmployeeID
-    """)
-    return [dict(leave) for leave in cursor.fetchall()]
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT l.*, e.EmployeeName 
+            FROM Leave l
+            LEFT JOIN Employee_details e ON l.EmployeeID = e.EmployeeID
+        """)
+        return [dict(leave) for leave in cursor.fetchall()]
+
+@reads
+def get_leave_page(employee_id=None, date_from=None, date_to=None, status=None, **page):
+    # A leave matches a date range when the two intervals overlap
+    return fetch_page(
+        "l.*, e.EmployeeName",
+        "Leave l LEFT JOIN Employee_details e ON l.EmployeeID = e.EmployeeID",
+        keys=["l.LeaveID"],
+        sorts={"id": "l.LeaveID", "start_date": "l.StartDate", "employee": "e.EmployeeName"},
+        filters=[
+            ("l.EmployeeID = ?", employee_id), ("l.EndDate >= ?", date_from),
+            ("l.StartDate <= ?", date_to), ("l.Status = ?", status),
+        ],
+        **page
+    )
 
+@reads
 def get_leave(id):
-    cursor = connection.cursor()
-    cursor.execute("SELECT * FROM Leave WHERE LeaveID = ?", (id,))
-    leave = cursor.fetchone()
-    return dict(leave) if leave else None
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT * FROM Leave WHERE LeaveID = ?", (id,))
+        leave = cursor.fetchone()
+        return dict(leave) if leave else None
+
+# Leave in these states no longer holds the days it asked for
+CLOSED_LEAVE_STATUSES = ("Rejected", "Cancelled")
+# Approved leave is taken: the employee is out and the days count against
+# the yearly allowance, in payroll deductions and leave balances alike
+APPROVED_LEAVE_STATUS = "Approved"
+LEAVE_ALLOWANCE_DAYS = int(os.environ.get("EMS_LEAVE_ALLOWANCE", 24))
+
+def is_approved_leave(status):
+    return (status or "").strip().lower() == APPROVED_LEAVE_STATUS.lower()
+
+def approved_leave_sql(column):
+    """SQL for is_approved_leave(``column``)."""
+    return f"lower(trim(IFNULL({column}, ''))) = '{APPROVED_LEAVE_STATUS.lower()}'"
+
+def is_closed_leave(status):
+    return (status or "").strip().lower() in {closed.lower() for closed in CLOSED_LEAVE_STATUSES}
+
+def closed_leave_sql(column):
+    """SQL for is_closed_leave(``column``)."""
+    return f"lower(trim(IFNULL({column}, ''))) IN ({', '.join(repr(closed.lower()) for closed in CLOSED_LEAVE_STATUSES)})"
+# Attendance in these states shows the employee at work that day
+WORKED_STATUSES = ("Present", "Late")
+
+def _leave_dates(cursor, data, id=None):
+    """Return the ISO (start, end) of ``data``, or raise ValueError if it clashes.
+
+    An open leave may not overlap another open leave of the same employee
+    or a day they are marked at work. Checked inside the writing
+    transaction, so two requests cannot both pass.
+    """
+    start, end = conversions.iso_date(data["StartDate"]), conversions.iso_date(data["EndDate"])
+    if start is None or end is None:
+        raise ValueError("StartDate and EndDate are required")
+    if end < start:
+        raise ValueError(f"EndDate {end} is before StartDate {start}")
+    if is_closed_leave(data["Status"]):
+        return start, end
+    cursor.execute(f"""
+        SELECT LeaveID, StartDate, EndDate FROM Leave
+        WHERE EmployeeID = ? AND StartDate <= ? AND EndDate >= ? AND LeaveID IS NOT ?
+        AND NOT {closed_leave_sql("Status")}
+        LIMIT 1
+    """, (data["EmployeeID"], end, start, id))
+    clash = cursor.fetchone()
+    if clash:
+        raise ValueError(f"overlaps leave {clash['LeaveID']} from {clash['StartDate']} to {clash['EndDate']}")
+    cursor.execute(f"""
+        SELECT Date FROM Attendance
+        WHERE EmployeeID = ? AND Date BETWEEN ? AND ? AND Status IN ({', '.join('?' * len(WORKED_STATUSES))})
+        LIMIT 1
+    """, (data["EmployeeID"], start, end) + WORKED_STATUSES)
+    worked = cursor.fetchone()
+    if worked:
+        raise ValueError(f"employee is marked at work on {worked['Date']}")
+    return start, end
 
 def create_leave(data):
-    cursor = connection.cursor()
-    cursor.execute("""
-        INSERT INTO Leave (EmployeeID, StartDate, EndDate, Reason, Status) 
-        VALUES (?, ?, ?, ?, ?)
-    """, (
-        data["EmployeeID"], data["StartDate"], data["EndDate"], 
-        data["Reason"], data["Status"]
-    ))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        start, end = _leave_dates(cursor, data)
+        cursor.execute("""
+            INSERT INTO Leave (EmployeeID, StartDate, EndDate, Reason, Status) 
+            VALUES (?, ?, ?, ?, ?)
+        """, (
+            data["EmployeeID"], start, end, 
+            data["Reason"], data["Status"]
+        ))
+        rows_changed("Leave", cursor.lastrowid)
 
 def update_leave(id, data):
-    cursor = connection.cursor()
-    cursor.execute("""
-        UPDATE Leave SET 
-            EmployeeID = ?, StartDate = ?, EndDate = ?, Reason = ?, Status = ?
-        WHERE LeaveID = ?
-    """, (
-        data["EmployeeID"], data["StartDate"], data["EndDate"], 
-        data["Reason"], data["Status"], id
-    ))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        start, end = _leave_dates(cursor, data, int(id))
+        cursor.execute("""
+            UPDATE Leave SET 
+                EmployeeID = ?, StartDate = ?, EndDate = ?, Reason = ?, Status = ?
+            WHERE LeaveID = ?
+        """, (
+            data["EmployeeID"], start, end, 
+            data["Reason"], data["Status"], id
+        ))
+        rows_changed("Leave", id)
 
 def delete_leave(id):
-    cursor = connection.cursor()
-    cursor.execute("DELETE FROM Leave WHERE LeaveID = ?", (id,))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM Leave WHERE LeaveID = ?", (id,))
+        rows_changed("Leave", id)
 
 # Project CRUD operations
+@reads
 def get_projects():
-    cursor = connection.cursor()
-    cursor.execute("""
-        SELECT p.*, e.EmployeeName 
-        FROM Project p
-        LEFT JOIN Employee_details e ON p.EmployeeID = e.EmployeeID
-    """)
-    return [dict(proj) for proj in cursor.fetchall()]
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT p.*, e.EmployeeName 
+            FROM Project p
+            LEFT JOIN Employee_details e ON p.EmployeeID = e.EmployeeID
+        """)
+        return [dict(proj) for proj in cursor.fetchall()]
+
+@reads
+def get_project_page(employee_id=None, team_id=None, status=None, **page):
+    return fetch_page(
+        "p.*, e.EmployeeName",
+        "Project p LEFT JOIN Employee_details e ON p.EmployeeID = e.EmployeeID",
+        keys=["p.EmployeeID", "p.TeamID"],
+        sorts={"id": "p.EmployeeID", "sprint": "p.Sprint", "project": "p.ProjectID"},
+        filters=[
+            ("p.EmployeeID = ?", employee_id), ("p.TeamID = ?", team_id),
+            ("p.Status = ?", status),
+        ],
+        **page
+    )
 
+@reads
 def get_project(employee_id, team_id):
-    cursor = connection.cursor()
-    cursor.execute("""
-        SELECT * FROM Project 
-        WHERE EmployeeID = ? AND TeamID = ?
-    """, (employee_id, team_id))
-    proj = cursor.fetchone()
-    return dict(proj) if proj else None
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT * FROM Project 
+            WHERE EmployeeID = ? AND TeamID = ?
+        """, (employee_id, team_id))
+        proj = cursor.fetchone()
+        return dict(proj) if proj else None
 
 def create_project(data):
-    cursor = connection.cursor()
-    cursor.execute("""
-        INSERT INTO Project (EmployeeID, TeamID, ProjectID, Task, Status, Sprint) 
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (
-        data["EmployeeID"], data["TeamID"], data["ProjectID"], 
-        data["Task"], data["Status"], data["Sprint"]
-    ))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO Project (EmployeeID, TeamID, ProjectID, Task, Status, Sprint) 
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (
+            data["EmployeeID"], data["TeamID"], data["ProjectID"], 
+            data["Task"], data["Status"], data["Sprint"]
+        ))
+        rows_changed("Project", (data["EmployeeID"], data["TeamID"]))
 
 def update_project(employee_id, team_id, data):
-    cursor = connection.cursor()
-    cursor.execute("""
-        UPDATE Project SET 
-            ProjectID = ?, Task = ?, Status = ?, Sprint = ?
-        WHERE EmployeeID = ? AND TeamID = ?
-    """, (
-        data["ProjectID"], data["Task"], data["Status"], 
-        data["Sprint"], employee_id, team_id
-    ))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE Project SET 
+                ProjectID = ?, Task = ?, Status = ?, Sprint = ?
+            WHERE EmployeeID = ? AND TeamID = ?
+        """, (
+            data["ProjectID"], data["Task"], data["Status"], 
+            data["Sprint"], employee_id, team_id
+        ))
+        rows_changed("Project", (employee_id, team_id))
 
 def delete_project(employee_id, team_id):
-    cursor = connection.cursor()
-    cursor.execute("""
-        DELETE FROM Project 
-        WHERE EmployeeID = ? AND TeamID = ?
-    """, (employee_id, team_id))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            DELETE FROM Project 
+            WHERE EmployeeID = ? AND TeamID = ?
+        """, (employee_id, team_id))
+        rows_changed("Project", (employee_id, team_id))
 
 # Payroll CRUD operations
+@reads
 def get_payrolls():
-    cursor = connection.cursor()
-    cursor.execute("""
-        SELECT p.*, e.EmployeeName 
-        FROM Payroll p
-        LEFT JOIN Employee_details e ON p.EmployeeID = e.EmployeeID
-    """)
-    return [dict(pay) for pay in cursor.fetchall()]
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT p.*, e.EmployeeName 
+            FROM Payroll p
+            LEFT JOIN Employee_details e ON p.EmployeeID = e.EmployeeID
+        """)
+        return [dict(pay) for pay in cursor.fetchall()]
 
+@reads
+def get_payroll_page(employee_id=None, month=None, month_from=None, month_to=None, **page):
+    # Months may be given as "March-2025", "2025-03" or 202503
+    month, month_from, month_to = (conversions.month_key(value) for value in (month, month_from, month_to))
+    return fetch_page(
+        "p.*, e.EmployeeName",
+        "Payroll p LEFT JOIN Employee_details e ON p.EmployeeID = e.EmployeeID",
+        keys=["p.PayrollID"],
+        sorts={"id": "p.PayrollID", "month": "p.MonthKey", "netpay": "p.NetpayCents", "employee": "e.EmployeeName"},
+        filters=[
+            ("p.EmployeeID = ?", employee_id), ("p.MonthKey = ?", month),
+            ("p.MonthKey >= ?", month_from), ("p.MonthKey <= ?", month_to),
+        ],
+        **page
+    )
+
+@reads
 def get_payroll(id):
-    cursor = connection.cursor()
-    cursor.execute("SELECT * FROM Payroll WHERE PayrollID = ?", (id,))
-    pay = cursor.fetchone()
-    return dict(pay) if pay else None
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT * FROM Payroll WHERE PayrollID = ?", (id,))
+        pay = cursor.fetchone()
+        return dict(pay) if pay else None
+
+def _payroll_values(data):
+    # Amounts are kept as integer cents and as the matching decimal amount,
+    # and the month as 202503 and as "March-2025"
+    month = conversions.month_key(data["Month"])
+    basic, deductions, netpay = (conversions.cents(data[name]) for name in ("BasicPay", "Deductions", "Netpay"))
+    return (
+        data["EmployeeID"], conversions.month_label(month), conversions.amount(basic),
+        conversions.amount(deductions), conversions.amount(netpay),
+        month, basic, deductions, netpay,
+    )
 
 def create_payroll(data):
-    cursor = connection.cursor()
-    cursor.execute("""
-        INSERT INTO Payroll (EmployeeID, Month, BasicPay, Deductions, Netpay) 
-        VALUES (?, ?, ?, ?, ?)
-    """, (
-        data["EmployeeID"], data["Month"], data["BasicPay"], 
-        data["Deductions"], data["Netpay"]
-    ))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO Payroll (
+                EmployeeID, Month, BasicPay, Deductions, Netpay,
+                MonthKey, BasicPayCents, DeductionsCents, NetpayCents
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, _payroll_values(data))
+        tables_changed("Payroll")
 
 def update_payroll(id, data):
-    cursor = connection.cursor()
-    cursor.execute("""
-        UPDATE Payroll SET 
-            EmployeeID = ?, Month = ?, BasicPay = ?, Deductions = ?, Netpay = ?
-        WHERE PayrollID = ?
-    """, (
-        data["EmployeeID"], data["Month"], data["BasicPay"], 
-        data["Deductions"], data["Netpay"], id
-    ))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE Payroll SET 
+                EmployeeID = ?, Month = ?, BasicPay = ?, Deductions = ?, Netpay = ?,
+                MonthKey = ?, BasicPayCents = ?, DeductionsCents = ?, NetpayCents = ?
+            WHERE PayrollID = ?
+        """, _payroll_values(data) + (id,))
+        tables_changed("Payroll")
 
 def delete_payroll(id):
-    cursor = connection.cursor()
-    cursor.execute("DELETE FROM Payroll WHERE PayrollID = ?", (id,))
-    connection.commit()
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM Payroll WHERE PayrollID = ?", (id,))
+        tables_changed("Payroll")
 
 # Test functions
-def setup_test_database():
-    initialize("test_ems.db")
-    cursor = connection.cursor()
+def setup_test_database(database_file="test_ems.db"):
+    # Start from a new file rather than dropping tables one by one, so
+    # tables, triggers and views added by later migrations go too
+    close()
+    for path in (database_file, database_file + "-wal", database_file + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+    initialize(database_file)
+    with transaction() as connection:
+        cursor = connection.cursor()
     
-    # Clear all tables
-    cursor.execute("DROP TABLE IF EXISTS Employee_details")
-    cursor.execute("DROP TABLE IF EXISTS Department")
-    cursor.execute("DROP TABLE IF EXISTS Position")
-    cursor.execute("DROP TABLE IF EXISTS Attendance")
-    cursor.execute("DROP TABLE IF EXISTS Leave")
-    cursor.execute("DROP TABLE IF EXISTS Project")
-    cursor.execute("DROP TABLE IF EXISTS Payroll")
-    
-    # Recreate tables
-    create_tables()
+        after_commit(cache.clear)
     
-    # Insert test data
-    # Departments
-    departments = [
-        {"DeptName": "IT", "Location": "Floor 1"},
-        {"DeptName": "HR", "Location": "Floor 2"},
-        {"DeptName": "Finance", "Location": "Floor 3"}
-    ]
-    for dept in departments:
-        create_department(dept)
+        # Insert test data
+        # Departments
+        departments = [
+            {"DeptName": "IT", "Location": "Floor 1"},
+            {"DeptName": "HR", "Location": "Floor 2"},
+            {"DeptName": "Finance", "Location": "Floor 3"}
+        ]
+        for dept in departments:
+            create_department(dept)
     
-    # Positions
-    positions = [
-        {"PositionName": "Developer", "DepartmentID": 1},
-        {"PositionName": "Manager", "DepartmentID": 1},
-        {"PositionName": "HR Specialist", "DepartmentID": 2},
-        {"PositionName": "Accountant", "DepartmentID": 3}
-    ]
-    for pos in positions:
-        create_position(pos)
-    
-    # Employees
-    employees = [
-        {
-            "EmployeeName": "John Doe", "HireDate": "2020-01-15", 
-            "Experience": "5 years", "Position": "Developer", 
-            "Gender": "Male", "DepartmentID": 1, "Email": "john@example.com",
-            "Phone": "1234567890", "Status": "Active", "DOB": "1990-05-10",
-            "Salary": "50000", "TeamID": 1
-        },
-        {
-            "EmployeeName": "Jane Smith", "HireDate": "2019-03-20", 
-            "Experience": "6 years", "Position": "Manager", 
-            "Gender": "Female", "DepartmentID": 1, "Email": "jane@example.com",
-            "Phone": "9876543210", "Status": "Active", "DOB": "1988-11-25",
-            "Salary": "70000", "TeamID": 1
-        }
-    ]
-    for emp in employees:
-        create_employee(emp)
+        # Positions
+        positions = [
+            {"PositionName": "Developer", "DepartmentID": 1},
+            {"PositionName": "Manager", "DepartmentID": 1},
+            {"PositionName": "HR Specialist", "DepartmentID": 2},
+            {"PositionName": "Accountant", "DepartmentID": 3}
+        ]
+        for pos in positions:
+            create_position(pos)
     
-    connection.commit()
+        # Employees
+        employees = [
+            {
+                "EmployeeName": "John Doe", "HireDate": "2020-01-15", 
+                "Experience": "5 years", "Position": "Developer", 
+                "Gender": "Male", "DepartmentID": 1, "Email": "john@example.com",
+                "Phone": "1234567890", "Status": "Active", "DOB": "1990-05-10",
+                "Salary": "50000", "TeamID": 1
+            },
+            {
+                "EmployeeName": "Jane Smith", "HireDate": "2019-03-20", 
+                "Experience": "6 years", "Position": "Manager", 
+                "Gender": "Female", "DepartmentID": 1, "Email": "jane@example.com",
+                "Phone": "9876543210", "Status": "Active", "DOB": "1988-11-25",
+                "Salary": "70000", "TeamID": 1
+            }
+        ]
+        for emp in employees:
+            create_employee(emp)
 
 if __name__ == "__main__":
     setup_test_database()
@@ -0,0 +1,232 @@
+"""Streaming CSV/Parquet export of the EMS tables.
+
+Rows are read with ``fetchmany`` and written chunk by chunk, so memory use
+does not depend on table size, and tables are exported in parallel, each
+from its own pooled connection inside one read transaction.
+
+With ``incremental=True`` only rows whose RowVersion is above the watermark
+saved by the previous run are written, into a ``<table>.<from>-<to>.<ext>``
+delta file next to the full export. Deleted rows are not visible to an
+incremental export; take a full export to drop them downstream.
+
+    python export.py --database ems.db --output output_csv --incremental
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+CHUNK_SIZE = 5000
+STATE_FILE = ".export_state.json"
+FORMATS = ("csv", "parquet")
+
+def table_columns(connection, table):
+    cursor = connection.cursor()
+    cursor.execute(f"PRAGMA table_info({table})")
+    return [(row["name"], (row["type"] or "").upper()) for row in cursor.fetchall()]
+
+class CsvWriter:
+    extension = "csv"
+
+    def __init__(self, path, columns):
+        self.file = open(path, "w", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([name for name, _ in columns])
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+def _arrow_type(declared):
+    if "INT" in declared:
+        return pyarrow.int64()
+    if any(name in declared for name in ("DECIMAL", "NUMERIC", "REAL", "FLOA", "DOUB")):
+        return pyarrow.float64()
+    return pyarrow.string()
+
+class ParquetWriter:
+    extension = "parquet"
+
+    def __init__(self, path, columns):
+        if pyarrow is None:
+            raise RuntimeError("Parquet export requires the pyarrow package")
+        self.schema = pyarrow.schema([(name, _arrow_type(declared)) for name, declared in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        arrays = []
+        for field, values in zip(self.schema, columns):
+            if field.type == pyarrow.string():
+                values = [None if value is None else str(value) for value in values]
+            arrays.append(pyarrow.array(values, type=field.type, from_pandas=False))
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+WRITERS = {"csv": CsvWriter, "parquet": ParquetWriter}
+
+@database.reads
+def export_table(table, output_folder, fmt="csv", since=None, chunk_size=CHUNK_SIZE, progress=None):
+    """Export one table and return a summary including the new watermark.
+
+    ``since`` is the watermark of the previous run; None means a full export.
+    ``progress(rows)`` is called after each chunk with the rows written so
+    far; an exception it raises abandons the export of the table.
+    """
+    started = time.perf_counter()
+    writer_class = WRITERS[fmt]
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        # Keep the watermark and the rows read from one snapshot
+        cursor.execute("BEGIN")
+        try:
+            cursor.execute("SELECT Value FROM row_version")
+            watermark = cursor.fetchone()[0]
+            columns = table_columns(connection, table)
+            if since is None:
+                cursor.execute(f"SELECT * FROM {table}")
+                name = f"{table}.{writer_class.extension}"
+            else:
+                cursor.execute(
+                    f"SELECT * FROM {table} WHERE RowVersion > ? AND RowVersion <= ? ORDER BY RowVersion",
+                    (since, watermark),
+                )
+                name = f"{table}.{since}-{watermark}.{writer_class.extension}"
+
+            path = os.path.join(output_folder, name)
+            partial = path + ".partial"
+            writer = None
+            count = 0
+            try:
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    if writer is None:
+                        writer = writer_class(partial, columns)
+                    writer.write([tuple(row) for row in rows])
+                    count += len(rows)
+                    if progress is not None:
+                        progress(count)
+                # A full export always produces a file, even for an empty table
+                if writer is None and since is None:
+                    writer = writer_class(partial, columns)
+            except BaseException:
+                if writer is not None:
+                    writer.close()
+                    os.remove(partial)
+                raise
+            if writer is not None:
+                writer.close()
+        finally:
+            connection.rollback()
+
+    if writer is not None:
+        os.replace(partial, path)
+    else:
+        path = None
+    return {
+        "table": table,
+        "rows": count,
+        "path": path,
+        "since": since,
+        "watermark": watermark,
+        "seconds": time.perf_counter() - started,
+    }
+
+def load_state(output_folder):
+    try:
+        with open(os.path.join(output_folder, STATE_FILE)) as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return {}
+
+def save_state(output_folder, state):
+    path = os.path.join(output_folder, STATE_FILE)
+    with open(path + ".partial", "w") as state_file:
+        json.dump(state, state_file, indent=2, sort_keys=True)
+    os.replace(path + ".partial", path)
+
+def export_tables(output_folder, tables=None, fmt="csv", incremental=False, workers=4, chunk_size=CHUNK_SIZE, progress=None):
+    """Export ``tables`` in parallel and save the new watermarks.
+
+    ``progress(done, total, message)`` is called as chunks are written,
+    ``done`` counting the tables finished.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"unsupported format {fmt!r}")
+    tables = list(tables or database.TABLES)
+    unknown = set(tables) - set(database.TABLES)
+    if unknown:
+        raise ValueError(f"unknown tables: {', '.join(sorted(unknown))}")
+    os.makedirs(output_folder, exist_ok=True)
+    state = load_state(output_folder)
+    marks = state.setdefault(fmt, {})
+
+    shard = database.current_shard()
+    finished = []
+
+    def report(table, rows):
+        if progress is not None:
+            progress(len(finished), len(tables), f"{table}: {rows} rows")
+
+    def run(table):
+        since = marks.get(table) if incremental else None
+        with database.use_shard(shard):
+            result = export_table(table, output_folder, fmt, since, chunk_size, lambda rows: report(table, rows))
+        finished.append(table)
+        report(table, result["rows"])
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(tables)))) as executor:
+        results = list(executor.map(run, tables))
+
+    for result in results:
+        marks[result["table"]] = result["watermark"]
+    save_state(output_folder, state)
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export EMS tables to CSV or Parquet.")
+    parser.add_argument("--database", default="ems.db")
+    parser.add_argument("--output", default="output_csv")
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("tables", nargs="*", help="defaults to every table in database.TABLES")
+    return parser.parse_args(argv)
+
+def print_results(results, args):
+    for result in results:
+        if result["path"]:
+            print(f"✅ {result['table']}: {result['rows']} rows -> {result['path']} ({result['seconds']:.2f}s)")
+        else:
+            print(f"{result['table']}: no changes since {result['since']}")
+    print(f"\nAll tables exported to {args.format.upper()} in '{args.output}' folder.")
+
+def main(argv=None):
+    args = parse_args(argv)
+    database.initialize(args.database, pool_size=max(args.workers, 1))
+    print_results(export_tables(
+        args.output, args.tables, args.format, args.incremental, args.workers, args.chunk_size
+    ), args)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,59 @@
+"""Compiled templates and cached table bodies for the HTML list pages.
+
+init_app() gives Jinja a bytecode cache on disk (EMS_TEMPLATE_CACHE, by
+default a per-user directory under the system temp dir), so a restarted
+worker loads compiled templates instead of parsing them, and compiles
+every template at startup rather than on its first request. With EMS_WARM_CACHE=1
+it also renders the first page of each list once, so the first visitors
+find the fragment and reference caches filled.
+
+cached_rows() keeps the rendered rows of a list page, with its next-page
+cursor, under a key holding the page's query arguments and the change
+counters of the tables it reads (database.data_versions). While none of
+those tables changes the page is served without a query or a render of
+the row loop; a write moves the counter on and the next request renders
+afresh, leaving the old entry to age out of the cache.
+"""
+import hashlib
+import os
+
+from flask import request
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+
+import cache
+import database
+
+def cached_rows(tables, render):
+    """Return ``render()``, a (rows html, next cursor) pair, cached for this page."""
+    versions = database.data_versions(tables)
+    page = (request.endpoint, request.script_root, sorted(request.args.items(multi=True)), versions)
+    key = "fragment:" + hashlib.sha1(repr(page).encode()).hexdigest()
+    rows, next_cursor = cache.get_or_load(key, render)
+    return Markup(rows), next_cursor
+
+def compile_templates(app):
+    """Load every template so it is compiled now, not on its first request."""
+    names = app.jinja_env.list_templates(extensions=["html"])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
+
+def warm(app, endpoints):
+    """Render the first page of each of ``endpoints`` once."""
+    for endpoint in endpoints:
+        with app.test_request_context():
+            path = app.url_for(endpoint)
+        with app.test_request_context(path):
+            app.view_functions[endpoint]()
+
+def init_app(app, list_endpoints=(), warm_cache=None):
+    directory = os.environ.get("EMS_TEMPLATE_CACHE")
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+    compile_templates(app)
+    if warm_cache is None:
+        warm_cache = os.environ.get("EMS_WARM_CACHE", "") not in ("", "0")
+    if warm_cache:
+        warm(app, list_endpoints)
@@ -0,0 +1,156 @@
+"""Group commit for high-frequency writes such as attendance check-ins.
+
+A request hands its row to a queue and blocks. One writer thread takes
+rows off the queue until it has BATCH_SIZE of them or FLUSH_MS have passed
+since the first, writes them in a single transaction and only then wakes
+the requests, so each one is acknowledged after its row is durable. Many
+concurrent check-ins therefore share one fsync instead of queueing for
+one each. A row that fails fails only its own request.
+
+The queue holds at most MAX_QUEUE rows. When it is full a request waits
+up to ENQUEUE_TIMEOUT seconds for room and then gets QueueFull, which the
+routes turn into a 503. A queued request waits for its commit for at most
+twice the database busy timeout (its batch and the one ahead of it may
+each wait out a lock) and then gets NotCommitted, also a 503; its row
+may still commit later. If the writer thread dies, every request it
+holds fails with NotCommitted at once and the next submit starts a new
+writer.
+"""
+import os
+import queue
+import threading
+import time
+
+import database
+import metrics
+
+BATCH_SIZE = int(os.environ.get("EMS_GROUP_COMMIT_ROWS", "100"))
+FLUSH_MS = float(os.environ.get("EMS_GROUP_COMMIT_MS", "5"))
+MAX_QUEUE = int(os.environ.get("EMS_GROUP_COMMIT_QUEUE", "2000"))
+ENQUEUE_TIMEOUT = 5.0
+
+class QueueFull(Exception):
+    pass
+
+class NotCommitted(Exception):
+    pass
+
+class _Pending:
+    __slots__ = ("data", "shard", "queued", "done", "result")
+
+    def __init__(self, data):
+        self.data = data
+        # The writer thread commits each row to the submitting thread's shard
+        self.shard = database.current_shard()
+        self.queued = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+
+class GroupCommit:
+    """Coalesce ``write(rows)`` calls from many threads into batches.
+
+    ``write`` takes a list of rows and returns one result per row, an
+    exception instance for rows that failed.
+    """
+
+    def __init__(self, name, write, batch_size=BATCH_SIZE, flush_ms=FLUSH_MS, max_queue=MAX_QUEUE):
+        self.name = name
+        self.write = write
+        self.batch_size = batch_size
+        self.flush_seconds = flush_ms / 1000
+        self.max_queue = max_queue
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _writer_queue(self):
+        # Start the writer on first use, and again in a forked child
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue(self.max_queue)
+                    threading.Thread(target=self._run, args=(self._queue,), name=f"ems-{self.name}-writer", daemon=True).start()
+                    self._pid = os.getpid()
+        return self._queue
+
+    def submit(self, data, timeout=ENQUEUE_TIMEOUT):
+        """Queue ``data``, wait for its batch to commit and return its result."""
+        pending = _Pending(data)
+        try:
+            self._writer_queue().put(pending, timeout=timeout)
+        except queue.Full:
+            metrics.increment("ems_group_commit_rejected_total", (self.name,))
+            raise QueueFull(f"{self.name} write queue is full") from None
+        if not pending.done.wait(self.commit_timeout()):
+            metrics.increment("ems_group_commit_timeouts_total", (self.name,))
+            raise NotCommitted(f"{self.name} write did not commit in time")
+        if isinstance(pending.result, Exception):
+            raise pending.result
+        return pending.result
+
+    def commit_timeout(self):
+        return 2 * database.busy_timeout() + self.flush_seconds
+
+    def depth(self):
+        return self._queue.qsize() if self._pid == os.getpid() else 0
+
+    def _run(self, rows):
+        last = 1
+        batch = []
+        try:
+            while True:
+                batch = [rows.get()]
+                # A lone write after a lone write is committed at once, so light
+                # traffic pays no flush delay; the window opens once writes overlap
+                deadline = time.perf_counter() + (self.flush_seconds if last > 1 or not rows.empty() else 0)
+                while len(batch) < self.batch_size:
+                    remaining = deadline - time.perf_counter()
+                    try:
+                        batch.append(rows.get(timeout=remaining) if remaining > 0 else rows.get_nowait())
+                    except queue.Empty:
+                        break
+                self._flush(batch)
+                last = len(batch)
+        except BaseException as error:
+            self._abandon(rows, batch, error)
+            raise
+
+    def _abandon(self, rows, batch, error):
+        # Never leave a request waiting on a writer that is gone
+        with self._lock:
+            if self._queue is rows:
+                self._pid = None
+        failure = NotCommitted(f"{self.name} writer stopped: {error!r}")
+        while True:
+            for pending in batch:
+                if not pending.done.is_set():
+                    pending.result = failure
+                    pending.done.set()
+            try:
+                batch = [rows.get_nowait()]
+            except queue.Empty:
+                return
+
+    def _flush(self, batch):
+        shards = {}
+        for pending in batch:
+            shards.setdefault(pending.shard, []).append(pending)
+        for shard, pendings in shards.items():
+            try:
+                with database.use_shard(shard):
+                    results = self.write([pending.data for pending in pendings])
+            except Exception as error:
+                results = [error] * len(pendings)
+            self._finish(pendings, results)
+        metrics.observe("ems_group_commit_batch_rows", (self.name,), len(batch))
+
+    def _finish(self, batch, results):
+        committed = time.perf_counter()
+        for pending, result in zip(batch, results):
+            metrics.observe("ems_group_commit_wait_seconds", (self.name,), committed - pending.queued)
+            pending.result = result
+            pending.done.set()
+
+attendance = GroupCommit("attendance", database.create_attendances)
+
+QUEUES = (attendance,)
@@ -0,0 +1,574 @@
+"""Background jobs: exports, payroll runs and report rebuilds off the request thread.
+
+A job is a row of the job table (migration 15) naming a registered kind
+and its parameters. submit() queues one; a JobRunner in each app process
+claims queued jobs and runs them on WORKERS threads. The heavy work is
+SQLite and file I/O, which releases the GIL, so threads are enough and
+a job sees the app's pools, caches and shards.
+
+While a job runs, its runner writes the job's progress and a heartbeat to
+the table every POLL_INTERVAL seconds, and picks up cancellation requests
+from any process. The runner's own writes (heartbeats, claims, requeues
+and schedules) go through a connection of its own, so they never wait
+behind a job holding the pool's writer. A job whose heartbeat is
+older than STALE_AFTER (the process running it died) is queued again, up
+to MAX_ATTEMPTS runs in all, by any runner but the one still running it.
+Jobs therefore survive restarts: queued ones wait in the table, running
+ones are picked up again.
+
+A schedule (job_schedule) submits a job whenever its cron expression
+("minute hour day month weekday", local time) comes due. A schedule missed
+while no runner was up runs once, as soon as one starts.
+
+Export jobs write only under EXPORT_DIR (EMS_EXPORT_DIR, by default the
+working directory), a tenant's to its own output_csv/<tenant> unless told
+otherwise, and the app's /jobs forms set only the WEB_PARAMS of a kind.
+
+    python jobs.py submit export --param format=parquet
+    python jobs.py schedule nightly-export export --cron "0 2 * * *"
+    python jobs.py list
+    python jobs.py cancel 42
+    python jobs.py work
+"""
+import argparse
+import inspect
+import json
+import os
+import signal
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import changes
+import database
+import export
+import payroll_run
+import reports
+
+WORKERS = int(os.environ.get("EMS_JOB_WORKERS", "2"))
+POLL_INTERVAL = 1.0
+STALE_AFTER = 30
+MAX_ATTEMPTS = 3
+PAGE_SIZE = 50
+STATUSES = ("queued", "running", "succeeded", "failed", "cancelled")
+FINISHED = ("succeeded", "failed", "cancelled")
+# Export jobs write only under this directory
+EXPORT_DIR = os.path.realpath(os.environ.get("EMS_EXPORT_DIR", os.getcwd()))
+# The parameters a web form may set, per kind; the rest keep their defaults
+WEB_PARAMS = {
+    "export": ("tables", "format", "incremental"),
+    "payroll_run": ("month",),
+    "rebuild_reports": (),
+    "compact_changes": (),
+}
+
+class Cancelled(Exception):
+    """Raised inside a job once its cancellation has been requested."""
+
+# Job kinds: name -> function(job, **params)
+KINDS = {}
+
+def kind(name):
+    def register(function):
+        KINDS[name] = function
+        return function
+    return register
+
+class Job:
+    """A running job, handed to its kind's function to report progress."""
+
+    def __init__(self, row):
+        self.id = row["JobID"]
+        self.kind = row["Kind"]
+        self.params = json.loads(row["Params"])
+        self.tenant = row["Tenant"]
+        self.progress = row["Progress"]
+        self.message = row["Message"]
+        self.cancelled = threading.Event()
+
+    def report(self, done, total=None, message=None):
+        """Record progress (``done`` of ``total``, or a fraction); raises Cancelled if asked to stop."""
+        self.progress = min(max(done / total if total else done, 0.0), 1.0)
+        if message is not None:
+            self.message = message
+        self.check()
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise Cancelled(f"job {self.id} cancelled")
+
+# Cron schedules
+_CRON_FIELDS = (("minute", 0, 59), ("hour", 0, 23), ("day", 1, 31), ("month", 1, 12), ("weekday", 0, 7))
+
+def parse_cron(expression):
+    """Return the sets of minutes, hours, days, months and weekdays (0 = Sunday) an expression allows."""
+    parts = expression.split()
+    if len(parts) != len(_CRON_FIELDS):
+        raise ValueError(f"cron expression {expression!r} needs 5 fields")
+    fields = []
+    for part, (name, low, high) in zip(parts, _CRON_FIELDS):
+        values = set()
+        for term in part.split(","):
+            span, _, step = term.partition("/")
+            try:
+                step = int(step) if step else 1
+                if span == "*":
+                    start, end = low, high
+                elif "-" in span:
+                    start, end = (int(value) for value in span.split("-", 1))
+                else:
+                    start = int(span)
+                    end = high if step > 1 else start
+            except ValueError:
+                raise ValueError(f"invalid cron {name} {term!r}") from None
+            if step < 1 or not low <= start <= end <= high:
+                raise ValueError(f"invalid cron {name} {term!r}")
+            values.update(range(start, end + 1, step))
+        fields.append(values)
+    fields[4] = {day % 7 for day in fields[4]}
+    # As in cron, a restricted day and weekday match either one
+    fields.append(parts[2] != "*" and parts[4] != "*")
+    return fields
+
+def next_run(expression, after):
+    """The first minute after the unix time ``after`` that ``expression`` allows."""
+    minutes, hours, days, months, weekdays, either = parse_cron(expression)
+    moment = datetime.fromtimestamp(after).replace(second=0, microsecond=0) + timedelta(minutes=1)
+    limit = moment + timedelta(days=366 * 5)
+    while moment < limit:
+        day_matches = (
+            (moment.day in days or (moment.isoweekday() % 7) in weekdays) if either
+            else (moment.day in days and (moment.isoweekday() % 7) in weekdays)
+        )
+        if moment.month not in months:
+            moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+        elif not day_matches:
+            moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+        elif moment.hour not in hours:
+            moment = moment.replace(minute=0) + timedelta(hours=1)
+        elif moment.minute not in minutes:
+            moment += timedelta(minutes=1)
+        else:
+            return moment.timestamp()
+    raise ValueError(f"cron expression {expression!r} never runs")
+
+# The job table lives in the default database, whichever tenant a job is for
+def _check_params(name, params):
+    if name not in KINDS:
+        raise ValueError(f"unknown job kind {name!r}")
+    try:
+        inspect.signature(KINDS[name]).bind(None, **params)
+    except TypeError as error:
+        raise ValueError(f"{name}: {error}") from None
+
+def submit(name, params=None, tenant=None, run_after=None, schedule=None):
+    """Queue a job of kind ``name``; returns its JobID."""
+    params = params or {}
+    _check_params(name, params)
+    if name == "export" and "output" in params:
+        export_path(params["output"])
+    now = time.time()
+    with database.use_shard(None), database.transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO job (Kind, Params, Tenant, Schedule, CreatedAt, RunAfter)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (name, json.dumps(params, sort_keys=True), tenant, schedule, now, run_after or now))
+        job_id = cursor.lastrowid
+    runner.wake()
+    return job_id
+
+def _job(row):
+    job = dict(row)
+    for column in ("Params", "Result"):
+        job[column] = json.loads(job[column]) if job[column] else None
+    job["CancelRequested"] = bool(job["CancelRequested"])
+    return job
+
+def get_job(job_id):
+    with database.use_shard(None), database.route("reader"), database.get_connection() as connection:
+        row = connection.execute("SELECT * FROM job WHERE JobID = ?", (job_id,)).fetchone()
+    return _job(row) if row else None
+
+def list_jobs(status=None, tenant=None, after=None, limit=PAGE_SIZE):
+    """Jobs newest first, ``after`` being the last JobID of the previous page."""
+    if status is not None and status not in STATUSES:
+        raise ValueError(f"unknown job status {status!r}")
+    limit = max(1, min(int(limit or PAGE_SIZE), database.MAX_PAGE_SIZE))
+    where, params = ["Tenant IS ?"], [tenant]
+    if status is not None:
+        where.append("Status = ?")
+        params.append(status)
+    if after is not None:
+        where.append("JobID < ?")
+        params.append(after)
+    with database.use_shard(None), database.route("reader"), database.get_connection() as connection:
+        rows = connection.execute(
+            f"SELECT * FROM job WHERE {' AND '.join(where)} ORDER BY JobID DESC LIMIT ?", params + [limit + 1]
+        ).fetchall()
+    jobs = [_job(row) for row in rows[:limit]]
+    return {"jobs": jobs, "next_after": jobs[-1]["JobID"] if len(rows) > limit else None}
+
+def cancel(job_id):
+    """Cancel a queued job, or ask the runner of a running one to stop it.
+
+    Returns the job's status afterwards, None if there is no such job.
+    """
+    with database.use_shard(None), database.transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            "UPDATE job SET Status = 'cancelled', FinishedAt = ? WHERE JobID = ? AND Status = 'queued'",
+            (time.time(), job_id),
+        )
+        cursor.execute("UPDATE job SET CancelRequested = 1 WHERE JobID = ? AND Status = 'running'", (job_id,))
+        cursor.execute("SELECT Status FROM job WHERE JobID = ?", (job_id,))
+        row = cursor.fetchone()
+    runner.cancel_local(job_id)
+    return row[0] if row else None
+
+def wait(job_id, timeout=None, interval=0.5, on_progress=None):
+    """Poll until the job finishes; returns it, or None on timeout."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        job = get_job(job_id)
+        if job is None or job["Status"] in FINISHED:
+            return job
+        if on_progress is not None:
+            on_progress(job)
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+        time.sleep(interval)
+
+def set_schedule(name, kind_name, cron, params=None, tenant=None):
+    """Create or replace the schedule ``name``; returns when it next runs."""
+    params = params or {}
+    _check_params(kind_name, params)
+    next_at = next_run(cron, time.time())
+    with database.use_shard(None), database.transaction() as connection:
+        connection.execute("""
+            INSERT OR REPLACE INTO job_schedule (Name, Kind, Params, Tenant, Cron, NextRunAt)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (name, kind_name, json.dumps(params, sort_keys=True), tenant, cron, next_at))
+    return next_at
+
+def delete_schedule(name):
+    with database.use_shard(None), database.transaction() as connection:
+        return connection.execute("DELETE FROM job_schedule WHERE Name = ?", (name,)).rowcount > 0
+
+def get_schedules():
+    with database.use_shard(None), database.route("reader"), database.get_connection() as connection:
+        rows = connection.execute("SELECT * FROM job_schedule ORDER BY Name").fetchall()
+    return [dict(row, Params=json.loads(row["Params"])) for row in rows]
+
+class JobRunner:
+    """Claim and run queued jobs on ``workers`` threads; see the module docstring.
+
+    ``kinds`` limits the kinds claimed (None: all); ``schedules`` turns
+    submitting due scheduled jobs on or off.
+    """
+
+    def __init__(self, workers=WORKERS, kinds=None, schedules=True):
+        self.workers = workers
+        self.kinds = kinds
+        self.schedules = schedules
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._running = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._executor = None
+        self._thread = None
+        self._pid = None
+        self._connection = None
+
+    def start(self):
+        # One loop per process, restarted in a forked worker
+        if self.workers < 1 or self._pid == os.getpid():
+            return self
+        with self._lock:
+            if self._pid != os.getpid():
+                self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+                self._running = {}
+                self._connection = None
+                self._stopping.clear()
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ems-job")
+                self._thread = threading.Thread(target=self._loop, name="ems-jobs", daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+        return self
+
+    def stop(self, wait=True):
+        """Stop claiming jobs; with ``wait``, let the running ones finish first."""
+        if self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._wake.set()
+        self._thread.join()
+        # Jobs left running are queued again once their heartbeat goes stale
+        self._executor.shutdown(wait=wait)
+        if self._connection is not None:
+            self._connection[1].close()
+            self._connection = None
+        self._pid = None
+
+    def wake(self):
+        self._wake.set()
+
+    def cancel_local(self, job_id):
+        job = self._running.get(job_id)
+        if job is not None:
+            job.cancelled.set()
+
+    def _loop(self):
+        while not self._stopping.is_set():
+            try:
+                self._tick()
+            except Exception as error:
+                print(f"job runner: {error}", file=sys.stderr)
+            self._wake.wait(POLL_INTERVAL)
+            self._wake.clear()
+
+    def _tick(self):
+        now = time.time()
+        self._tick_running()
+        self._requeue_stale(now)
+        if self.schedules:
+            self._submit_due(now)
+        while len(self._running) < self.workers and not self._stopping.is_set():
+            job = self._claim()
+            if job is None:
+                break
+            self._running[job.id] = job
+            self._executor.submit(self._execute, job)
+
+    def _connect(self):
+        # (database file, connection), opened again if database.initialize
+        # moved the default database
+        database_file = database.pool.database_file
+        if self._connection is not None and self._connection[0] != database_file:
+            self._connection[1].close()
+            self._connection = None
+        if self._connection is None:
+            connection = sqlite3.connect(database_file, timeout=database.busy_timeout(), check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            self._connection = (database_file, connection)
+        return self._connection[1]
+
+    def _tick_running(self):
+        # Save the progress and heartbeat of our jobs, and learn of cancellations
+        jobs = list(self._running.values())
+        if not jobs:
+            return
+        with self._connect() as connection:
+            cursor = connection.cursor()
+            now = time.time()
+            cursor.executemany(
+                "UPDATE job SET Progress = ?, Message = ?, HeartbeatAt = ? WHERE JobID = ? AND Owner = ?",
+                [(job.progress, job.message, now, job.id, self.owner) for job in jobs],
+            )
+            cursor.execute(
+                f"SELECT JobID FROM job WHERE CancelRequested = 1 AND JobID IN ({', '.join('?' * len(jobs))})",
+                [job.id for job in jobs],
+            )
+            for (job_id,) in cursor.fetchall():
+                self.cancel_local(job_id)
+
+    def _requeue_stale(self, now):
+        # Never our own running jobs: a late heartbeat does not mean we stopped
+        running = list(self._running)
+        mine = f"AND JobID NOT IN ({', '.join('?' * len(running))})" if running else ""
+        with self._connect() as connection:
+            cursor = connection.cursor()
+            cursor.execute(f"""
+                UPDATE job SET
+                    Status = CASE CancelRequested WHEN 1 THEN 'cancelled' ELSE 'failed' END,
+                    Error = 'the process running it stopped', FinishedAt = ?, Owner = NULL
+                WHERE Status = 'running' AND HeartbeatAt < ? AND (Attempts >= ? OR CancelRequested = 1) {mine}
+            """, [now, now - STALE_AFTER, MAX_ATTEMPTS] + running)
+            cursor.execute(f"""
+                UPDATE job SET Status = 'queued', Owner = NULL
+                WHERE Status = 'running' AND HeartbeatAt < ? {mine}
+            """, [now - STALE_AFTER] + running)
+
+    def _submit_due(self, now):
+        with self._connect() as connection:
+            cursor = connection.cursor()
+            cursor.execute("SELECT * FROM job_schedule WHERE NextRunAt <= ?", (now,))
+            for schedule in cursor.fetchall():
+                try:
+                    next_at = next_run(schedule["Cron"], now)
+                except ValueError as error:
+                    print(f"job schedule {schedule['Name']}: {error}", file=sys.stderr)
+                    continue
+                # Another runner may have submitted it already
+                cursor.execute(
+                    "UPDATE job_schedule SET NextRunAt = ? WHERE Name = ? AND NextRunAt = ?",
+                    (next_at, schedule["Name"], schedule["NextRunAt"]),
+                )
+                if cursor.rowcount == 0:
+                    continue
+                cursor.execute("""
+                    INSERT INTO job (Kind, Params, Tenant, Schedule, CreatedAt, RunAfter)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (schedule["Kind"], schedule["Params"], schedule["Tenant"], schedule["Name"], now, now))
+                cursor.execute(
+                    "UPDATE job_schedule SET LastJobID = ? WHERE Name = ?", (cursor.lastrowid, schedule["Name"])
+                )
+
+    def _claim(self):
+        # One statement, so two runners never claim the same job
+        kinds = list(self.kinds) if self.kinds is not None else list(KINDS)
+        now = time.time()
+        with self._connect() as connection:
+            row = connection.execute(f"""
+                UPDATE job SET Status = 'running', Owner = ?, StartedAt = ?, HeartbeatAt = ?, Attempts = Attempts + 1
+                WHERE JobID = (
+                    SELECT JobID FROM job
+                    WHERE Status = 'queued' AND RunAfter <= ? AND Kind IN ({', '.join('?' * len(kinds))})
+                    ORDER BY RunAfter, JobID LIMIT 1
+                )
+                RETURNING *
+            """, [self.owner, now, now, now] + kinds).fetchone()
+        return Job(row) if row else None
+
+    def _execute(self, job):
+        status, result, error = "succeeded", None, None
+        try:
+            with database.use_shard(job.tenant):
+                result = KINDS[job.kind](job, **job.params)
+            job.progress = 1.0
+        except Cancelled:
+            status = "cancelled"
+        except Exception as failure:
+            status, error = "failed", f"{type(failure).__name__}: {failure}"
+        try:
+            with database.transaction() as connection:
+                connection.execute("""
+                    UPDATE job SET Status = ?, Progress = ?, Message = ?, Result = ?, Error = ?, FinishedAt = ?, HeartbeatAt = ?
+                    WHERE JobID = ? AND Owner = ?
+                """, (
+                    status, job.progress, job.message, json.dumps(result) if result is not None else None,
+                    error, time.time(), time.time(), job.id, self.owner,
+                ))
+        finally:
+            self._running.pop(job.id, None)
+            self._wake.set()
+
+runner = JobRunner()
+
+# Job kinds
+def export_path(output):
+    """``output`` resolved under EXPORT_DIR; ValueError if it leads outside."""
+    path = os.path.realpath(os.path.join(EXPORT_DIR, output))
+    if os.path.commonpath([EXPORT_DIR, path]) != EXPORT_DIR:
+        raise ValueError(f"export output {output!r} is outside {EXPORT_DIR}")
+    return path
+
+@kind("export")
+def export_job(job, output=None, tables=None, format="csv", incremental=False, workers=4,
+               chunk_size=export.CHUNK_SIZE):
+    """The app.py export: every table (or ``tables``) to CSV or Parquet files under EXPORT_DIR.
+
+    By default a tenant's job writes to output_csv/<tenant>, so tenants
+    never share files or an incremental export state.
+    """
+    if output is None:
+        output = "output_csv" if job.tenant is None else os.path.join("output_csv", job.tenant)
+    if isinstance(tables, str):
+        tables = [table for table in tables.split(",") if table]
+    return export.export_tables(
+        export_path(output), tables, format, incremental in (True, "1", "true", "on"), int(workers), int(chunk_size),
+        progress=job.report,
+    )
+
+@kind("payroll_run")
+def payroll_job(job, month, leave_allowance=None):
+    return payroll_run.run_payroll(
+        month, None if leave_allowance is None else float(leave_allowance), progress=job.report
+    )
+
+@kind("rebuild_reports")
+def rebuild_reports_job(job):
+    job.report(0, message="rebuilding summary tables")
+    return reports.rebuild()
+
+@kind("compact_changes")
+def compact_changes_job(job):
+    merged, dropped = changes.compact()
+    return {"merged": merged, "dropped": dropped}
+
+def _params(values):
+    params = {}
+    for value in values:
+        name, separator, setting = value.partition("=")
+        if not separator:
+            raise argparse.ArgumentTypeError(f"expected name=value, got {value!r}")
+        params[name] = setting
+    return params
+
+def _print_job(job):
+    print(
+        f"{job['JobID']:>6}  {job['Kind']:<16}{job['Status']:<11}{job['Progress'] * 100:5.0f}%  "
+        f"{job['Message'] or job['Error'] or ''}"
+    )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Queue, schedule and run EMS background jobs.")
+    parser.add_argument("command", choices=["submit", "list", "cancel", "schedule", "unschedule", "work"])
+    parser.add_argument("target", nargs="*", help="submit: KIND; cancel: JOB_ID; schedule: NAME KIND; unschedule: NAME")
+    parser.add_argument("--database", default="ems.db")
+    parser.add_argument("--param", action="append", default=[], help="name=value passed to the job (repeatable)")
+    parser.add_argument("--cron", help='schedule: "minute hour day month weekday"')
+    parser.add_argument("--tenant", help="run the job on this tenant's shard (see shards.py)")
+    parser.add_argument("--status", choices=STATUSES)
+    args = parser.parse_args(argv)
+    expected = {"submit": 1, "cancel": 1, "schedule": 2, "unschedule": 1, "list": 0, "work": 0}[args.command]
+    if len(args.target) != expected:
+        parser.error(f"{args.command} takes {expected} argument(s)")
+
+    database.initialize(args.database, pool_size=2)
+    try:
+        if args.command == "submit":
+            print(f"✅ queued job {submit(args.target[0], _params(args.param), args.tenant)}")
+        elif args.command == "cancel":
+            status = cancel(int(args.target[0]))
+            if status is None:
+                print(f"❌ no job {args.target[0]}")
+                return 1
+            print(f"job {args.target[0]}: {status}")
+        elif args.command == "schedule":
+            if not args.cron:
+                parser.error("schedule needs --cron")
+            next_at = set_schedule(args.target[0], args.target[1], args.cron, _params(args.param), args.tenant)
+            print(f"✅ {args.target[0]} next runs at {datetime.fromtimestamp(next_at):%Y-%m-%d %H:%M}")
+        elif args.command == "unschedule":
+            print("✅ removed" if delete_schedule(args.target[0]) else f"❌ no schedule {args.target[0]}")
+        elif args.command == "list":
+            for schedule in get_schedules():
+                print(f"schedule {schedule['Name']}: {schedule['Kind']} at \"{schedule['Cron']}\", "
+                      f"next {datetime.fromtimestamp(schedule['NextRunAt']):%Y-%m-%d %H:%M}")
+            for job in list_jobs(args.status, args.tenant)["jobs"]:
+                _print_job(job)
+        else:
+            signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+            runner.start()
+            while True:
+                time.sleep(3600)
+    except ValueError as error:
+        print(f"❌ {error}")
+        return 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.command == "work":
+            runner.stop()
+        database.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,351 @@
+"""In-memory interval index over Leave: who is out, overlaps and balances.
+
+LeaveIndex holds every leave as a day interval in two indexes:
+
+- an interval tree across the whole organisation, answering "who is out
+  between these dates" in O(log days + matches);
+- a list per employee sorted by start date, answering "which of this
+  employee's leaves overlap these dates" with a bisect.
+
+It also keeps the days each employee has taken (approved, as
+database.is_approved_leave) and has pending (any other open status) per
+calendar year, so a balance is a dict lookup. The yearly allowance is
+database.LEAVE_ALLOWANCE_DAYS, the one payroll_run deducts against.
+
+The index is loaded from the Leave table at startup (``get_index().load()``)
+and kept current the way org_chart is: create/update/delete_leave report
+the LeaveIDs they wrote (database.on_change) and the index re-reads those
+rows; other writes move the Leave change counter and the next read catches
+up on rows with a newer RowVersion. database.create_leave and update_leave
+check overlaps themselves, inside the writing transaction.
+"""
+import bisect
+import threading
+from datetime import date
+
+import conversions
+import database
+
+OUT_STATUSES = (database.APPROVED_LEAVE_STATUS,)
+BALANCE_PAGE_SIZE = 100
+# Day numbers covered by the tree; a leave outside them is not indexed
+FIRST_DAY = date(1900, 1, 1).toordinal()
+LAST_DAY = date(2199, 12, 31).toordinal()
+
+class _Node:
+    __slots__ = ("low", "high", "center", "by_start", "by_end", "left", "right")
+
+    def __init__(self, low, high):
+        self.low, self.high = low, high
+        self.center = (low + high) // 2
+        # Intervals containing center, as (start, end, item) and (end, start, item)
+        self.by_start = []
+        self.by_end = []
+        self.left = self.right = None
+
+class IntervalTree:
+    """Centered interval tree over the fixed day range [low, high].
+
+    Each node splits its range at the center day and holds the intervals
+    that contain it; the rest go left or right. Nodes split a fixed range,
+    so the depth stays at most log2(high - low) whatever the order of
+    inserts, and inserts and removals need no rebalancing.
+    """
+
+    def __init__(self, low=FIRST_DAY, high=LAST_DAY):
+        self.root = _Node(low, high)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _node(self, start, end, create):
+        node = self.root
+        while not start <= node.center <= end:
+            if end < node.center:
+                if node.left is None and create:
+                    node.left = _Node(node.low, node.center - 1)
+                node = node.left
+            else:
+                if node.right is None and create:
+                    node.right = _Node(node.center + 1, node.high)
+                node = node.right
+            if node is None:
+                return None
+        return node
+
+    def add(self, start, end, item):
+        node = self._node(start, end, True)
+        bisect.insort(node.by_start, (start, end, item))
+        bisect.insort(node.by_end, (end, start, item))
+        self.size += 1
+
+    def remove(self, start, end, item):
+        node = self._node(start, end, False)
+        for entries, entry in ((node.by_start, (start, end, item)), (node.by_end, (end, start, item))):
+            position = bisect.bisect_left(entries, entry)
+            if position == len(entries) or entries[position] != entry:
+                raise KeyError(item)
+            del entries[position]
+        self.size -= 1
+
+    def overlapping(self, start, end):
+        """Yield the items of intervals sharing at least one day with [start, end]."""
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if start <= node.center <= end:
+                for entry in node.by_start:
+                    yield entry[2]
+            elif end < node.center:
+                for entry in node.by_start:
+                    if entry[0] > end:
+                        break
+                    yield entry[2]
+            else:
+                for entry in reversed(node.by_end):
+                    if entry[0] < start:
+                        break
+                    yield entry[2]
+            if node.left is not None and start < node.center:
+                stack.append(node.left)
+            if node.right is not None and end > node.center:
+                stack.append(node.right)
+
+def _day(value):
+    return date.fromisoformat(conversions.iso_date(value)).toordinal()
+
+def _years(start, end):
+    """(year, days) for each calendar year the days [start, end] fall in."""
+    first, last = date.fromordinal(start), date.fromordinal(end)
+    for year in range(first.year, last.year + 1):
+        low = max(start, date(year, 1, 1).toordinal())
+        high = min(end, date(year, 12, 31).toordinal())
+        yield year, high - low + 1
+
+class LeaveIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.loaded = False
+
+    def _reset(self):
+        # LeaveID -> (EmployeeID, start day, end day, Status)
+        self.leaves = {}
+        self.tree = IntervalTree()
+        # EmployeeID -> sorted [(start day, end day, LeaveID)]
+        self.by_employee = {}
+        # (EmployeeID, year) -> [days taken, days pending]
+        self.used = {}
+        # year -> sorted EmployeeIDs with leave that year
+        self.years = {}
+        # Longest leave seen, bounding how far back an overlap can start
+        self.longest = 0
+        # LeaveIDs whose dates cannot be placed on the calendar
+        self.unplaced = set()
+        self.watermark = 0
+        self.version = 0
+
+    def load(self):
+        """Index the whole Leave table; returns the number of leaves indexed."""
+        with self._lock, database.route("reader"), database.get_connection() as connection:
+            self._reset()
+            cursor = connection.cursor()
+            cursor.execute("BEGIN")
+            try:
+                self.version = self._read_version(cursor)
+                cursor.execute("SELECT LeaveID, EmployeeID, StartDate, EndDate, Status, RowVersion FROM Leave")
+                self._apply_rows(cursor.fetchall())
+            finally:
+                connection.rollback()
+            self.loaded = True
+            return len(self.leaves)
+
+    def _read_version(self, cursor):
+        cursor.execute("SELECT Version FROM table_version WHERE TableName = 'Leave'")
+        return cursor.fetchone()[0]
+
+    def _usage(self, record, sign):
+        employee, start, end, status = record
+        if database.is_closed_leave(status):
+            return
+        column = 0 if database.is_approved_leave(status) else 1
+        for year, days in _years(start, end):
+            used = self.used.get((employee, year))
+            if used is None:
+                used = self.used[(employee, year)] = [0, 0]
+                bisect.insort(self.years.setdefault(year, []), employee)
+            used[column] += sign * days
+            if used == [0, 0]:
+                del self.used[(employee, year)]
+                employees = self.years[year]
+                del employees[bisect.bisect_left(employees, employee)]
+
+    def _set(self, leave_id, record):
+        self.unplaced.discard(leave_id)
+        old = self.leaves.pop(leave_id, None)
+        if old is not None:
+            employee, start, end, _ = old
+            self.tree.remove(start, end, leave_id)
+            intervals = self.by_employee[employee]
+            del intervals[bisect.bisect_left(intervals, (start, end, leave_id))]
+            if not intervals:
+                del self.by_employee[employee]
+            self._usage(old, -1)
+        if record is not None:
+            employee, start, end, _ = record
+            self.leaves[leave_id] = record
+            self.tree.add(start, end, leave_id)
+            bisect.insort(self.by_employee.setdefault(employee, []), (start, end, leave_id))
+            self.longest = max(self.longest, end - start)
+            self._usage(record, 1)
+
+    def _apply_rows(self, rows):
+        for leave_id, employee, start, end, status, version in rows:
+            self.watermark = max(self.watermark, version or 0)
+            try:
+                start, end = _day(start), _day(end)
+            except (TypeError, ValueError):
+                start = end = None
+            if employee is None or start is None or end < start or start < FIRST_DAY or end > LAST_DAY:
+                self._set(leave_id, None)
+                self.unplaced.add(leave_id)
+                continue
+            self._set(leave_id, (employee, start, end, status or ""))
+
+    def apply(self, table, keys):
+        """database.on_change listener: bring the index up to date after a write."""
+        if table != "Leave" or not self.loaded:
+            return
+        try:
+            self.sync(keys)
+        except Exception:
+            # Never fail a write that has already committed; reload on next read
+            self.loaded = False
+
+    def sync(self, keys=None):
+        with self._lock, database.get_connection() as connection:
+            cursor = connection.cursor()
+            began = not connection.in_transaction
+            if began:
+                cursor.execute("BEGIN")
+            try:
+                version = self._read_version(cursor)
+                # Only the reported rows changed: re-read just those
+                if keys is not None and version - self.version <= len(keys):
+                    for key in keys:
+                        cursor.execute(
+                            "SELECT LeaveID, EmployeeID, StartDate, EndDate, Status, RowVersion FROM Leave WHERE LeaveID = ?",
+                            (key,),
+                        )
+                        row = cursor.fetchone()
+                        if row is None:
+                            self._set(int(key), None)
+                        else:
+                            self._apply_rows([row])
+                elif version != self.version:
+                    cursor.execute(
+                        "SELECT LeaveID, EmployeeID, StartDate, EndDate, Status, RowVersion FROM Leave WHERE RowVersion > ?",
+                        (self.watermark,),
+                    )
+                    rows = cursor.fetchall()
+                    self._apply_rows(rows)
+                    # The counter moves once per row written: if it moved
+                    # further than the rows re-read, some were deleted and
+                    # RowVersion cannot show which
+                    if version - self.version != len(rows):
+                        cursor.execute("SELECT LeaveID FROM Leave")
+                        for leave_id in (set(self.leaves) | self.unplaced) - {row[0] for row in cursor.fetchall()}:
+                            self._set(leave_id, None)
+                self.version = version
+            finally:
+                if began:
+                    connection.rollback()
+
+    def current(self):
+        """Load or catch up when Leave has moved past what the index holds."""
+        if not self.loaded:
+            self.load()
+        elif database.data_versions(("Leave",))[0] > self.version:
+            self.sync()
+
+    def _row(self, leave_id):
+        employee, start, end, status = self.leaves[leave_id]
+        return {
+            "LeaveID": leave_id, "EmployeeID": employee, "Status": status,
+            "StartDate": date.fromordinal(start).isoformat(), "EndDate": date.fromordinal(end).isoformat(),
+        }
+
+    def who_is_out(self, date_from, date_to=None, statuses=OUT_STATUSES):
+        """Leaves in ``statuses`` covering any day from ``date_from`` to ``date_to``."""
+        start = _day(date_from)
+        end = _day(date_to) if date_to else start
+        if end < start:
+            raise ValueError(f"date_to {date_to} is before date_from {date_from}")
+        wanted = {status.strip().lower() for status in statuses}
+        self.current()
+        with self._lock:
+            rows = [self._row(leave_id) for leave_id in self.tree.overlapping(start, end)
+                    if self.leaves[leave_id][3].strip().lower() in wanted]
+        rows.sort(key=lambda row: (row["StartDate"], row["EmployeeID"], row["LeaveID"]))
+        return rows
+
+    def overlapping(self, employee_id, date_from, date_to, exclude=None):
+        """Open leaves of ``employee_id`` sharing a day with the given dates."""
+        start, end = _day(date_from), _day(date_to)
+        self.current()
+        with self._lock:
+            intervals = self.by_employee.get(int(employee_id), [])
+            # Anything starting before start - longest has ended before start
+            low = bisect.bisect_left(intervals, (start - self.longest,))
+            high = bisect.bisect_right(intervals, (end, float("inf")))
+            return [
+                self._row(leave_id) for first, last, leave_id in intervals[low:high]
+                if last >= start and leave_id != exclude
+                and not database.is_closed_leave(self.leaves[leave_id][3])
+            ]
+
+    def _balance(self, employee_id, year):
+        taken, pending = self.used.get((employee_id, year), (0, 0))
+        allowance = database.LEAVE_ALLOWANCE_DAYS
+        return {
+            "EmployeeID": employee_id, "year": year, "allowance": allowance,
+            "taken": taken, "pending": pending, "remaining": allowance - taken - pending,
+        }
+
+    def balance(self, employee_id, year):
+        self.current()
+        with self._lock:
+            return self._balance(int(employee_id), int(year))
+
+    def balances(self, year, after=None, limit=BALANCE_PAGE_SIZE):
+        """Balances for ``year`` of employees with leave that year, in id order.
+
+        Employees without leave in ``year`` have the whole allowance left.
+        """
+        year = int(year)
+        self.current()
+        with self._lock:
+            employees = self.years.get(year, [])
+            first = 0 if after is None else bisect.bisect_right(employees, after)
+            page = employees[first:first + limit]
+            return {
+                "balances": [self._balance(employee, year) for employee in page],
+                "next_after": page[-1] if first + limit < len(employees) else None,
+            }
+
+# One index per tenant shard (None: the default database)
+_indexes = {}
+
+def get_index():
+    """The index of this thread's shard, loaded on its first read."""
+    shard = database.current_shard()
+    index = _indexes.get(shard)
+    if index is None:
+        index = _indexes.setdefault(shard, LeaveIndex())
+    return index
+
+@database.on_change
+def _apply(table, keys):
+    index = _indexes.get(database.current_shard())
+    if index is not None:
+        index.apply(table, keys)
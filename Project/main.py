@@ -1,30 +1,241 @@
-from flask import Flask, render_template, request, redirect, url_for
+import os
+from contextlib import ExitStack
+from datetime import date, datetime
+
+from flask import Flask, abort, g, jsonify, render_template, request, redirect, stream_with_context, url_for
+import api
+import bulk_import
+import cache
 import database
-
-# Initialize the database
-database.initialize("ems.db")
+import fragments
+import group_commit
+import jobs
+import leave_index
+import metrics
+import org_chart
+import payroll_run
+import reports
+import shards
+
+# The database init() opens; asgi.py raises the pool size for its worker threads
+DATABASE_FILE = os.environ.get("EMS_DATABASE", "ems.db")
+POOL_SIZE = int(os.environ.get("EMS_POOL_SIZE", "5"))
 
 app = Flask(__name__)
+metrics.init_app(app)
+app.register_blueprint(api.api)
+
+@app.before_request
+def enter_tenant():
+    # Every query of a request naming a tenant goes to that tenant's shard
+    tenant = shards.tenant_of(request)
+    if tenant is None:
+        return
+    g.tenant = ExitStack()
+    try:
+        g.tenant.enter_context(database.use_shard(tenant))
+    except LookupError as error:
+        abort(404, str(error))
+
+@app.teardown_request
+def leave_tenant(error=None):
+    stack = g.pop("tenant", None)
+    if stack is not None:
+        stack.close()
+
+def get_page(fetch, *filters, stream=False):
+    args = {name: request.args.get(name) or None for name in filters}
+    try:
+        return fetch(
+            sort=request.args.get("sort"),
+            order=request.args.get("order", "asc"),
+            after=request.args.get("after"),
+            limit=api.limit_arg(database.PAGE_SIZE),
+            stream=stream,
+            **args
+        )
+    except ValueError as error:
+        abort(400, str(error))
+
+# Template output pieces joined into one chunk of a streamed response
+STREAM_BUFFER = 500
+
+def stream_list(template, name, fetch, filters):
+    """Stream a list page holding every matching row.
+
+    Rows come from a database generator and the template is rendered with
+    Jinja's stream(), so the head of the page is sent before the rows are
+    read and memory use does not grow with the row count.
+    """
+    page = get_page(fetch, *filters, stream=True)
+    context = {name: page["rows"], "first_url": None, "next_url": None}
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template).stream(context)
+    stream.enable_buffering(STREAM_BUFFER)
+
+    def generate():
+        try:
+            yield from stream
+        finally:
+            # Give the connection back now if the client goes away mid-stream
+            page["rows"].close()
+    return app.response_class(stream_with_context(generate()), mimetype="text/html")
+
+def render_list(template, name, resource):
+    """Render a list page; its rows come from the fragment cache when current.
+
+    ``?all=1`` streams every row instead of one page.
+    """
+    _, tables, fetch, filters, _ = api.RESOURCES[resource]
+    if request.args.get("all"):
+        return stream_list(template, name, fetch, filters)
+
+    def render():
+        page = get_page(fetch, *filters)
+        rows = render_template(template.replace("_list", "_rows"), **{name: page["rows"]})
+        return rows, page["next_cursor"]
+
+    rows, next_cursor = fragments.cached_rows(tables, render)
+    args = request.args.to_dict()
+    args.pop("after", None)
+    first_url = url_for(request.endpoint, **args) if "after" in request.args else None
+    next_url = None
+    if next_cursor:
+        next_url = url_for(request.endpoint, after=next_cursor, **args)
+    all_url = url_for(request.endpoint, all=1, **args) if next_url else None
+    return render_template(template, first_url=first_url, next_url=next_url, all_url=all_url, rows=rows)
+
+def import_upload(entity):
+    upload = request.files.get("file")
+    if upload is None or not upload.filename:
+        abort(400, "a file upload named 'file' is required")
+    result = bulk_import.import_upload(entity, upload)
+    return jsonify(result), 200 if not result["failed"] else 207
+
+@app.route("/cache/stats", methods=["GET"])
+def get_cache_stats():
+    return jsonify(cache.stats())
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    pools = database.pool_stats()
+    replica_age = database.replica_age()
+    cache_stats = cache.stats()
+    extra = {
+        "ems_db_pool_connections": ("Pooled SQLite connections by pool and state.", "gauge", {
+            (("pool", name), ("state", state)): stats[state]
+            for name, stats in pools.items() for state in ("in_use", "idle")
+        }),
+        "ems_db_pool_wait_seconds_total": ("Time spent waiting for a pooled connection.", "counter", {
+            (("pool", name),): stats["wait_time_total"] for name, stats in pools.items()
+        }),
+        "ems_db_pool_timeouts_total": ("Connection checkouts that timed out.", "counter", {
+            (("pool", name),): stats["timeouts"] for name, stats in pools.items()
+        }),
+        "ems_db_replica_age_seconds": ("Seconds since the replica was refreshed from the primary.", "gauge", {
+            (): replica_age,
+        } if replica_age is not None else {}),
+        "ems_cache_lookups_total": ("Cache lookups by result.", "counter", {
+            (("result", "hit"),): cache_stats["hits"],
+            (("result", "miss"),): cache_stats["misses"],
+        }),
+        "ems_group_commit_queue_depth": ("Writes waiting for the next group commit.", "gauge", {
+            (("queue", queue.name),): queue.depth() for queue in group_commit.QUEUES
+        }),
+    }
+    return app.response_class(metrics.render(extra), mimetype="text/plain; version=0.0.4")
+
+@app.route("/metrics/slow-queries", methods=["GET"])
+def get_slow_queries():
+    return jsonify(list(metrics.slow_queries))
+
+# Report Routes
+@app.route("/reports", methods=["GET"])
+def get_reports():
+    month = request.args.get("month") or reports.current_month()
+    departments = reports.get_department_month(month)
+    days = reports.get_daily_totals(month)
+    statuses = {"attendance": set(), "leave": set()}
+    for row in departments:
+        for source in statuses:
+            statuses[source].update(row[source])
+    return render_template(
+        "reports.html", month=month, departments=departments, days=days,
+        attendance_statuses=sorted(statuses["attendance"]), leave_statuses=sorted(statuses["leave"])
+    )
+
+@app.route("/org", methods=["GET"])
+def get_org():
+    after = api.int_arg("after")
+    chart = org_chart.get_chart()
+    return render_template("org.html", summary=chart.summary(), teams=chart.teams(after=after))
+
+# Job Routes
+@app.template_filter("timestamp")
+def format_timestamp(value):
+    return datetime.fromtimestamp(value).strftime("%Y-%m-%d %H:%M:%S") if value else ""
+
+@app.route("/jobs", methods=["GET"])
+def get_jobs():
+    status = request.args.get("status") or None
+    try:
+        page = jobs.list_jobs(status, database.current_shard(), api.int_arg("after"))
+    except ValueError as error:
+        abort(400, str(error))
+    return render_template(
+        "jobs.html", page=page, status=status, statuses=jobs.STATUSES, schedules=jobs.get_schedules(),
+        highlight=api.int_arg("job"),
+    )
+
+@app.route("/jobs/<kind>", methods=["POST"])
+def post_job_submit(kind):
+    if kind not in jobs.WEB_PARAMS:
+        abort(400, f"unknown job kind {kind!r}")
+    params = {name: request.form[name] for name in jobs.WEB_PARAMS[kind] if request.form.get(name)}
+    try:
+        job_id = jobs.submit(kind, params, tenant=database.current_shard())
+    except ValueError as error:
+        abort(400, str(error))
+    return redirect(url_for("get_jobs", job=job_id))
+
+@app.route("/jobs/<int:id>/cancel", methods=["POST"])
+def post_job_cancel(id):
+    job = jobs.get_job(id)
+    if job is None or job["Tenant"] != database.current_shard():
+        abort(404, f"job {id} not found")
+    jobs.cancel(id)
+    return redirect(url_for("get_jobs", job=id))
 
 # Employee Routes
 @app.route("/", methods=["GET"])
 @app.route("/employees", methods=["GET"])
 def get_employee_list():
-    employees = database.get_employees()
-    return render_template("employee_list.html", employees=employees)
+    return render_list("employee_list.html", "employees", "employees")
+
+@app.route("/employees/search", methods=["GET"])
+def get_employee_search():
+    query = request.args.get("q", "")
+    limit = api.limit_arg(database.SEARCH_LIMIT)
+    return jsonify(database.search_employees(query, limit))
 
 @app.route("/employee/create", methods=["GET"])
 def get_employee_create():
-    departments = database.get_departments()
-    positions = database.get_positions()
+    departments, positions = database.gather(database.get_departments, database.get_positions)
     return render_template("employee_create.html", departments=departments, positions=positions)
 
 @app.route("/employee/create", methods=["POST"])
 def post_employee_create():
     data = dict(request.form)
-    database.create_employee(data)
+    try:
+        database.create_employee(data)
+    except ValueError as error:
+        abort(400, str(error))
     return redirect(url_for("get_employee_list"))
 
+@app.route("/employee/import", methods=["POST"])
+def post_employee_import():
+    return import_upload("employee")
+
 @app.route("/employee/delete/<id>", methods=["GET"])
 def get_employee_delete(id):
     database.delete_employee(id)
@@ -32,22 +243,24 @@ def get_employee_delete(id):
 
 @app.route("/employee/update/<id>", methods=["GET"])
 def get_employee_update(id):
-    employee = database.get_employee(id)
-    departments = database.get_departments()
-    positions = database.get_positions()
+    employee, departments, positions = database.gather(
+        lambda: database.get_employee(id), database.get_departments, database.get_positions
+    )
     return render_template("employee_update.html", employee=employee, departments=departments, positions=positions)
 
 @app.route("/employee/update/<id>", methods=["POST"])
 def post_employee_update(id):
     data = dict(request.form)
-    database.update_employee(id, data)
+    try:
+        database.update_employee(id, data)
+    except ValueError as error:
+        abort(400, str(error))
     return redirect(url_for("get_employee_list"))
 
 # Department Routes
 @app.route("/departments", methods=["GET"])
 def get_department_list():
-    departments = database.get_departments()
-    return render_template("department_list.html", departments=departments)
+    return render_list("department_list.html", "departments", "departments")
 
 @app.route("/department/create", methods=["GET"])
 def get_department_create():
@@ -78,8 +291,7 @@ def post_department_update(id):
 # Position Routes
 @app.route("/positions", methods=["GET"])
 def get_position_list():
-    positions = database.get_positions()
-    return render_template("position_list.html", positions=positions)
+    return render_list("position_list.html", "positions", "positions")
 
 @app.route("/position/create", methods=["GET"])
 def get_position_create():
@@ -99,8 +311,7 @@ def get_position_delete(id):
 
 @app.route("/position/update/<id>", methods=["GET"])
 def get_position_update(id):
-    position = database.get_position(id)
-    departments = database.get_departments()
+    position, departments = database.gather(lambda: database.get_position(id), database.get_departments)
     return render_template("position_update.html", position=position, departments=departments)
 
 @app.route("/position/update/<id>", methods=["POST"])
@@ -112,20 +323,25 @@ def post_position_update(id):
 # Attendance Routes
 @app.route("/attendances", methods=["GET"])
 def get_attendance_list():
-    attendances = database.get_attendances()
-    return render_template("attendance_list.html", attendances=attendances)
+    return render_list("attendance_list.html", "attendances", "attendance")
 
 @app.route("/attendance/create", methods=["GET"])
 def get_attendance_create():
-    employees = database.get_employees()
-    return render_template("attendance_create.html", employees=employees)
+    return render_template("attendance_create.html")
 
 @app.route("/attendance/create", methods=["POST"])
 def post_attendance_create():
     data = dict(request.form)
-    database.create_attendance(data)
+    try:
+        group_commit.attendance.submit(data)
+    except (group_commit.QueueFull, group_commit.NotCommitted) as error:
+        abort(503, str(error))
     return redirect(url_for("get_attendance_list"))
 
+@app.route("/attendance/import", methods=["POST"])
+def post_attendance_import():
+    return import_upload("attendance")
+
 @app.route("/attendance/delete/<id>", methods=["GET"])
 def get_attendance_delete(id):
     database.delete_attendance(id)
@@ -134,8 +350,8 @@ def get_attendance_delete(id):
 @app.route("/attendance/update/<id>", methods=["GET"])
 def get_attendance_update(id):
     attendance = database.get_attendance(id)
-    employees = database.get_employees()
-    return render_template("attendance_update.html", attendance=attendance, employees=employees)
+    employee = database.get_employee(attendance["EmployeeID"]) if attendance else None
+    return render_template("attendance_update.html", attendance=attendance, selected_employee=employee)
 
 @app.route("/attendance/update/<id>", methods=["POST"])
 def post_attendance_update(id):
@@ -146,18 +362,41 @@ def post_attendance_update(id):
 # Leave Routes
 @app.route("/leaves", methods=["GET"])
 def get_leave_list():
-    leaves = database.get_leaves()
-    return render_template("leave_list.html", leaves=leaves)
+    return render_list("leave_list.html", "leaves", "leaves")
+
+def employee_names(ids):
+    rows = database.get_by_ids("Employee_details", sorted(set(ids)))
+    return {row["EmployeeID"]: row["EmployeeName"] for row in rows}
+
+@app.route("/leaves/out", methods=["GET"])
+def get_leave_out():
+    date_from = request.args.get("date_from") or date.today().isoformat()
+    date_to = request.args.get("date_to") or date_from
+    try:
+        leaves = leave_index.get_index().who_is_out(date_from, date_to)
+    except ValueError as error:
+        abort(400, str(error))
+    names = employee_names({leave["EmployeeID"] for leave in leaves})
+    return render_template("leave_out.html", leaves=leaves, names=names, date_from=date_from, date_to=date_to)
+
+@app.route("/leaves/balances", methods=["GET"])
+def get_leave_balances():
+    year = api.int_arg("year", date.today().year)
+    page = leave_index.get_index().balances(year, after=api.int_arg("after"))
+    names = employee_names(balance["EmployeeID"] for balance in page["balances"])
+    return render_template("leave_balances.html", year=year, page=page, names=names)
 
 @app.route("/leave/create", methods=["GET"])
 def get_leave_create():
-    employees = database.get_employees()
-    return render_template("leave_create.html", employees=employees)
+    return render_template("leave_create.html")
 
 @app.route("/leave/create", methods=["POST"])
 def post_leave_create():
     data = dict(request.form)
-    database.create_leave(data)
+    try:
+        database.create_leave(data)
+    except ValueError as error:
+        abort(400, str(error))
     return redirect(url_for("get_leave_list"))
 
 @app.route("/leave/delete/<id>", methods=["GET"])
@@ -168,25 +407,26 @@ def get_leave_delete(id):
 @app.route("/leave/update/<id>", methods=["GET"])
 def get_leave_update(id):
     leave = database.get_leave(id)
-    employees = database.get_employees()
-    return render_template("leave_update.html", leave=leave, employees=employees)
+    employee = database.get_employee(leave["EmployeeID"]) if leave else None
+    return render_template("leave_update.html", leave=leave, selected_employee=employee)
 
 @app.route("/leave/update/<id>", methods=["POST"])
 def post_leave_update(id):
     data = dict(request.form)
-    database.update_leave(id, data)
+    try:
+        database.update_leave(id, data)
+    except ValueError as error:
+        abort(400, str(error))
     return redirect(url_for("get_leave_list"))
 
 # Project Routes
 @app.route("/projects", methods=["GET"])
 def get_project_list():
-    projects = database.get_projects()
-    return render_template("project_list.html", projects=projects)
+    return render_list("project_list.html", "projects", "projects")
 
 @app.route("/project/create", methods=["GET"])
 def get_project_create():
-    employees = database.get_employees()
-    return render_template("project_create.html", employees=employees)
+    return render_template("project_create.html")
 
 @app.route("/project/create", methods=["POST"])
 def post_project_create():
@@ -202,8 +442,8 @@ def get_project_delete(employee_id, team_id):
 @app.route("/project/update/<employee_id>/<team_id>", methods=["GET"])
 def get_project_update(employee_id, team_id):
     project = database.get_project(employee_id, team_id)
-    employees = database.get_employees()
-    return render_template("project_update.html", project=project, employees=employees)
+    employee = database.get_employee(project["EmployeeID"]) if project else None
+    return render_template("project_update.html", project=project, selected_employee=employee)
 
 @app.route("/project/update/<employee_id>/<team_id>", methods=["POST"])
 def post_project_update(employee_id, team_id):
@@ -214,20 +454,35 @@ def post_project_update(employee_id, team_id):
 # Payroll Routes
 @app.route("/payrolls", methods=["GET"])
 def get_payroll_list():
-    payrolls = database.get_payrolls()
-    return render_template("payroll_list.html", payrolls=payrolls)
+    return render_list("payroll_list.html", "payrolls", "payrolls")
 
 @app.route("/payroll/create", methods=["GET"])
 def get_payroll_create():
-    employees = database.get_employees()
-    return render_template("payroll_create.html", employees=employees)
+    return render_template("payroll_create.html")
 
 @app.route("/payroll/create", methods=["POST"])
 def post_payroll_create():
     data = dict(request.form)
-    database.create_payroll(data)
+    try:
+        database.create_payroll(data)
+    except ValueError as error:
+        abort(400, str(error))
     return redirect(url_for("get_payroll_list"))
 
+@app.route("/payroll/import", methods=["POST"])
+def post_payroll_import():
+    return import_upload("payroll")
+
+@app.route("/payroll/run", methods=["POST"])
+def post_payroll_run():
+    # A run rewrites a whole month: queue it rather than hold the request
+    try:
+        month = payroll_run.parse_month(request.form.get("month", ""))[0]
+        job_id = jobs.submit("payroll_run", {"month": month}, tenant=database.current_shard())
+    except ValueError as error:
+        abort(400, str(error))
+    return redirect(url_for("get_jobs", job=job_id))
+
 @app.route("/payroll/delete/<id>", methods=["GET"])
 def get_payroll_delete(id):
     database.delete_payroll(id)
@@ -236,14 +491,42 @@ def get_payroll_delete(id):
 @app.route("/payroll/update/<id>", methods=["GET"])
 def get_payroll_update(id):
     payroll = database.get_payroll(id)
-    employees = database.get_employees()
-    return render_template("payroll_update.html", payroll=payroll, employees=employees)
+    employee = database.get_employee(payroll["EmployeeID"]) if payroll else None
+    return render_template("payroll_update.html", payroll=payroll, selected_employee=employee)
 
 @app.route("/payroll/update/<id>", methods=["POST"])
 def post_payroll_update(id):
     data = dict(request.form)
-    database.update_payroll(id, data)
+    try:
+        database.update_payroll(id, data)
+    except ValueError as error:
+        abort(400, str(error))
     return redirect(url_for("get_payroll_list"))
 
+LIST_ENDPOINTS = (
+    "get_employee_list", "get_department_list", "get_position_list", "get_attendance_list",
+    "get_leave_list", "get_project_list", "get_payroll_list",
+)
+
+def init(database_file=DATABASE_FILE, pool_size=POOL_SIZE):
+    """Open the database and shards, warm the caches and start the job runner.
+
+    Importing main only defines the app, so a process that merely imports
+    it (a fan-out worker spawned by shards.py re-imports ``__main__``) opens
+    nothing and runs no jobs.
+    """
+    database.initialize(database_file, pool_size=pool_size)
+    shards.configure()
+    fragments.init_app(app, LIST_ENDPOINTS)
+    org_chart.get_chart().load()
+    leave_index.get_index().load()
+    jobs.runner.start()
+    return app
+
 if __name__ == "__main__":
+    # The reloader's parent process only watches files and restarts its
+    # child (WERKZEUG_RUN_MAIN=true), which serves: only the child opens
+    # the database and runs jobs
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        init()
     app.run(debug=True)
\ No newline at end of file
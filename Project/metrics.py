@@ -0,0 +1,295 @@
+"""Request and SQL instrumentation exposed in Prometheus text format.
+
+- Route latency histograms per endpoint, method and status.
+- Template render time, tracked apart from DB time within each request.
+- SQL execute time per calling function, plus fetch time and row counts,
+  collected through the cursor class pooled connections are opened with.
+- A slow-query log (logger ``ems.slow_query``) for statements slower than
+  SLOW_QUERY_SECONDS.
+- An opt-in sampling profiler: when the app has ``PROFILING`` enabled,
+  add ``?__profile=1`` to any URL to get folded stacks for that request.
+"""
+import collections
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+SLOW_QUERY_SECONDS = float(os.environ.get("EMS_SLOW_QUERY_MS", "100")) / 1000
+SLOW_QUERY_LOG_SIZE = 100
+PROFILE_INTERVAL = 0.001
+
+enabled = os.environ.get("EMS_METRICS", "1") != "0"
+slow_query_log = logging.getLogger("ems.slow_query")
+slow_queries = collections.deque(maxlen=SLOW_QUERY_LOG_SIZE)
+_lock = threading.Lock()
+_local = threading.local()
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+# metric name -> (help text, type, {labels tuple: Histogram or number})
+_metrics = {
+    "ems_http_request_duration_seconds": ("HTTP request latency by route.", "histogram", {}),
+    "ems_http_request_db_seconds": ("Time spent in SQL per HTTP request.", "histogram", {}),
+    "ems_template_render_seconds": ("Jinja template render time.", "histogram", {}),
+    "ems_db_query_duration_seconds": ("SQL execute time by calling function.", "histogram", {}),
+    "ems_db_fetch_seconds_total": ("Time spent fetching SQL results by calling function.", "counter", {}),
+    "ems_db_rows_total": ("Rows fetched by calling function.", "counter", {}),
+    "ems_db_slow_queries_total": ("Statements slower than the slow-query threshold.", "counter", {}),
+    "ems_group_commit_batch_rows": ("Rows written per group commit.", "histogram", {}),
+    "ems_group_commit_wait_seconds": ("Time from queueing a write to its commit.", "histogram", {}),
+    "ems_group_commit_rejected_total": ("Writes refused because the queue stayed full.", "counter", {}),
+}
+_label_names = {
+    "ems_http_request_duration_seconds": ("endpoint", "method", "status"),
+    "ems_http_request_db_seconds": ("endpoint",),
+    "ems_template_render_seconds": ("template",),
+    "ems_db_query_duration_seconds": ("function",),
+    "ems_db_fetch_seconds_total": ("function",),
+    "ems_db_rows_total": ("function",),
+    "ems_db_slow_queries_total": ("function",),
+    "ems_group_commit_batch_rows": ("queue",),
+    "ems_group_commit_wait_seconds": ("queue",),
+    "ems_group_commit_rejected_total": ("queue",),
+}
+# Histograms that count something other than seconds
+_buckets = {
+    "ems_group_commit_batch_rows": SIZE_BUCKETS,
+}
+
+def observe(name, labels, value):
+    series = _metrics[name][2]
+    with _lock:
+        histogram = series.get(labels)
+        if histogram is None:
+            histogram = series[labels] = Histogram(_buckets.get(name, BUCKETS))
+        histogram.observe(value)
+
+def increment(name, labels, value=1):
+    series = _metrics[name][2]
+    with _lock:
+        series[labels] = series.get(labels, 0) + value
+
+def reset():
+    with _lock:
+        for _, _, series in _metrics.values():
+            series.clear()
+        slow_queries.clear()
+
+def _caller(frame):
+    # Label statements with the outermost function of the calling module, so
+    # helpers such as database.fetch_page report as the page function using them
+    module = frame.f_globals
+    while frame.f_back is not None and frame.f_back.f_globals is module:
+        frame = frame.f_back
+    return f"{module.get('__name__')}.{frame.f_code.co_name}"
+
+def _add_db_time(seconds):
+    if getattr(_local, "db_time", None) is not None:
+        _local.db_time += seconds
+
+# SQL instrumentation
+class InstrumentedCursor(sqlite3.Cursor):
+    def _record(self, sql, started):
+        elapsed = time.perf_counter() - started
+        function = self._function
+        observe("ems_db_query_duration_seconds", (function,), elapsed)
+        _add_db_time(elapsed)
+        if elapsed >= SLOW_QUERY_SECONDS:
+            increment("ems_db_slow_queries_total", (function,))
+            statement = " ".join(sql.split())
+            slow_queries.append({"function": function, "seconds": elapsed, "sql": statement, "at": time.time()})
+            slow_query_log.warning("%.1f ms in %s: %s", elapsed * 1000, function, statement)
+
+    def execute(self, sql, parameters=()):
+        if not enabled:
+            return super().execute(sql, parameters)
+        self._function = _caller(sys._getframe(1))
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._record(sql, started)
+
+    def executemany(self, sql, parameters):
+        if not enabled:
+            return super().executemany(sql, parameters)
+        self._function = _caller(sys._getframe(1))
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            self._record(sql, started)
+
+    def _fetched(self, rows, started):
+        elapsed = time.perf_counter() - started
+        function = getattr(self, "_function", "unknown")
+        increment("ems_db_fetch_seconds_total", (function,), elapsed)
+        increment("ems_db_rows_total", (function,), rows)
+        _add_db_time(elapsed)
+
+    def fetchall(self):
+        if not enabled:
+            return super().fetchall()
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(len(rows), started)
+        return rows
+
+    def fetchmany(self, size=None):
+        if not enabled:
+            return super().fetchmany(size if size is not None else self.arraysize)
+        started = time.perf_counter()
+        rows = super().fetchmany(size if size is not None else self.arraysize)
+        self._fetched(len(rows), started)
+        return rows
+
+    def fetchone(self):
+        if not enabled:
+            return super().fetchone()
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(0 if row is None else 1, started)
+        return row
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+# Sampling profiler
+class Sampler:
+    """Sample one thread's stack every ``interval`` seconds from a helper thread."""
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + "\n"
+
+# Flask integration
+def init_app(app):
+    from flask import g, request, template_rendered, before_render_template
+
+    app.config.setdefault("PROFILING", os.environ.get("EMS_PROFILING") == "1")
+
+    @app.before_request
+    def start_request():
+        g.metrics_started = time.perf_counter()
+        _local.db_time = 0.0
+        if app.config["PROFILING"] and request.args.get("__profile"):
+            g.sampler = Sampler(threading.get_ident()).start()
+
+    @app.after_request
+    def finish_request(response):
+        started = g.pop("metrics_started", None)
+        sampler = g.pop("sampler", None)
+        if started is not None and enabled:
+            endpoint = request.endpoint or "unmatched"
+            elapsed = time.perf_counter() - started
+            observe("ems_http_request_duration_seconds", (endpoint, request.method, str(response.status_code)), elapsed)
+            observe("ems_http_request_db_seconds", (endpoint,), _local.db_time)
+        _local.db_time = None
+        if sampler is not None:
+            sampler.stop()
+            header = f"# {sampler.samples} samples every {sampler.interval * 1000:g} ms for {request.path}\n"
+            response = app.response_class(header + sampler.folded(), mimetype="text/plain")
+        return response
+
+    def render_started(sender, template, context, **extra):
+        _local.render_started = time.perf_counter()
+
+    def render_finished(sender, template, context, **extra):
+        started = getattr(_local, "render_started", None)
+        if started is not None and enabled:
+            observe("ems_template_render_seconds", (template.name or "string",), time.perf_counter() - started)
+        _local.render_started = None
+
+    before_render_template.connect(render_started, app, weak=False)
+    template_rendered.connect(render_finished, app, weak=False)
+
+# Prometheus text exposition
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def render(extra=None):
+    """Return all metrics, plus ``extra`` ({name: (help, type, {labels: value})})."""
+    lines = []
+    with _lock:
+        snapshot = {
+            name: (help_text, kind, {labels: (
+                (list(value.counts), value.sum, value.count) if isinstance(value, Histogram) else value
+            ) for labels, value in series.items()})
+            for name, (help_text, kind, series) in _metrics.items()
+        }
+    for name, (help_text, kind, series) in snapshot.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        names = _label_names[name]
+        for labels, value in sorted(series.items()):
+            if kind == "histogram":
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket in zip(_buckets.get(name, BUCKETS), counts):
+                    cumulative += bucket
+                    lines.append(f"{name}_bucket{_labels(names, labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{_labels(names, labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{_labels(names, labels)} {total}")
+                lines.append(f"{name}_count{_labels(names, labels)} {count}")
+            else:
+                lines.append(f"{name}{_labels(names, labels)} {value}")
+    for name, (help_text, kind, values) in (extra or {}).items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(values.items()):
+            lines.append(f"{name}{_labels([label for label, _ in labels], [v for _, v in labels])} {value}")
+    return "\n".join(lines) + "\n"
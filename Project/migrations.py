@@ -0,0 +1,649 @@
+import argparse
+import sys
+
+import conversions
+
+# Tables that existed when row versions were introduced; a migration step
+# must not change meaning as later steps add tables
+ROW_VERSIONED_TABLES = ("Department", "Position", "Employee_details", "Attendance", "Leave", "Project", "Payroll")
+
+def _add_row_versions(cursor):
+    # Every data row carries the value of a global counter bumped on each
+    # insert/update so exports can pick up only what changed since last run
+    cursor.execute("CREATE TABLE IF NOT EXISTS row_version (Value INTEGER NOT NULL)")
+    cursor.execute("INSERT INTO row_version (Value) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM row_version)")
+    for table in ROW_VERSIONED_TABLES:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN RowVersion INTEGER")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table.lower()}_row_version ON {table} (RowVersion)")
+        # The UPDATE trigger skips the trigger's own RowVersion write
+        for event, condition in (("INSERT", ""), ("UPDATE", "WHEN NEW.RowVersion IS OLD.RowVersion")):
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table.lower()}_{event.lower()}_row_version
+                AFTER {event} ON {table} {condition}
+                BEGIN
+                    UPDATE row_version SET Value = Value + 1;
+                    UPDATE {table} SET RowVersion = (SELECT Value FROM row_version)
+                    WHERE rowid = NEW.rowid;
+                END
+            """)
+
+def _add_table_versions(cursor):
+    # One change counter per table, bumped by every insert, update and delete
+    # (RowVersion cannot see deletes), so readers can tell cheaply whether
+    # anything a response depends on has changed
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS table_version (
+            TableName TEXT PRIMARY KEY,
+            Version INTEGER NOT NULL,
+            ModifiedAt INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    now = "CAST(strftime('%s', 'now') AS INTEGER)"
+    for table in ROW_VERSIONED_TABLES:
+        cursor.execute(f"INSERT OR IGNORE INTO table_version VALUES (?, 0, {now})", (table,))
+        # The row_version trigger's own RowVersion write is not a change
+        for event, condition in (("INSERT", ""), ("UPDATE", "WHEN NEW.RowVersion IS OLD.RowVersion"), ("DELETE", "")):
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table.lower()}_{event.lower()}_table_version
+                AFTER {event} ON {table} {condition}
+                BEGIN
+                    UPDATE table_version SET Version = Version + 1, ModifiedAt = {now}
+                    WHERE TableName = '{table}';
+                END
+            """)
+
+def _add_employee_search(cursor):
+    # employee_search answers prefix queries; employee_trigram backs the
+    # fuzzy fallback. Both index Employee_details without copying it.
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS employee_search USING fts5(
+            EmployeeName, Email, Phone,
+            content='Employee_details', content_rowid='EmployeeID',
+            prefix='1 2 3'
+        )
+    """)
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS employee_trigram USING fts5(
+            EmployeeName, Email,
+            content='Employee_details', content_rowid='EmployeeID',
+            tokenize='trigram'
+        )
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_employee_search_insert AFTER INSERT ON Employee_details
+        BEGIN
+            INSERT INTO employee_search (rowid, EmployeeName, Email, Phone)
+            VALUES (NEW.EmployeeID, NEW.EmployeeName, NEW.Email, NEW.Phone);
+            INSERT INTO employee_trigram (rowid, EmployeeName, Email)
+            VALUES (NEW.EmployeeID, NEW.EmployeeName, NEW.Email);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_employee_search_delete AFTER DELETE ON Employee_details
+        BEGIN
+            INSERT INTO employee_search (employee_search, rowid, EmployeeName, Email, Phone)
+            VALUES ('delete', OLD.EmployeeID, OLD.EmployeeName, OLD.Email, OLD.Phone);
+            INSERT INTO employee_trigram (employee_trigram, rowid, EmployeeName, Email)
+            VALUES ('delete', OLD.EmployeeID, OLD.EmployeeName, OLD.Email);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_employee_search_update
+        AFTER UPDATE OF EmployeeID, EmployeeName, Email, Phone ON Employee_details
+        BEGIN
+            INSERT INTO employee_search (employee_search, rowid, EmployeeName, Email, Phone)
+            VALUES ('delete', OLD.EmployeeID, OLD.EmployeeName, OLD.Email, OLD.Phone);
+            INSERT INTO employee_search (rowid, EmployeeName, Email, Phone)
+            VALUES (NEW.EmployeeID, NEW.EmployeeName, NEW.Email, NEW.Phone);
+            INSERT INTO employee_trigram (employee_trigram, rowid, EmployeeName, Email)
+            VALUES ('delete', OLD.EmployeeID, OLD.EmployeeName, OLD.Email);
+            INSERT INTO employee_trigram (rowid, EmployeeName, Email)
+            VALUES (NEW.EmployeeID, NEW.EmployeeName, NEW.Email);
+        END
+    """)
+    cursor.execute("INSERT INTO employee_search (employee_search) VALUES ('rebuild')")
+    cursor.execute("INSERT INTO employee_trigram (employee_trigram) VALUES ('rebuild')")
+
+SUMMARY_TABLES = {
+    "summary_employee_month": ("EmployeeID", "Month"),
+    "summary_department_month": ("DepartmentID", "Month"),
+    "summary_department_day": ("DepartmentID", "Date"),
+}
+
+def _department_of(employee):
+    return f"IFNULL((SELECT DepartmentID FROM Employee_details WHERE EmployeeID = {employee}), 0)"
+
+def _upsert(table, select):
+    owner, period = SUMMARY_TABLES[table]
+    return f"""
+        INSERT INTO {table} ({owner}, {period}, Source, Status, Days) {select}
+        ON CONFLICT ({owner}, {period}, Source, Status) DO UPDATE SET Days = Days + excluded.Days
+    """
+
+def _attendance_delta(row, sign):
+    # One attendance row adds or removes a day in each summary
+    status = f"IFNULL({row}.Status, '')"
+    month = f"substr({row}.Date, 1, 7)"
+    department = _department_of(f"{row}.EmployeeID")
+    statements = [
+        _upsert("summary_employee_month",
+                f"SELECT {row}.EmployeeID, {month}, 'attendance', {status}, {sign} "
+                f"WHERE {row}.EmployeeID IS NOT NULL AND {row}.Date IS NOT NULL"),
+        _upsert("summary_department_month",
+                f"SELECT {department}, {month}, 'attendance', {status}, {sign} WHERE {row}.Date IS NOT NULL"),
+        _upsert("summary_department_day",
+                f"SELECT {department}, {row}.Date, 'attendance', {status}, {sign} WHERE {row}.Date IS NOT NULL"),
+    ]
+    if sign < 0:
+        statements += [
+            f"DELETE FROM summary_employee_month WHERE EmployeeID = {row}.EmployeeID AND Month = {month} "
+            f"AND Source = 'attendance' AND Status = {status} AND Days <= 0",
+            f"DELETE FROM summary_department_month WHERE DepartmentID = {department} AND Month = {month} "
+            f"AND Source = 'attendance' AND Status = {status} AND Days <= 0",
+            f"DELETE FROM summary_department_day WHERE DepartmentID = {department} AND Date = {row}.Date "
+            f"AND Source = 'attendance' AND Status = {status} AND Days <= 0",
+        ]
+    return statements
+
+def _text(column):
+    # Leave dates are declared DATE (numeric affinity); comparing them with
+    # the TEXT calendar/summary dates uncast applies numeric affinity to the
+    # TEXT side and rules out the primary key, scanning every calendar day
+    return f"CAST({column} AS TEXT)"
+
+CALENDAR_JOIN = f"c.Date BETWEEN {_text('l.StartDate')} AND {_text('l.EndDate')}"
+
+def _leave_delta(row, sign):
+    # A leave adds or removes every calendar day between its start and end
+    status = f"IFNULL({row}.Status, '')"
+    department = _department_of(f"{row}.EmployeeID")
+    days = f"FROM calendar_day c WHERE c.Date BETWEEN {_text(row + '.StartDate')} AND {_text(row + '.EndDate')}"
+    months = f"BETWEEN substr({row}.StartDate, 1, 7) AND substr({row}.EndDate, 1, 7)"
+    statements = [
+        _upsert("summary_employee_month",
+                f"SELECT {row}.EmployeeID, substr(c.Date, 1, 7), 'leave', {status}, {sign} * COUNT(*) "
+                f"{days} AND {row}.EmployeeID IS NOT NULL GROUP BY substr(c.Date, 1, 7)"),
+        _upsert("summary_department_month",
+                f"SELECT {department}, substr(c.Date, 1, 7), 'leave', {status}, {sign} * COUNT(*) "
+                f"{days} GROUP BY substr(c.Date, 1, 7)"),
+        _upsert("summary_department_day",
+                f"SELECT {department}, c.Date, 'leave', {status}, {sign} {days}"),
+    ]
+    if sign < 0:
+        statements += [
+            f"DELETE FROM summary_employee_month WHERE EmployeeID = {row}.EmployeeID AND Month {months} "
+            f"AND Source = 'leave' AND Status = {status} AND Days <= 0",
+            f"DELETE FROM summary_department_month WHERE DepartmentID = {department} AND Month {months} "
+            f"AND Source = 'leave' AND Status = {status} AND Days <= 0",
+            f"DELETE FROM summary_department_day WHERE DepartmentID = {department} "
+            f"AND Date BETWEEN {_text(row + '.StartDate')} AND {_text(row + '.EndDate')} "
+            f"AND Source = 'leave' AND Status = {status} AND Days <= 0",
+        ]
+    return statements
+
+def _department_move(employee, old_department, new_department):
+    # Re-attribute an employee's history when their department changes
+    statements = []
+    for department, sign in ((old_department, -1), (new_department, 1)):
+        statements += [
+            _upsert("summary_department_month",
+                    f"SELECT {department}, substr(Date, 1, 7), 'attendance', IFNULL(Status, ''), {sign} * COUNT(*) "
+                    f"FROM Attendance WHERE EmployeeID = {employee} AND Date IS NOT NULL "
+                    f"GROUP BY substr(Date, 1, 7), IFNULL(Status, '')"),
+            _upsert("summary_department_day",
+                    f"SELECT {department}, Date, 'attendance', IFNULL(Status, ''), {sign} * COUNT(*) "
+                    f"FROM Attendance WHERE EmployeeID = {employee} AND Date IS NOT NULL "
+                    f"GROUP BY Date, IFNULL(Status, '')"),
+            _upsert("summary_department_month",
+                    f"SELECT {department}, substr(c.Date, 1, 7), 'leave', IFNULL(l.Status, ''), {sign} * COUNT(*) "
+                    f"FROM Leave l JOIN calendar_day c ON {CALENDAR_JOIN} "
+                    f"WHERE l.EmployeeID = {employee} GROUP BY substr(c.Date, 1, 7), IFNULL(l.Status, '')"),
+            _upsert("summary_department_day",
+                    f"SELECT {department}, c.Date, 'leave', IFNULL(l.Status, ''), {sign} * COUNT(*) "
+                    f"FROM Leave l JOIN calendar_day c ON {CALENDAR_JOIN} "
+                    f"WHERE l.EmployeeID = {employee} GROUP BY c.Date, IFNULL(l.Status, '')"),
+        ]
+    statements += [
+        f"DELETE FROM summary_department_month WHERE DepartmentID = {old_department} AND Days <= 0",
+        f"DELETE FROM summary_department_day WHERE DepartmentID = {old_department} AND Days <= 0",
+    ]
+    return statements
+
+def _trigger(cursor, name, event, statements, condition=""):
+    body = ";\n".join(statement.strip() for statement in statements)
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} {condition} BEGIN {body}; END")
+
+def _add_attendance_summaries(cursor):
+    # calendar_day lets triggers expand a leave's date range without a CTE,
+    # which SQLite does not allow inside trigger bodies
+    cursor.execute("CREATE TABLE IF NOT EXISTS calendar_day (Date TEXT PRIMARY KEY) WITHOUT ROWID")
+    cursor.execute("""
+        WITH RECURSIVE day(Date) AS (
+            SELECT '1990-01-01'
+            UNION ALL
+            SELECT date(Date, '+1 day') FROM day WHERE Date < '2099-12-31'
+        )
+        INSERT OR IGNORE INTO calendar_day (Date) SELECT Date FROM day
+    """)
+    for table, (owner, period) in SUMMARY_TABLES.items():
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                {owner} INTEGER NOT NULL,
+                {period} TEXT NOT NULL,
+                Source TEXT NOT NULL,
+                Status TEXT NOT NULL,
+                Days REAL NOT NULL,
+                PRIMARY KEY ({owner}, {period}, Source, Status)
+            ) WITHOUT ROWID
+        """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_summary_employee_month_month ON summary_employee_month (Month)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_summary_department_month_month ON summary_department_month (Month)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_summary_department_day_date ON summary_department_day (Date)")
+    # Count the rows already there; the triggers add every later change onto these
+    fill_summaries(cursor)
+    _add_summary_triggers(cursor)
+
+def fill_summaries(cursor):
+    """Recompute the summary tables from Attendance and Leave."""
+    for table in SUMMARY_TABLES:
+        cursor.execute(f"DELETE FROM {table}")
+
+    department = "IFNULL(e.DepartmentID, 0)"
+    attendance = """
+        FROM Attendance a LEFT JOIN Employee_details e ON e.EmployeeID = a.EmployeeID
+        WHERE a.Date IS NOT NULL
+    """
+    leave = f"""
+        FROM Leave l
+        JOIN calendar_day c ON {CALENDAR_JOIN}
+        LEFT JOIN Employee_details e ON e.EmployeeID = l.EmployeeID
+    """
+    cursor.execute(f"""
+        INSERT INTO summary_employee_month (EmployeeID, Month, Source, Status, Days)
+        SELECT a.EmployeeID, substr(a.Date, 1, 7), 'attendance', IFNULL(a.Status, ''), COUNT(*)
+        {attendance} AND a.EmployeeID IS NOT NULL
+        GROUP BY 1, 2, 4
+    """)
+    cursor.execute(f"""
+        INSERT INTO summary_employee_month (EmployeeID, Month, Source, Status, Days)
+        SELECT l.EmployeeID, substr(c.Date, 1, 7), 'leave', IFNULL(l.Status, ''), COUNT(*)
+        {leave} WHERE l.EmployeeID IS NOT NULL
+        GROUP BY 1, 2, 4
+    """)
+    for table, period in (("summary_department_month", "substr({}.Date, 1, 7)"), ("summary_department_day", "{}.Date")):
+        cursor.execute(f"""
+            INSERT INTO {table}
+            SELECT {department}, {period.format("a")}, 'attendance', IFNULL(a.Status, ''), COUNT(*)
+            {attendance}
+            GROUP BY 1, 2, 4
+        """)
+        cursor.execute(f"""
+            INSERT INTO {table}
+            SELECT {department}, {period.format("c")}, 'leave', IFNULL(l.Status, ''), COUNT(*)
+            {leave}
+            GROUP BY 1, 2, 4
+        """)
+
+SUMMARY_TRIGGERS = (
+    "trg_attendance_summary_insert", "trg_attendance_summary_delete", "trg_attendance_summary_update",
+    "trg_leave_summary_insert", "trg_leave_summary_delete", "trg_leave_summary_update",
+    "trg_employee_summary_department", "trg_employee_summary_delete",
+)
+
+def _add_summary_triggers(cursor):
+    _trigger(cursor, "trg_attendance_summary_insert", "AFTER INSERT ON Attendance",
+             _attendance_delta("NEW", 1))
+    _trigger(cursor, "trg_attendance_summary_delete", "AFTER DELETE ON Attendance",
+             _attendance_delta("OLD", -1))
+    _trigger(cursor, "trg_attendance_summary_update", "AFTER UPDATE OF EmployeeID, Date, Status ON Attendance",
+             _attendance_delta("OLD", -1) + _attendance_delta("NEW", 1))
+    _trigger(cursor, "trg_leave_summary_insert", "AFTER INSERT ON Leave",
+             _leave_delta("NEW", 1))
+    _trigger(cursor, "trg_leave_summary_delete", "AFTER DELETE ON Leave",
+             _leave_delta("OLD", -1))
+    _trigger(cursor, "trg_leave_summary_update", "AFTER UPDATE OF EmployeeID, StartDate, EndDate, Status ON Leave",
+             _leave_delta("OLD", -1) + _leave_delta("NEW", 1))
+    _trigger(cursor, "trg_employee_summary_department", "AFTER UPDATE OF DepartmentID ON Employee_details",
+             _department_move("NEW.EmployeeID", "IFNULL(OLD.DepartmentID, 0)", "IFNULL(NEW.DepartmentID, 0)"),
+             "WHEN IFNULL(OLD.DepartmentID, 0) != IFNULL(NEW.DepartmentID, 0)")
+    _trigger(cursor, "trg_employee_summary_delete", "AFTER DELETE ON Employee_details",
+             _department_move("OLD.EmployeeID", "IFNULL(OLD.DepartmentID, 0)", "0"),
+             "WHEN IFNULL(OLD.DepartmentID, 0) != 0")
+
+def _replace_summary_triggers(cursor):
+    for name in SUMMARY_TRIGGERS:
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+    _add_summary_triggers(cursor)
+
+def _add_typed_columns(cursor):
+    # Typed copies of the text columns, filled for existing rows by the
+    # chunked backfills below and written alongside the text by database.py
+    for table, column, declared in (
+        ("Employee_details", "PositionID", "INTEGER REFERENCES Position(PositionID)"),
+        ("Employee_details", "SalaryCents", "INTEGER"),
+        ("Employee_details", "ExperienceMonths", "INTEGER"),
+        ("Payroll", "MonthKey", "INTEGER"),
+        ("Payroll", "BasicPayCents", "INTEGER"),
+        ("Payroll", "DeductionsCents", "INTEGER"),
+        ("Payroll", "NetpayCents", "INTEGER"),
+    ):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declared}")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_employee_position_id ON Employee_details (PositionID)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_payroll_month_key ON Payroll (MonthKey, NetpayCents)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_payroll_employee_month_key ON Payroll (EmployeeID, MonthKey)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS data_migration (
+            Name TEXT PRIMARY KEY,
+            LastRowID INTEGER NOT NULL DEFAULT 0,
+            Rows INTEGER NOT NULL DEFAULT 0,
+            Failed INTEGER NOT NULL DEFAULT 0,
+            Done INTEGER NOT NULL DEFAULT 0,
+            UpdatedAt TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.executemany("INSERT OR IGNORE INTO data_migration (Name) VALUES (?)", [(name,) for name, *_ in BACKFILLS])
+
+def _change_log_triggers(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+    columns = cursor.fetchall()
+    keys = [column[1] for column in sorted(columns, key=lambda column: column[5]) if column[5]]
+    names = [column[1] for column in columns if column[1] != "RowVersion"]
+    key = lambda row: f"json_array({', '.join(f'{row}.{name}' for name in keys)})"
+    same_key = " AND ".join(f"NEW.{name} IS OLD.{name}" for name in keys)
+    changed = " UNION ALL ".join(f"SELECT '{name}' AS Name WHERE NEW.{name} IS NOT OLD.{name}" for name in names)
+    insert = "INSERT INTO change_log (TableName, RowKey, Operation, Columns) SELECT"
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table.lower()}_insert_change_log AFTER INSERT ON {table}
+        BEGIN {insert} '{table}', {key("NEW")}, 'insert', NULL; END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table.lower()}_delete_change_log AFTER DELETE ON {table}
+        BEGIN {insert} '{table}', {key("OLD")}, 'delete', NULL; END
+    """)
+    # The row_version trigger's own RowVersion write is not a change, and
+    # an update that moves a row to a new key is a delete and an insert
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table.lower()}_update_change_log AFTER UPDATE ON {table}
+        WHEN NEW.RowVersion IS OLD.RowVersion AND ({" OR ".join(f"NEW.{name} IS NOT OLD.{name}" for name in names)})
+        BEGIN
+            {insert} '{table}', {key("OLD")}, 'delete', NULL WHERE NOT ({same_key});
+            {insert} '{table}', {key("NEW")}, 'insert', NULL WHERE NOT ({same_key});
+            {insert} '{table}', {key("NEW")}, 'update', (SELECT json_group_array(Name) FROM ({changed}))
+            WHERE {same_key};
+        END
+    """)
+
+def _add_change_log(cursor):
+    # Every insert, update and delete of a data table appends a record in
+    # the same transaction. AUTOINCREMENT never hands out a Seq again, even
+    # one that compaction deleted; Columns lists the columns an update
+    # changed (NULL: the whole row). See changes.py.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS change_log (
+            Seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            TableName TEXT NOT NULL,
+            RowKey TEXT NOT NULL,
+            Operation TEXT NOT NULL,
+            Columns TEXT,
+            ChangedAt INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_change_log_row ON change_log (TableName, RowKey, Seq)")
+    # FloorSeq: records at or below it may have been dropped by retention;
+    # CompactedSeq: records at or below it hold one record per row
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS change_log_state (
+            FloorSeq INTEGER NOT NULL,
+            CompactedSeq INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("INSERT INTO change_log_state SELECT 0, 0 WHERE NOT EXISTS (SELECT 1 FROM change_log_state)")
+    for table in ROW_VERSIONED_TABLES:
+        _change_log_triggers(cursor, table)
+
+def _add_jobs(cursor):
+    # Background jobs and their schedules (see jobs.py). Times are unix
+    # seconds; HeartbeatAt is refreshed while a job runs, so a job whose
+    # process died can be told apart from a slow one and run again.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS job (
+            JobID INTEGER PRIMARY KEY AUTOINCREMENT,
+            Kind TEXT NOT NULL,
+            Params TEXT NOT NULL DEFAULT '{}',
+            Tenant TEXT,
+            Schedule TEXT,
+            Status TEXT NOT NULL DEFAULT 'queued',
+            Progress REAL NOT NULL DEFAULT 0,
+            Message TEXT,
+            Result TEXT,
+            Error TEXT,
+            Attempts INTEGER NOT NULL DEFAULT 0,
+            CancelRequested INTEGER NOT NULL DEFAULT 0,
+            Owner TEXT,
+            CreatedAt REAL NOT NULL,
+            RunAfter REAL NOT NULL,
+            StartedAt REAL,
+            FinishedAt REAL,
+            HeartbeatAt REAL
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_job_status ON job (Status, RunAfter)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS job_schedule (
+            Name TEXT PRIMARY KEY,
+            Kind TEXT NOT NULL,
+            Params TEXT NOT NULL DEFAULT '{}',
+            Tenant TEXT,
+            Cron TEXT NOT NULL,
+            NextRunAt REAL NOT NULL,
+            LastJobID INTEGER
+        )
+    """)
+
+# Ordered schema migrations applied on top of database.create_tables().
+# Each step runs once, inside the caller's transaction, and is recorded in
+# the schema_version table so initialize() can be called on every start.
+# A step is a list of SQL statements or callables taking a cursor.
+MIGRATIONS = [
+    (1, "index attendance by employee and date", [
+        "CREATE INDEX IF NOT EXISTS idx_attendance_employee_date ON Attendance (EmployeeID, Date)",
+        "CREATE INDEX IF NOT EXISTS idx_attendance_date ON Attendance (Date)",
+    ]),
+    (2, "index payroll by employee and month", [
+        "CREATE INDEX IF NOT EXISTS idx_payroll_employee_month ON Payroll (EmployeeID, Month)",
+        "CREATE INDEX IF NOT EXISTS idx_payroll_month ON Payroll (Month)",
+    ]),
+    (3, "index leave by employee and start date", [
+        "CREATE INDEX IF NOT EXISTS idx_leave_employee_start ON Leave (EmployeeID, StartDate)",
+        "CREATE INDEX IF NOT EXISTS idx_leave_start ON Leave (StartDate)",
+        "CREATE INDEX IF NOT EXISTS idx_leave_end ON Leave (EndDate)",
+    ]),
+    (4, "index employee department, position and team", [
+        "CREATE INDEX IF NOT EXISTS idx_employee_department ON Employee_details (DepartmentID)",
+        "CREATE INDEX IF NOT EXISTS idx_employee_position ON Employee_details (Position)",
+        "CREATE INDEX IF NOT EXISTS idx_employee_team ON Employee_details (TeamID)",
+    ]),
+    (5, "index position name and department", [
+        "CREATE INDEX IF NOT EXISTS idx_position_name ON Position (PositionName)",
+        "CREATE INDEX IF NOT EXISTS idx_position_department ON Position (DepartmentID)",
+    ]),
+    (6, "index project team", [
+        "CREATE INDEX IF NOT EXISTS idx_project_team ON Project (TeamID)",
+    ]),
+    (7, "row versions for incremental exports", [_add_row_versions]),
+    (8, "full-text employee search", [_add_employee_search]),
+    (9, "payroll run history", [
+        """
+        CREATE TABLE IF NOT EXISTS payroll_run (
+            Month TEXT PRIMARY KEY,
+            Employees INTEGER,
+            TotalNetpay REAL,
+            Seconds REAL,
+            Stages TEXT,
+            RunAt TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (10, "attendance and leave summaries", [_add_attendance_summaries]),
+    (11, "summary triggers use the calendar_day key", [_replace_summary_triggers]),
+    (12, "per-table change counters", [_add_table_versions]),
+    (13, "typed position, money, month and experience columns", [_add_typed_columns]),
+    (14, "change log", [_add_change_log]),
+    (15, "background jobs", [_add_jobs]),
+    # Migration 10 used to create the summaries empty; recount databases it upgraded
+    (16, "recount attendance and leave summaries", [fill_summaries]),
+]
+
+def current_version(connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT MAX(Version) FROM schema_version")
+    return cursor.fetchone()[0] or 0
+
+def migrate(connection, migrations=MIGRATIONS):
+    cursor = connection.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            Version INTEGER PRIMARY KEY,
+            Description TEXT,
+            AppliedAt TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    version = current_version(connection)
+    applied = []
+    for step, description, statements in sorted(migrations, key=lambda m: m[0]):
+        if step <= version:
+            continue
+        for statement in statements:
+            if callable(statement):
+                statement(cursor)
+            else:
+                cursor.execute(statement)
+        cursor.execute(
+            "INSERT INTO schema_version (Version, Description) VALUES (?, ?)",
+            (step, description),
+        )
+        applied.append(step)
+    return applied
+
+# Data backfills. Converting every existing row inside a schema migration
+# would hold the write lock for the whole table, so each backfill converts
+# CHUNK_SIZE rows per transaction, in rowid order, and records how far it
+# got in data_migration; an interrupted backfill resumes from there.
+BACKFILL_CHUNK_SIZE = 1000
+
+def _convert(changes, failures, column, parse, value):
+    try:
+        changes[column] = parse(value)
+    except ValueError:
+        failures.append(column)
+
+def _typed_employees(cursor, rows):
+    cursor.execute("SELECT PositionID, PositionName, DepartmentID FROM Position ORDER BY PositionID")
+    positions = {}
+    for position in cursor.fetchall():
+        positions.setdefault((position["PositionName"], position["DepartmentID"]), position["PositionID"])
+        positions.setdefault((position["PositionName"], None), position["PositionID"])
+    converted = []
+    for row in rows:
+        changes, failures = {}, []
+        if row["Position"] is not None:
+            changes["PositionID"] = positions.get((row["Position"], row["DepartmentID"]), positions.get((row["Position"], None)))
+            if changes["PositionID"] is None:
+                failures.append("PositionID")
+        _convert(changes, failures, "SalaryCents", conversions.cents, row["Salary"])
+        _convert(changes, failures, "ExperienceMonths", conversions.experience_months, row["Experience"])
+        _convert(changes, failures, "HireDate", conversions.iso_date, row["HireDate"])
+        _convert(changes, failures, "DOB", conversions.iso_date, row["DOB"])
+        converted.append((row, changes, failures))
+    return converted
+
+def _typed_payrolls(cursor, rows):
+    # The text columns are rewritten too: Month as "March-2025" and the
+    # amounts as plain numbers
+    converted = []
+    for row in rows:
+        changes, failures = {}, []
+        _convert(changes, failures, "MonthKey", conversions.month_key, row["Month"])
+        if changes.get("MonthKey") is not None:
+            changes["Month"] = conversions.month_label(changes["MonthKey"])
+        for column in ("BasicPay", "Deductions", "Netpay"):
+            _convert(changes, failures, f"{column}Cents", conversions.cents, row[column])
+            if changes.get(f"{column}Cents") is not None:
+                changes[column] = conversions.amount(changes[f"{column}Cents"])
+        converted.append((row, changes, failures))
+    return converted
+
+# (name, table, columns read, converter returning (row, {column: value}, failed columns) per row)
+BACKFILLS = [
+    ("typed employee columns", "Employee_details",
+     ("Position", "DepartmentID", "Salary", "Experience", "HireDate", "DOB",
+      "PositionID", "SalaryCents", "ExperienceMonths"), _typed_employees),
+    ("typed payroll columns", "Payroll",
+     ("Month", "BasicPay", "Deductions", "Netpay", "MonthKey", "BasicPayCents", "DeductionsCents", "NetpayCents"),
+     _typed_payrolls),
+]
+
+def backfill_step(cursor, chunk_size=BACKFILL_CHUNK_SIZE):
+    """Convert the next chunk of the first unfinished backfill.
+
+    Returns (name, rows read, rows failed), or None once every backfill is done.
+    """
+    for name, table, columns, convert in BACKFILLS:
+        cursor.execute("SELECT LastRowID, Done FROM data_migration WHERE Name = ?", (name,))
+        state = cursor.fetchone()
+        if state is None or state["Done"]:
+            continue
+        cursor.execute(
+            f"SELECT rowid AS _rowid, {', '.join(columns)} FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (state["LastRowID"], chunk_size),
+        )
+        rows = cursor.fetchall()
+        failed = 0
+        updates = {}
+        for row, changes, failures in convert(cursor, rows):
+            failed += bool(failures)
+            # Only rows whose values change are written, so a resumed or
+            # repeated chunk does not bump row versions again
+            changes = {column: value for column, value in changes.items() if row[column] != value}
+            if changes:
+                updates.setdefault(tuple(changes), []).append(tuple(changes.values()) + (row["_rowid"],))
+        for changed, values in updates.items():
+            assignments = ", ".join(f"{column} = ?" for column in changed)
+            cursor.executemany(f"UPDATE {table} SET {assignments} WHERE rowid = ?", values)
+        cursor.execute("""
+            UPDATE data_migration
+            SET LastRowID = ?, Rows = Rows + ?, Failed = Failed + ?, Done = ?, UpdatedAt = CURRENT_TIMESTAMP
+            WHERE Name = ?
+        """, (rows[-1]["_rowid"] if rows else state["LastRowID"], len(rows), failed, len(rows) < chunk_size, name))
+        return name, len(rows), failed
+    return None
+
+def backfill_status(connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT * FROM data_migration ORDER BY Name")
+    return [dict(row) for row in cursor.fetchall()]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Show or run the chunked data backfills.")
+    parser.add_argument("command", choices=["status", "backfill"])
+    parser.add_argument("--database", default="ems.db")
+    parser.add_argument("--chunk-size", type=int, default=BACKFILL_CHUNK_SIZE)
+    parser.add_argument("--pause-ms", type=float, default=0, help="sleep between chunks to leave room for other writers")
+    args = parser.parse_args(argv)
+
+    # database.py imports this module, so import it only when run as a script
+    import database
+    database.initialize(args.database, backfill=False)
+    if args.command == "backfill":
+        database.run_backfills(
+            args.chunk_size, args.pause_ms / 1000,
+            progress=lambda name, rows, failed: print(f"{name}: {rows} rows, {failed} not convertible"),
+        )
+    with database.get_connection() as connection:
+        for state in backfill_status(connection):
+            status = "done" if state["Done"] else f"at rowid {state['LastRowID']}"
+            print(f"{state['Name']}: {status}, {state['Rows']} rows read, {state['Failed']} not convertible")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,288 @@
+"""In-memory org chart: headcount and salary by department, position and team.
+
+The chart holds one small tuple per employee and project assignment plus
+running totals per department, position and team, so a request reads the
+totals and never aggregates Employee_details. It is loaded once by
+``get_chart().load()`` and then kept current a row at a time:
+
+- the CRUD functions in database.py report the keys they wrote once they
+  commit (database.on_change), and the chart re-reads just those rows;
+- writes it was not told about (another process, a bulk import, raw SQL)
+  move the table_version counters past the ones it has applied, and the
+  next read catches up on the rows whose RowVersion is newer, comparing
+  key sets when the counters moved further than those rows account for
+  (rows were deleted behind its back).
+
+Headcount and salary count active employees; ``employees`` counts all.
+"""
+import threading
+
+import database
+
+TABLES = ("Employee_details", "Department", "Position", "Project")
+TEAM_PAGE_SIZE = 100
+
+def _is_active(status):
+    return (status or "").strip().lower() == "active"
+
+class Rollup:
+    __slots__ = ("employees", "headcount", "salary_cents")
+
+    def __init__(self):
+        self.employees = 0
+        self.headcount = 0
+        self.salary_cents = 0
+
+    def add(self, active, salary, sign):
+        self.employees += sign
+        if active:
+            self.headcount += sign
+            self.salary_cents += salary * sign
+
+    def as_dict(self):
+        return {"employees": self.employees, "headcount": self.headcount, "salary": self.salary_cents / 100}
+
+class OrgChart:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.loaded = False
+
+    def _reset(self):
+        # EmployeeID -> (DepartmentID, PositionID, TeamID, active, salary cents)
+        self.employees = {}
+        # (EmployeeID, TeamID) -> Status
+        self.assignments = {}
+        self.departments = {}
+        self.positions = {}
+        self.total = Rollup()
+        self.by_department = {}
+        self.by_position = {}
+        self.by_team = {}
+        self.team_projects = {}
+        self.watermarks = {"Employee_details": 0, "Project": 0}
+        self.versions = {table: 0 for table in TABLES}
+
+    def load(self):
+        """Read the whole org structure; returns the number of employees."""
+        with self._lock, database.route("reader"), database.get_connection() as connection:
+            self._reset()
+            cursor = connection.cursor()
+            cursor.execute("BEGIN")
+            try:
+                self.versions = self._read_versions(cursor)
+                self._load_names(cursor)
+                cursor.execute("SELECT EmployeeID, DepartmentID, PositionID, TeamID, Status, SalaryCents, RowVersion FROM Employee_details")
+                self._apply_employees(cursor.fetchall())
+                cursor.execute("SELECT EmployeeID, TeamID, Status, RowVersion FROM Project")
+                self._apply_assignments(cursor.fetchall())
+            finally:
+                connection.rollback()
+            self.loaded = True
+            return len(self.employees)
+
+    def _read_versions(self, cursor):
+        cursor.execute(
+            f"SELECT TableName, Version FROM table_version WHERE TableName IN ({', '.join('?' * len(TABLES))})", TABLES
+        )
+        return dict(cursor.fetchall())
+
+    def _load_names(self, cursor):
+        cursor.execute("SELECT DepartmentID, DeptName FROM Department")
+        self.departments = dict(cursor.fetchall())
+        cursor.execute("SELECT PositionID, PositionName, DepartmentID FROM Position")
+        self.positions = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+    def _rollups(self, record, sign):
+        department, position, team, active, salary = record
+        self.total.add(active, salary, sign)
+        for totals, key in ((self.by_department, department), (self.by_position, position), (self.by_team, team)):
+            rollup = totals.get(key)
+            if rollup is None:
+                rollup = totals[key] = Rollup()
+            rollup.add(active, salary, sign)
+            if rollup.employees == 0:
+                del totals[key]
+
+    def _set_employee(self, employee_id, record):
+        old = self.employees.pop(employee_id, None)
+        if old is not None:
+            self._rollups(old, -1)
+        if record is not None:
+            self.employees[employee_id] = record
+            self._rollups(record, 1)
+
+    def _apply_employees(self, rows):
+        for employee_id, department, position, team, status, salary, version in rows:
+            self._set_employee(employee_id, (department, position, team, _is_active(status), salary or 0))
+            self.watermarks["Employee_details"] = max(self.watermarks["Employee_details"], version or 0)
+
+    def _set_assignment(self, key, status):
+        old = self.assignments.pop(key, None)
+        team = key[1]
+        if old is not None:
+            projects = self.team_projects[team]
+            projects[old] -= 1
+            if not projects[old]:
+                del projects[old]
+            if not projects:
+                del self.team_projects[team]
+        if status is not None:
+            self.assignments[key] = status
+            projects = self.team_projects.setdefault(team, {})
+            projects[status] = projects.get(status, 0) + 1
+
+    def _apply_assignments(self, rows):
+        for employee_id, team, status, version in rows:
+            self._set_assignment((employee_id, team), status or "")
+            self.watermarks["Project"] = max(self.watermarks["Project"], version or 0)
+
+    def apply(self, table, keys):
+        """database.on_change listener: bring the chart up to date after a write."""
+        if table not in TABLES or not self.loaded:
+            return
+        try:
+            self.sync(table, keys)
+        except Exception:
+            # Never fail a write that has already committed; reload on next read
+            self.loaded = False
+
+    def sync(self, table=None, keys=None):
+        with self._lock, database.get_connection() as connection:
+            cursor = connection.cursor()
+            began = not connection.in_transaction
+            if began:
+                cursor.execute("BEGIN")
+            try:
+                versions = self._read_versions(cursor)
+                moved = {name for name in TABLES if versions.get(name, 0) != self.versions.get(name, 0)}
+                # Only the reported rows changed: re-read just those
+                if keys is not None and moved <= {table} and versions.get(table, 0) - self.versions.get(table, 0) <= len(keys):
+                    self._sync_keys(cursor, table, keys)
+                else:
+                    for name in moved:
+                        self._catch_up(cursor, name, versions.get(name, 0) - self.versions.get(name, 0))
+                self.versions = versions
+            finally:
+                if began:
+                    connection.rollback()
+
+    def _sync_keys(self, cursor, table, keys):
+        if table == "Employee_details":
+            for key in keys:
+                cursor.execute(
+                    "SELECT EmployeeID, DepartmentID, PositionID, TeamID, Status, SalaryCents, RowVersion FROM Employee_details WHERE EmployeeID = ?",
+                    (key,),
+                )
+                row = cursor.fetchone()
+                if row is None:
+                    self._set_employee(int(key), None)
+                else:
+                    self._apply_employees([row])
+        elif table == "Project":
+            for employee_id, team in keys:
+                cursor.execute(
+                    "SELECT EmployeeID, TeamID, Status, RowVersion FROM Project WHERE EmployeeID = ? AND TeamID = ?",
+                    (employee_id, team),
+                )
+                row = cursor.fetchone()
+                if row is None:
+                    self._set_assignment((int(employee_id), int(team)), None)
+                else:
+                    self._apply_assignments([row])
+        else:
+            self._load_names(cursor)
+
+    def _catch_up(self, cursor, table, changed):
+        # table_version moves once per row inserted, updated or deleted; when
+        # it moved further than the rows re-read here, some were deleted (a
+        # delete leaves no RowVersion behind) and only the key sets can show which
+        if table == "Employee_details":
+            cursor.execute(
+                "SELECT EmployeeID, DepartmentID, PositionID, TeamID, Status, SalaryCents, RowVersion FROM Employee_details WHERE RowVersion > ?",
+                (self.watermarks[table],),
+            )
+            rows = cursor.fetchall()
+            self._apply_employees(rows)
+            if changed != len(rows):
+                cursor.execute("SELECT EmployeeID FROM Employee_details")
+                for employee_id in set(self.employees) - {row[0] for row in cursor.fetchall()}:
+                    self._set_employee(employee_id, None)
+        elif table == "Project":
+            cursor.execute(
+                "SELECT EmployeeID, TeamID, Status, RowVersion FROM Project WHERE RowVersion > ?",
+                (self.watermarks[table],),
+            )
+            rows = cursor.fetchall()
+            self._apply_assignments(rows)
+            if changed != len(rows):
+                cursor.execute("SELECT EmployeeID, TeamID FROM Project")
+                for key in set(self.assignments) - {tuple(row) for row in cursor.fetchall()}:
+                    self._set_assignment(key, None)
+        else:
+            self._load_names(cursor)
+
+    def current(self):
+        """Load or catch up when the tables have moved past what the chart holds."""
+        if not self.loaded:
+            self.load()
+            return
+        # Cached counters: no query unless a write was committed since
+        versions = database.data_versions(TABLES)
+        if any(version > self.versions.get(table, 0) for table, version in zip(TABLES, versions)):
+            self.sync()
+
+    def summary(self):
+        """Totals, and each department with its positions."""
+        self.current()
+        with self._lock:
+            positions = {}
+            for position_id, (name, department_id) in sorted(self.positions.items()):
+                positions.setdefault(department_id, []).append(
+                    dict(id=position_id, name=name, **self.by_position.get(position_id, Rollup()).as_dict())
+                )
+            departments = []
+            for department_id in sorted(set(self.departments) | set(self.by_department), key=lambda key: (key is None, key or 0)):
+                rollup = self.by_department.get(department_id, Rollup())
+                departments.append(dict(
+                    id=department_id, name=self.departments.get(department_id),
+                    positions=positions.get(department_id, []), **rollup.as_dict()
+                ))
+            return {
+                "total": self.total.as_dict(),
+                "departments": departments,
+                "teams": len(set(self.by_team) | set(self.team_projects)),
+            }
+
+    def teams(self, after=None, limit=TEAM_PAGE_SIZE):
+        """Teams in id order after ``after``, with headcount and project staffing."""
+        self.current()
+        with self._lock:
+            ids = sorted(team for team in set(self.by_team) | set(self.team_projects) if team is not None)
+            if after is not None:
+                ids = [team for team in ids if team > after]
+            page = ids[:limit]
+            teams = []
+            for team in page:
+                projects = self.team_projects.get(team, {})
+                teams.append(dict(
+                    id=team, **self.by_team.get(team, Rollup()).as_dict(),
+                    assignments=sum(projects.values()), projects=dict(sorted(projects.items())),
+                ))
+            return {"teams": teams, "next_after": page[-1] if len(ids) > limit else None}
+
+# One chart per tenant shard (None: the default database)
+_charts = {}
+
+def get_chart():
+    """The chart of this thread's shard, loaded on its first read."""
+    shard = database.current_shard()
+    chart = _charts.get(shard)
+    if chart is None:
+        chart = _charts.setdefault(shard, OrgChart())
+    return chart
+
+@database.on_change
+def _apply(table, keys):
+    chart = _charts.get(database.current_shard())
+    if chart is not None:
+        chart.apply(table, keys)
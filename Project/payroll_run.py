@@ -0,0 +1,192 @@
+"""Monthly payroll run.
+
+Computes BasicPay, Deductions and Netpay for every active employee for one
+month and writes the rows in a single transaction. Each stage is one
+set-based SQL statement over the whole workforce, so no Python code runs
+per employee.
+
+BasicPay is the employee's Salary. Deductions are a daily rate
+(BasicPay / days in the month) times the unpaid days, rounded to the cent:
+- Absent attendance counts one day and Half Day half a day, unless an
+  approved leave covers that date.
+- Approved leave (database.is_approved_leave) is unpaid once the days taken
+  since January pass the yearly database.LEAVE_ALLOWANCE_DAYS, the same
+  allowance leave_index balances count down.
+
+Re-running a month replaces all of that month's Payroll rows, including
+those of employees no longer active, so runs are idempotent.
+
+    python payroll_run.py March-2025
+"""
+import argparse
+import json
+import sys
+import time
+from datetime import date, timedelta
+
+import conversions
+import database
+
+STAGES = ("employees", "attendance", "leave", "write")
+
+def parse_month(month):
+    """Accept "March-2025" or "2025-03"; return (label, month key, first day, last day)."""
+    key = conversions.month_key(month)
+    if key is None:
+        raise ValueError("a month is required, e.g. March-2025 or 2025-03")
+    return (conversions.month_label(key), key) + conversions.month_bounds(key)
+
+def _covered_by_leave(alias):
+    return f"""
+        EXISTS (
+            SELECT 1 FROM Leave l
+            WHERE l.EmployeeID = {alias}.EmployeeID
+              AND {database.approved_leave_sql("l.Status")}
+              AND l.StartDate <= {alias}.Date AND l.EndDate >= {alias}.Date
+        )
+    """
+
+def run_payroll(month, leave_allowance=None, progress=None):
+    """Run payroll for ``month`` and return a summary of the run.
+
+    ``leave_allowance`` is the yearly days of paid leave, by default
+    database.LEAVE_ALLOWANCE_DAYS.
+
+    ``progress(done, total, stage)`` is called as each of STAGES finishes;
+    an exception it raises rolls the whole run back.
+    """
+    label, key, first, last = parse_month(month)
+    days_in_month = int(last[-2:])
+    if leave_allowance is None:
+        leave_allowance = database.LEAVE_ALLOWANCE_DAYS
+    year_start = f"{first[:4]}-01-01"
+    before = (date.fromisoformat(first) - timedelta(days=1)).isoformat()
+    stages = {}
+    started = time.perf_counter()
+
+    def stage(name, clock):
+        stages[name] = round(time.perf_counter() - clock, 6)
+        if progress is not None:
+            progress(len(stages), len(STAGES), name)
+        return time.perf_counter()
+
+    with database.transaction() as connection:
+        cursor = connection.cursor()
+        # Take the write lock up front so every stage sees one snapshot
+        if not connection.in_transaction:
+            cursor.execute("BEGIN IMMEDIATE")
+        try:
+            clock = time.perf_counter()
+            cursor.execute("DROP TABLE IF EXISTS temp.run_employee")
+            cursor.execute("""
+                CREATE TEMP TABLE run_employee AS
+                SELECT EmployeeID, IFNULL(SalaryCents, 0) AS BasicPay
+                FROM Employee_details
+                WHERE lower(Status) = 'active'
+                  AND (HireDate IS NULL OR HireDate <= ?)
+            """, (last,))
+            cursor.execute("CREATE UNIQUE INDEX temp.run_employee_id ON run_employee (EmployeeID)")
+            clock = stage("employees", clock)
+
+            cursor.execute("DROP TABLE IF EXISTS temp.run_absence")
+            cursor.execute(f"""
+                CREATE TEMP TABLE run_absence AS
+                SELECT a.EmployeeID,
+                       SUM(CASE lower(a.Status) WHEN 'absent' THEN 1.0 WHEN 'half day' THEN 0.5 ELSE 0 END) AS Days
+                FROM Attendance a
+                WHERE a.Date BETWEEN ? AND ?
+                  AND lower(a.Status) IN ('absent', 'half day')
+                  AND NOT {_covered_by_leave("a")}
+                GROUP BY a.EmployeeID
+            """, (first, last))
+            clock = stage("attendance", clock)
+
+            cursor.execute("DROP TABLE IF EXISTS temp.run_leave")
+            # Approved days taken this year up to the end of the month and before it
+            cursor.execute(f"""
+                CREATE TEMP TABLE run_leave AS
+                SELECT EmployeeID,
+                       SUM(julianday(MIN(EndDate, :last)) - julianday(MAX(StartDate, :year_start)) + 1) AS ToDate,
+                       SUM(MAX(julianday(MIN(EndDate, :before)) - julianday(MAX(StartDate, :year_start)) + 1, 0)) AS Earlier
+                FROM Leave
+                WHERE StartDate <= :last AND EndDate >= :year_start AND {database.approved_leave_sql("Status")}
+                GROUP BY EmployeeID
+            """, {"last": last, "year_start": year_start, "before": before})
+            clock = stage("leave", clock)
+
+            cursor.execute("DELETE FROM Payroll WHERE MonthKey = ?", (key,))
+            replaced = cursor.rowcount
+            cursor.execute("""
+                INSERT INTO Payroll (
+                    EmployeeID, Month, MonthKey, BasicPay, Deductions, Netpay,
+                    BasicPayCents, DeductionsCents, NetpayCents
+                )
+                SELECT EmployeeID, :label, :key, BasicPay / 100.0, Deductions / 100.0, (BasicPay - Deductions) / 100.0,
+                       BasicPay, Deductions, BasicPay - Deductions
+                FROM (
+                    SELECT e.EmployeeID, e.BasicPay,
+                           CAST(ROUND(MIN(
+                               e.BasicPay * 1.0 / :days * (
+                                   IFNULL(a.Days, 0) + MAX(IFNULL(l.ToDate, 0) - :allowance, 0)
+                                   - MAX(IFNULL(l.Earlier, 0) - :allowance, 0)
+                               ),
+                               e.BasicPay
+                           )) AS INTEGER) AS Deductions
+                    FROM run_employee e
+                    LEFT JOIN run_absence a ON a.EmployeeID = e.EmployeeID
+                    LEFT JOIN run_leave l ON l.EmployeeID = e.EmployeeID
+                )
+                ORDER BY EmployeeID
+            """, {"label": label, "key": key, "days": days_in_month, "allowance": leave_allowance})
+            employees = cursor.rowcount
+            cursor.execute(
+                "SELECT IFNULL(SUM(NetpayCents), 0) FROM Payroll WHERE MonthKey = ?", (key,),
+            )
+            total_netpay = conversions.amount(cursor.fetchone()[0])
+            clock = stage("write", clock)
+
+            summary = {
+                "month": label,
+                "employees": employees,
+                "replaced": replaced,
+                "total_netpay": round(total_netpay, 2),
+                "stages": stages,
+                "seconds": round(time.perf_counter() - started, 6),
+            }
+            cursor.execute("""
+                INSERT OR REPLACE INTO payroll_run (Month, Employees, TotalNetpay, Seconds, Stages)
+                VALUES (?, ?, ?, ?, ?)
+            """, (label, employees, summary["total_netpay"], summary["seconds"], json.dumps(stages)))
+            database.tables_changed("Payroll")
+        finally:
+            for table in ("run_employee", "run_absence", "run_leave"):
+                cursor.execute(f"DROP TABLE IF EXISTS temp.{table}")
+    return summary
+
+@database.reads
+def get_runs():
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT * FROM payroll_run ORDER BY RunAt DESC")
+        return [dict(run) for run in cursor.fetchall()]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute payroll for every active employee for a month.")
+    parser.add_argument("month", help='e.g. "March-2025" or "2025-03"')
+    parser.add_argument("--database", default="ems.db")
+    parser.add_argument("--leave-allowance", type=float, default=database.LEAVE_ALLOWANCE_DAYS,
+                        help="paid leave days per year")
+    args = parser.parse_args(argv)
+
+    database.initialize(args.database)
+    summary = run_payroll(args.month, args.leave_allowance)
+    for name, seconds in summary["stages"].items():
+        print(f"  {name:<12}{seconds * 1000:10.1f} ms")
+    print(
+        f"{summary['month']}: {summary['employees']} employees, "
+        f"net pay {summary['total_netpay']:.2f}, {summary['seconds']:.2f}s"
+    )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
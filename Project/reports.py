@@ -0,0 +1,151 @@
+"""Attendance and leave summaries for reporting.
+
+Three pre-aggregated tables count days per status: per employee per month,
+per department per month and per department per day. Each leave is
+expanded into the calendar days it covers. Triggers created by migration
+10 keep the tables up to date on every insert, update or delete of
+Attendance, Leave or an employee's department, starting from the counts
+the migration takes of the rows already there. Report queries therefore
+read only the aggregates, whatever the history size. rebuild() recomputes
+everything from the base tables.
+
+    python reports.py rebuild
+"""
+import argparse
+import sys
+from datetime import date
+
+import database
+import migrations
+
+SUMMARY_TABLES = ("summary_employee_month", "summary_department_month", "summary_department_day")
+
+def _rebuild(cursor):
+    migrations.fill_summaries(cursor)
+
+def rebuild():
+    with database.transaction() as connection:
+        _rebuild(connection.cursor())
+    return summary_counts()
+
+@database.reads
+def summary_counts():
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        counts = {}
+        for table in SUMMARY_TABLES:
+            cursor.execute(f"SELECT COUNT(*) FROM {table}")
+            counts[table] = cursor.fetchone()[0]
+        return counts
+
+def verify():
+    """Return summary rows that differ from a fresh rebuild (empty if in sync)."""
+    differences = {}
+    with database.transaction() as connection:
+        cursor = connection.cursor()
+        if not connection.in_transaction:
+            cursor.execute("BEGIN")
+        cursor.execute("SAVEPOINT summary_verify")
+        snapshots = {}
+        for table in SUMMARY_TABLES:
+            cursor.execute(f"SELECT * FROM {table}")
+            snapshots[table] = {tuple(row) for row in cursor.fetchall()}
+        _rebuild(cursor)
+        for table in SUMMARY_TABLES:
+            cursor.execute(f"SELECT * FROM {table}")
+            expected = {tuple(row) for row in cursor.fetchall()}
+            if expected != snapshots[table]:
+                differences[table] = {
+                    "missing": sorted(expected - snapshots[table]),
+                    "unexpected": sorted(snapshots[table] - expected),
+                }
+        cursor.execute("ROLLBACK TO summary_verify")
+        cursor.execute("RELEASE summary_verify")
+    return differences
+
+def current_month():
+    return date.today().strftime("%Y-%m")
+
+def _pivot(rows, key):
+    pivot = {}
+    for row in rows:
+        entry = pivot.setdefault(row[key], {key: row[key], "name": row["Name"], "attendance": {}, "leave": {}})
+        entry[row["Source"]][row["Status"]] = row["Days"]
+    return list(pivot.values())
+
+@database.reads
+def get_department_month(month):
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT s.DepartmentID, d.DeptName AS Name, s.Source, s.Status, s.Days
+            FROM summary_department_month s
+            LEFT JOIN Department d ON d.DepartmentID = s.DepartmentID
+            WHERE s.Month = ?
+            ORDER BY s.DepartmentID
+        """, (month,))
+        return _pivot(cursor.fetchall(), "DepartmentID")
+
+@database.reads
+def get_employee_month(month, employee_id=None):
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        if employee_id is None:
+            cursor.execute("""
+                SELECT s.EmployeeID, e.EmployeeName AS Name, s.Source, s.Status, s.Days
+                FROM summary_employee_month s
+                LEFT JOIN Employee_details e ON e.EmployeeID = s.EmployeeID
+                WHERE s.Month = ?
+                ORDER BY s.EmployeeID
+            """, (month,))
+        else:
+            cursor.execute("""
+                SELECT s.EmployeeID, e.EmployeeName AS Name, s.Source, s.Status, s.Days
+                FROM summary_employee_month s
+                LEFT JOIN Employee_details e ON e.EmployeeID = s.EmployeeID
+                WHERE s.EmployeeID = ? AND s.Month = ?
+            """, (employee_id, month))
+        return _pivot(cursor.fetchall(), "EmployeeID")
+
+@database.reads
+def get_daily_totals(month, department_id=None):
+    params = [f"{month}-01", f"{month}-31"]
+    where = "Date BETWEEN ? AND ?"
+    if department_id is not None:
+        where += " AND DepartmentID = ?"
+        params.append(department_id)
+    with database.get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(f"""
+            SELECT Date, Source, Status, SUM(Days) AS Days
+            FROM summary_department_day
+            WHERE {where}
+            GROUP BY Date, Source, Status
+            ORDER BY Date
+        """, params)
+        days = {}
+        for row in cursor.fetchall():
+            entry = days.setdefault(row["Date"], {"Date": row["Date"], "attendance": {}, "leave": {}})
+            entry[row["Source"]][row["Status"]] = row["Days"]
+        return list(days.values())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the attendance and leave summary tables.")
+    parser.add_argument("command", choices=["rebuild", "verify"])
+    parser.add_argument("--database", default="ems.db")
+    args = parser.parse_args(argv)
+
+    database.initialize(args.database)
+    if args.command == "rebuild":
+        for table, count in rebuild().items():
+            print(f"{table}: {count} rows")
+        return 0
+    differences = verify()
+    for table, diff in differences.items():
+        print(f"{table}: {len(diff['missing'])} missing, {len(diff['unexpected'])} unexpected rows")
+    if not differences:
+        print("Summaries match the base tables.")
+    return 1 if differences else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,302 @@
+"""Tenant shards: one database file per tenant.
+
+A tenant's data lives in its own SQLite file with its own writer and
+readers (database.use_shard), so tenants do not share a write lock, a page
+cache or a cached entry. The shards are listed in EMS_SHARDS as
+``name=path`` pairs, or are the ``<name>.db`` files of EMS_SHARD_DIR:
+
+    EMS_SHARDS=acme=shards/acme.db,globex=shards/globex.db
+
+A request names its tenant in the X-Tenant header or the ``tenant`` query
+argument; requests without one use the file given to database.initialize.
+Lists and reports across every tenant run the same database.py or
+reports.py function on each shard in a process pool (fan_out) and merge
+the results.
+
+split() divides an existing database into shards by ranges of DepartmentID;
+each employee goes with their department and attendance, leave, projects
+and payroll go with the employee:
+
+    python shards.py split --database ems.db --output shards --tenant acme=1-10 --tenant globex=11-20 --rest other
+    python shards.py list --output shards
+"""
+import argparse
+import glob
+import heapq
+import importlib
+import itertools
+import multiprocessing
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import database
+import reports
+
+TENANT_HEADER = "X-Tenant"
+TENANT_ARG = "tenant"
+FAN_OUT_WORKERS = int(os.environ.get("EMS_FAN_OUT_WORKERS", os.cpu_count() or 1))
+# Tables copied by split, parents first; the first three carry a DepartmentID
+SPLIT_TABLES = database.TABLES
+DEPARTMENT_TABLES = ("Department", "Position", "Employee_details")
+
+def load_config(spec=None, directory=None):
+    """Return {tenant: database file} from an EMS_SHARDS spec or a shard directory."""
+    spec = os.environ.get("EMS_SHARDS", "") if spec is None else spec
+    directory = os.environ.get("EMS_SHARD_DIR") if directory is None else directory
+    files = {}
+    if directory:
+        for path in sorted(glob.glob(os.path.join(directory, "*.db"))):
+            files[os.path.splitext(os.path.basename(path))[0]] = path
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        name, separator, path = entry.partition("=")
+        if not separator or not name.strip() or not path.strip():
+            raise ValueError(f"invalid shard {entry!r}, expected name=path")
+        files[name.strip()] = path.strip()
+    return files
+
+def configure(spec=None, directory=None):
+    files = load_config(spec, directory)
+    database.configure_shards(files)
+    return files
+
+def tenant_of(request):
+    """The tenant a Flask request names, None for the default database."""
+    return request.headers.get(TENANT_HEADER) or request.args.get(TENANT_ARG) or None
+
+# Fan-out across shards
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+def _worker_init(files):
+    database.configure_shards(files)
+
+def _run(tenant, module, name, args, kwargs):
+    function = getattr(importlib.import_module(module), name)
+    with database.use_shard(tenant):
+        return function(*args, **kwargs)
+
+def _pool():
+    global _executor, _executor_pid
+    if _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor_pid != os.getpid():
+                # Spawned workers start clean, without the parent's threads or open connections
+                _executor = ProcessPoolExecutor(
+                    max_workers=max(1, min(FAN_OUT_WORKERS, len(database.shard_names()))),
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_worker_init, initargs=(database.shard_files(),),
+                )
+                _executor_pid = os.getpid()
+    return _executor
+
+def _gather(function, calls):
+    # calls: {tenant: (args, kwargs)}
+    pool = _pool() if calls else None
+    futures = {
+        tenant: pool.submit(_run, tenant, function.__module__, function.__name__, args, kwargs)
+        for tenant, (args, kwargs) in calls.items()
+    }
+    return {tenant: future.result() for tenant, future in futures.items()}
+
+def fan_out(function, *args, tenants=None, **kwargs):
+    """Run a module-level ``function`` on every shard; returns {tenant: result}.
+
+    ``function`` must be importable by name (a database.py or reports.py
+    function, say) and its arguments and result picklable.
+    """
+    tenants = database.shard_names() if tenants is None else tenants
+    return _gather(function, {tenant: (args, kwargs) for tenant in tenants})
+
+def shutdown():
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is not None and _executor_pid == os.getpid():
+            _executor.shutdown()
+        _executor = _executor_pid = None
+
+def _sort_key(values):
+    # SQLite's order across storage classes: NULL, numbers, text, blobs
+    return [
+        (0, 0) if value is None else (1, value) if isinstance(value, (int, float))
+        else (2, value) if isinstance(value, str) else (3, value)
+        for value in values
+    ]
+
+def fetch_pages(fetch, after=None, limit=database.PAGE_SIZE, order="asc", **args):
+    """One page of ``fetch`` (a get_*_page function) over every shard.
+
+    Every tenant still holding rows is asked for ``limit`` rows after its
+    own cursor; the pages are merged on the sort key and cut at ``limit``,
+    each row with a ``Tenant`` column. ``next_cursor`` holds, per tenant
+    that has more, the cursor after the last of its rows on this page, so
+    a tenant that runs out drops out of later pages.
+    """
+    tenants = database.shard_names()
+    if after:
+        values = database.decode_cursor(after)
+        if not all(isinstance(value, list) and len(value) == 2 and value[0] in tenants for value in values):
+            raise ValueError("invalid cursor")
+        cursors = dict(values)
+    else:
+        cursors = dict.fromkeys(tenants)
+    limit = max(1, min(int(limit or database.PAGE_SIZE), database.MAX_PAGE_SIZE))
+    pages = _gather(fetch, {
+        tenant: ((), dict(args, order=order, after=cursor, limit=limit, row_keys=True))
+        for tenant, cursor in cursors.items()
+    })
+    merged = heapq.merge(
+        *([(tenant, row) for row in pages[tenant]["rows"]] for tenant in cursors),
+        key=lambda entry: _sort_key(entry[1]["_keys"]), reverse=order == "desc",
+    )
+    rows = []
+    taken = dict.fromkeys(cursors, 0)
+    for tenant, row in itertools.islice(merged, limit):
+        taken[tenant] += 1
+        cursors[tenant] = database.encode_cursor(row.pop("_keys"))
+        rows.append(dict(row, Tenant=tenant))
+    following = [
+        [tenant, cursor] for tenant, cursor in cursors.items()
+        if taken[tenant] < len(pages[tenant]["rows"]) or pages[tenant]["next_cursor"]
+    ]
+    return {"rows": rows, "next_cursor": database.encode_cursor(following) if following else None, "limit": limit}
+
+def summary_counts():
+    """reports.summary_counts of every shard, and their sum under ``total``."""
+    counts = fan_out(reports.summary_counts)
+    total = {}
+    for tenant_counts in counts.values():
+        for table, count in tenant_counts.items():
+            total[table] = total.get(table, 0) + count
+    return {"tenants": counts, "total": total}
+
+def get_department_month(month):
+    """reports.get_department_month of every shard, each row with its ``Tenant``."""
+    return [
+        dict(row, Tenant=tenant)
+        for tenant, rows in fan_out(reports.get_department_month, month).items() for row in rows
+    ]
+
+# Splitting a database into shards
+def _columns(cursor, schema, table):
+    cursor.execute(f"PRAGMA {schema}.table_info({table})")
+    return [row[1] for row in cursor.fetchall()]
+
+def _copy(cursor, table, where, params):
+    # Only the columns both schemas have, in case the source is behind on migrations
+    target = set(_columns(cursor, "main", table))
+    columns = [name for name in _columns(cursor, "source", table) if name in target]
+    names = ", ".join(f'"{name}"' for name in columns)
+    cursor.execute(f"INSERT INTO main.{table} ({names}) SELECT {names} FROM source.{table} t WHERE {where}", params)
+    return cursor.rowcount
+
+def _split_copy(cursor, claimed, params, keep=True):
+    """Copy the rows of the departments ``claimed`` matches (SQL on d), or of every other one."""
+    test = "EXISTS" if keep else "NOT EXISTS"
+    department = f"{test} (SELECT 1 FROM source.Department d WHERE d.DepartmentID = t.DepartmentID AND ({claimed}))"
+    employee = f"""{test} (
+        SELECT 1 FROM source.Employee_details e JOIN source.Department d ON d.DepartmentID = e.DepartmentID
+        WHERE e.EmployeeID = t.EmployeeID AND ({claimed})
+    )"""
+    return {
+        table: _copy(cursor, table, department if table in DEPARTMENT_TABLES else employee, params)
+        for table in SPLIT_TABLES
+    }
+
+def split(source, output, tenants, rest=None):
+    """Copy ``source`` into one new database per tenant under ``output``.
+
+    ``tenants`` maps each tenant to an inclusive (low, high) DepartmentID
+    range. Rows of no range (employees without a department, say) go to the
+    tenant ``rest`` if given and are left out otherwise. Returns
+    {tenant: {table: rows copied}}. The source is only read.
+    """
+    ranges = list(tenants.values())
+    for name, (low, high) in tenants.items():
+        if low > high:
+            raise ValueError(f"{name}: empty department range {low}-{high}")
+        for other, (other_low, other_high) in tenants.items():
+            if other < name and low <= other_high and other_low <= high:
+                raise ValueError(f"department ranges of {other} and {name} overlap")
+    names = list(tenants) + ([rest] if rest else [])
+    if len(set(names)) != len(names):
+        raise ValueError("tenant names must be unique")
+    os.makedirs(output, exist_ok=True)
+    files = {name: os.path.join(output, f"{name}.db") for name in names}
+    existing = [path for path in files.values() if os.path.exists(path)]
+    if existing:
+        raise ValueError(f"shard files already exist: {', '.join(existing)}")
+    if not os.path.exists(source):
+        raise ValueError(f"no database at {source}")
+
+    database.configure_shards(files)
+    copied = {}
+    for name in names:
+        with database.use_shard(name), database.get_connection("primary") as connection:
+            cursor = connection.cursor()
+            cursor.execute("ATTACH DATABASE ? AS source", (os.path.abspath(source),))
+            try:
+                with database.transaction():
+                    if name == rest:
+                        # Employees without a department have no d row and land here too
+                        claimed = " OR ".join("d.DepartmentID BETWEEN ? AND ?" for _ in tenants)
+                        copied[name] = _split_copy(cursor, claimed, [bound for pair in ranges for bound in pair], keep=False)
+                    else:
+                        copied[name] = _split_copy(cursor, "d.DepartmentID BETWEEN ? AND ?", list(tenants[name]))
+                    # The triggers logged every copied row; a shard's feed starts empty
+                    cursor.execute("DELETE FROM change_log")
+                    cursor.execute("SELECT IFNULL(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'change_log'")
+                    sequence = cursor.fetchone()[0]
+                    cursor.execute("UPDATE change_log_state SET FloorSeq = ?, CompactedSeq = ?", (sequence, sequence))
+            finally:
+                cursor.execute("DETACH DATABASE source")
+    database.close()
+    return copied
+
+def _range(value):
+    name, separator, bounds = value.partition("=")
+    low, dash, high = bounds.partition("-")
+    try:
+        return name, (int(low), int(high if dash else low))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected name=low-high, got {value!r}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Split the EMS database into tenant shards.")
+    parser.add_argument("command", choices=["split", "list"])
+    parser.add_argument("--database", default="ems.db")
+    parser.add_argument("--output", default="shards", help="shard directory")
+    parser.add_argument("--tenant", action="append", type=_range, default=[],
+                        help="name=low-high: a tenant and its DepartmentID range (repeatable)")
+    parser.add_argument("--rest", help="tenant taking the rows of no range")
+    args = parser.parse_args(argv)
+
+    if args.command == "split":
+        if not args.tenant:
+            parser.error("split needs at least one --tenant")
+        # Bring the source schema up to date so every table can be copied
+        database.initialize(args.database, pool_size=1, backfill=False)
+        database.close()
+        started = time.perf_counter()
+        try:
+            copied = split(args.database, args.output, dict(args.tenant), args.rest)
+        except (ValueError, sqlite3.Error) as error:
+            print(f"❌ {error}")
+            return 1
+        for name, tables in copied.items():
+            print(f"✅ {name}: " + ", ".join(f"{rows} {table}" for table, rows in tables.items()))
+        print(f"split into {len(copied)} shards in {time.perf_counter() - started:.2f}s")
+        print(f"serve them with EMS_SHARD_DIR={args.output}")
+    else:
+        for name, path in load_config("", args.output).items():
+            print(f"{name:<20}{os.path.getsize(path):>14} bytes  {path}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())